@@ -0,0 +1,197 @@
+'''
+Benchmarks of jrnr's own overhead, for `asv <https://asv.readthedocs.io>`_
+
+Each benchmark uses a synthetic job with a no-op ``run_job``, so the times
+measured are the cost of dispatching, tracking and submitting tasks rather
+than of running them. Submission uses a fake ``sbatch``, so the suite runs on
+any machine.
+
+Run with ``asv run`` (or ``asv run --python=same`` to use the current
+environment), and compare commits with ``asv compare``.
+'''
+
+from __future__ import absolute_import
+
+import os
+import shutil
+import tempfile
+import itertools
+
+from click.testing import CliRunner
+
+from jrnr.jrnr import slurm_runner, get_job_by_index
+from jrnr.spec import JobSpec
+from jrnr.state import get_state_store
+
+FAKE_SBATCH = '''#!/bin/sh
+echo "Submitted batch job 1234567"
+'''
+
+
+def make_spec(num_tasks):
+    '''
+    A job spec of ``num_tasks`` tasks over three dimensions
+    '''
+
+    inner = min(num_tasks, 100)
+    middle = min(num_tasks // inner, 10)
+    outer = num_tasks // (inner * middle)
+
+    return (
+        [{'model': 'model{}'.format(i)} for i in range(outer)],
+        [{'scenario': 'rcp{}'.format(i)} for i in range(middle)],
+        [{'year': 2000 + i} for i in range(inner)])
+
+
+def make_runner(num_tasks):
+    @slurm_runner(job_spec=make_spec(num_tasks))
+    def run_job(metadata, model, scenario, year, interactive=False):
+        pass
+
+    return run_job
+
+
+def invoke(runner, args):
+    result = CliRunner().invoke(runner, [str(arg) for arg in args])
+
+    if result.exit_code != 0:
+        raise RuntimeError(
+            'jrnr {} failed: {}\n{}'.format(
+                args[0], result.exception, result.output))
+
+    return result
+
+
+class _InTempDir(object):
+    '''
+    Run each benchmark in a fresh working directory, with a fake ``sbatch``
+    on the path
+    '''
+
+    def setup(self, *params):
+        self._cwd = os.getcwd()
+        self._path = os.environ.get('PATH', '')
+        self.tmpdir = tempfile.mkdtemp()
+
+        sbatch = os.path.join(self.tmpdir, 'sbatch')
+
+        with open(sbatch, 'w') as f:
+            f.write(FAKE_SBATCH)
+
+        os.chmod(sbatch, 0o755)
+        os.environ['PATH'] = self.tmpdir + os.pathsep + self._path
+        os.chdir(self.tmpdir)
+
+    def teardown(self, *params):
+        os.chdir(self._cwd)
+        os.environ['PATH'] = self._path
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+
+class DecodeSuite(object):
+    '''
+    Mapping task IDs to keyword arguments
+    '''
+
+    params = [10**3, 10**4, 10**5, 10**6]
+    param_names = ['tasks']
+
+    def setup(self, num_tasks):
+        self.spec = JobSpec(make_spec(num_tasks))
+        self.spec_tuple = make_spec(num_tasks)
+        self.task_ids = range(len(self.spec))
+        self.sample = range(0, num_tasks, max(1, num_tasks // 1000))
+
+    def time_decode_many(self, num_tasks):
+        self.spec.decode_many(self.task_ids)
+
+    def time_get_job(self, num_tasks):
+        for task_id in self.sample:
+            self.spec.get_job(task_id)
+
+    def time_get_job_by_index(self, num_tasks):
+        # uncompiled job spec, as passed by older callers
+        for task_id in self.sample:
+            get_job_by_index(self.spec_tuple, task_id)
+
+    def time_compile(self, num_tasks):
+        len(JobSpec(self.spec_tuple))
+
+
+class ScriptSuite(_InTempDir):
+    '''
+    Generating and submitting job scripts
+    '''
+
+    params = [10**3, 10**6]
+    param_names = ['tasks']
+
+    def setup(self, num_tasks):
+        _InTempDir.setup(self)
+        self.runner = make_runner(num_tasks)
+
+    def time_prep(self, num_tasks):
+        invoke(self.runner, ['prep', '-j', 'bench', '-u', '1'])
+
+    def time_run(self, num_tasks):
+        invoke(self.runner, ['run', '-j', 'bench', '-u', '1'])
+
+
+class DispatchSuite(_InTempDir):
+    '''
+    Claiming and completing tasks with several local worker processes
+    '''
+
+    params = ([1000, 10000], ['file', 'sqlite'], [1, 100])
+    param_names = ['tasks', 'backend', 'claim_batch']
+
+    timeout = 600
+    number = 1
+    repeat = 3
+
+    def setup(self, num_tasks, backend, claim_batch):
+        _InTempDir.setup(self)
+        self.runner = make_runner(num_tasks)
+        self.job_ids = itertools.count()
+
+    def time_local(self, num_tasks, backend, claim_batch):
+        invoke(self.runner, [
+            'local', '-j', 'bench', '-u', next(self.job_ids),
+            '--workers', 4, '--backend', backend,
+            '--claim_batch', claim_batch])
+
+
+class StateSuite(_InTempDir):
+    '''
+    Reading the state of every task of a finished job
+    '''
+
+    params = ([10**3, 10**4, 10**5], ['file', 'sqlite'])
+    param_names = ['tasks', 'backend']
+
+    timeout = 600
+
+    def setup(self, num_tasks, backend):
+        _InTempDir.setup(self)
+        self.runner = make_runner(num_tasks)
+
+        store = get_state_store('bench', '1', backend)
+        store.setup()
+
+        if backend == 'file':
+            # one lock file per task
+            for task_id in range(num_tasks):
+                store.complete(task_id)
+
+        else:
+            store.claim(0, num_tasks)
+            store.complete(0, num_tasks)
+
+    def time_status(self, num_tasks, backend):
+        invoke(self.runner, [
+            'status', '-j', 'bench', '-u', '1', '--backend', backend])
+
+    def time_wait(self, num_tasks, backend):
+        invoke(self.runner, [
+            'wait', '--job_name', 'bench', '--job_id', '1',
+            '--num_jobs', num_tasks, '--backend', backend])
@@ -4,6 +4,10 @@
 
 from __future__ import absolute_import
 from jrnr.jrnr import slurm_runner
+from jrnr.spec import JobSpec
+from jrnr.memo import memoize
+from jrnr.shm import NodeCache
+from jrnr.attempt import stage_output
 
 __author__ = """Justin Simcock"""
 __email__ = 'jsimcock@rhg.com'
@@ -11,6 +15,10 @@ __version__ = '0.2.4'
 
 _module_imports = (
     slurm_runner,
+    JobSpec,
+    memoize,
+    NodeCache,
+    stage_output,
 )
 
 __all__ = list(map(lambda x: x.__name__, _module_imports))
@@ -1,6 +1,16 @@
 from contextlib import contextmanager
 import os
 import sys
+import time
+import errno
+import select
+import ctypes
+import ctypes.util
+
+try:
+    import resource
+except ImportError:
+    resource = None
 
 py2 = (sys.version_info[0] < 3)
 
@@ -18,3 +28,202 @@ else:
     def exclusive_open(fp):
         with open(fp, 'x') as f:
             yield f
+
+
+if py2:
+
+    def iterdir(path):
+        return iter(os.listdir(path))
+
+else:
+
+    def iterdir(path):
+        for entry in os.scandir(path):
+            yield entry.name
+
+
+# inotify event masks, from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+
+
+class _PollingWatcher(object):
+
+    def wait(self, timeout):
+        time.sleep(timeout)
+        return False
+
+    def close(self):
+        pass
+
+
+class _InotifyWatcher(object):
+
+    def __init__(self, path):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+
+        self.fd = libc.inotify_init1(os.O_NONBLOCK)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+
+        mask = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE
+        if libc.inotify_add_watch(self.fd, path.encode(), mask) < 0:
+            os.close(self.fd)
+            raise OSError(ctypes.get_errno(), 'inotify_add_watch failed')
+
+    def wait(self, timeout):
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+
+        if not ready:
+            return False
+
+        while True:
+            try:
+                os.read(self.fd, 65536)
+            except OSError as e:
+                if e.errno == errno.EAGAIN:
+                    return True
+                raise
+
+    def close(self):
+        os.close(self.fd)
+
+
+@contextmanager
+def watch_directory(path):
+    '''
+    Watch a directory for changes
+
+    Yields an object whose ``wait(timeout)`` method blocks until a file in
+    ``path`` is created, written, renamed or removed, or until ``timeout``
+    seconds have passed. ``wait`` returns True if it was woken by a change.
+
+    Uses inotify where available, and otherwise simply sleeps for ``timeout``.
+    inotify only reports changes made from the current host, so callers
+    should not rely on being woken for changes made by other nodes on a
+    shared filesystem.
+    '''
+
+    try:
+        watcher = _InotifyWatcher(path)
+    except (OSError, AttributeError, TypeError):
+        watcher = _PollingWatcher()
+
+    try:
+        yield watcher
+    finally:
+        watcher.close()
+
+
+def get_rss():
+    '''
+    Resident set size of the current process in bytes
+
+    Reads the current RSS from ``/proc`` where available. Elsewhere, falls
+    back to the peak RSS reported by ``getrusage``, or ``None`` if neither is
+    available.
+    '''
+
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError, IndexError):
+        pass
+
+    if resource is None:
+        return None
+
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # ru_maxrss is reported in bytes on macOS and kilobytes elsewhere
+    if sys.platform == 'darwin':
+        return maxrss
+
+    return maxrss * 1024
+
+
+def reset_peak_rss():
+    '''
+    Reset the peak RSS of the current process, so that ``get_peak_rss``
+    measures the peak from now on
+
+    Only supported on Linux 4.0 and later. Returns False if the peak could
+    not be reset.
+    '''
+
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except (IOError, OSError):
+        return False
+
+    return True
+
+
+def get_peak_rss():
+    '''
+    Peak resident set size of the current process in bytes
+
+    Reads ``VmHWM`` from ``/proc`` where available, which can be reset with
+    ``reset_peak_rss``. Elsewhere, falls back to the lifetime peak reported
+    by ``getrusage``, or ``None`` if neither is available.
+    '''
+
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError, ValueError, IndexError):
+        pass
+
+    if resource is None:
+        return None
+
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    if sys.platform == 'darwin':
+        return maxrss
+
+    return maxrss * 1024
+
+
+def get_cpu_time():
+    '''
+    User and system CPU seconds used by this process and its waited-for
+    children
+    '''
+
+    if resource is None:
+        return time.process_time()
+
+    return sum(
+        usage.ru_utime + usage.ru_stime
+        for usage in (
+            resource.getrusage(resource.RUSAGE_SELF),
+            resource.getrusage(resource.RUSAGE_CHILDREN)))
+
+
+def get_io():
+    '''
+    Bytes read from and written to storage by this process
+
+    Returns
+    -------
+    io : dict or None
+        ``read_bytes`` and ``write_bytes`` from ``/proc/self/io``, or None if
+        these are not available
+    '''
+
+    try:
+        with open('/proc/self/io', 'r') as f:
+            fields = dict(line.split(':', 1) for line in f if ':' in line)
+
+        return {
+            'read_bytes': int(fields['read_bytes']),
+            'write_bytes': int(fields['write_bytes'])}
+
+    except (IOError, OSError, KeyError, ValueError):
+        return None
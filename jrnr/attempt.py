@@ -0,0 +1,166 @@
+'''
+Outputs written by an attempt at running tasks
+
+With ``--speculate``, the same block of tasks can be run by two workers at
+once, and only the first attempt to complete the block is committed. Tasks
+which write their outputs to the paths returned by ``stage_output`` write to
+a temporary file next to each output instead. Staged files are moved into
+place when the attempt is committed, and removed if another attempt committed
+first or the task failed, so duplicate attempts never overwrite each other's
+outputs, and interrupted tasks never leave partial outputs behind.
+'''
+
+from __future__ import absolute_import
+
+import os
+import uuid
+import threading
+import contextlib
+
+_local = threading.local()
+
+
+class Attempt(object):
+    '''
+    Staged outputs and deferred actions of an attempt at a block of tasks
+    '''
+
+    def __init__(self):
+        self.staged = []
+        self._callbacks = []
+
+    def stage(self, path):
+        '''
+        Temporary path in the same directory as ``path``, with the same
+        extension, to be moved to ``path`` on commit
+        '''
+
+        dirname, fname = os.path.split(path)
+        base, ext = os.path.splitext(fname)
+
+        tmp = os.path.join(
+            dirname, '.{}.{}{}'.format(base, uuid.uuid4().hex[:12], ext))
+
+        self.staged.append((tmp, path))
+
+        return tmp
+
+    def when_committed(self, func):
+        '''
+        Call ``func`` once the attempt is committed, or immediately if it has
+        no staged outputs
+        '''
+
+        if self.staged:
+            self._callbacks.append(func)
+        else:
+            func()
+
+    def mark(self):
+        return (len(self.staged), len(self._callbacks))
+
+    def discard(self, mark=(0, 0)):
+        '''
+        Remove the staged outputs added since ``mark``
+        '''
+
+        for tmp, _ in self.staged[mark[0]:]:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+        del self.staged[mark[0]:]
+        del self._callbacks[mark[1]:]
+
+    def commit(self):
+        '''
+        Move staged outputs into place and run deferred actions
+        '''
+
+        for tmp, path in self.staged:
+            if os.path.exists(tmp):
+                os.rename(tmp, path)
+
+        callbacks = self._callbacks
+
+        self.staged = []
+        self._callbacks = []
+
+        for func in callbacks:
+            func()
+
+
+@contextlib.contextmanager
+def attempt():
+    '''
+    Collect the outputs staged by the current thread within a context
+
+    Anything not committed by the end of the context is discarded.
+    '''
+
+    previous = getattr(_local, 'attempt', None)
+    _local.attempt = current = Attempt()
+
+    try:
+        yield current
+
+    finally:
+        current.discard()
+        _local.attempt = previous
+
+
+def current_attempt():
+    '''
+    The attempt running on the current thread, or None
+    '''
+
+    return getattr(_local, 'attempt', None)
+
+
+def stage_output(path):
+    '''
+    Path to which a task should write the output ``path``
+
+    Within a task run by a jrnr worker, this is a temporary file which is
+    moved to ``path`` once the task's block is committed. Elsewhere (e.g. in
+    ``run_interactive``), ``path`` is returned unchanged. Call this from the
+    thread running the task.
+
+    Examples
+    --------
+
+    .. code-block:: python
+
+        >>> import tempfile
+        >>> path = os.path.join(tempfile.mkdtemp(), 'tas_2000.nc')
+        >>> stage_output(path) == path
+        True
+
+        >>> with attempt() as current:
+        ...     tmp = stage_output(path)
+        ...     with open(tmp, 'w') as f:
+        ...         _ = f.write('data')
+        ...     os.path.exists(path)
+        ...     current.commit()
+        ...
+        False
+
+        >>> os.path.exists(path), os.path.exists(tmp)
+        (True, False)
+
+    In a task:
+
+    .. code-block:: python
+
+        @slurm_runner(job_spec=JOB_SPEC, output=WRITE_PATH)
+        def make_tas(metadata, scenario, year, model, interactive=False):
+            ds = compute_tas(scenario, year, model)
+            ds.to_netcdf(stage_output(WRITE_PATH.format(**metadata)))
+
+    '''
+
+    current = current_attempt()
+
+    if current is None:
+        return path
+
+    return current.stage(path)
@@ -0,0 +1,350 @@
+'''
+Content-addressed cache of task results
+
+A task's cache key is a hash of its keyword arguments, a fingerprint of the
+code which runs it, and the modification times and sizes of any input files
+it declares. A task whose key is found in the cache has already been run with
+the same arguments, code, and inputs, and does not need to be run again.
+'''
+
+from __future__ import absolute_import
+
+import os
+import json
+import time
+import shutil
+import hashlib
+import uuid
+import inspect
+import tempfile
+
+from jrnr._compat import iterdir
+
+
+def fingerprint(func):
+    '''
+    Hash of the source code of a function
+
+    Falls back to the function's compiled bytecode if its source is not
+    available.
+
+    Examples
+    --------
+
+    .. code-block:: python
+
+        >>> def f(x):
+        ...     return x + 1
+        ...
+        >>> len(fingerprint(f))
+        40
+
+    '''
+
+    try:
+        source = inspect.getsource(func).encode('utf-8')
+    except (OSError, TypeError):
+        code = func.__code__
+        source = code.co_code + repr(code.co_consts).encode('utf-8')
+
+    return hashlib.sha1(source).hexdigest()
+
+
+def _file_hash(path):
+    sha = hashlib.sha1()
+
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha.update(chunk)
+
+    return sha.hexdigest()
+
+
+def _file_state(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return [path, None, None]
+
+    return [path, stat.st_mtime, stat.st_size]
+
+
+def cache_key(kwargs, code='', inputs=None):
+    '''
+    Cache key for a task
+
+    Parameters
+    ----------
+
+    kwargs : dict
+        The task's keyword arguments. Values are compared as strings.
+
+    code : str, optional
+        Fingerprint of the code run by the task
+
+    inputs : list of str, optional
+        Paths of files read by the task. A task's key changes whenever one of
+        these is modified.
+
+    Examples
+    --------
+
+    .. code-block:: python
+
+        >>> cache_key({'year': 2000}) == cache_key({'year': '2000'})
+        True
+
+        >>> cache_key({'year': 2000}) == cache_key({'year': 2000}, 'abc')
+        False
+
+    '''
+
+    record = {
+        'kwargs': {k: str(v) for k, v in kwargs.items()},
+        'code': code,
+        'inputs': [_file_state(path) for path in (inputs or [])]}
+
+    return hashlib.sha256(
+        json.dumps(record, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class ResultCache(object):
+    '''
+    Task results stored in a directory, one entry per cache key
+
+    Each entry is a small JSON record at ``{cachedir}/{key[:2]}/{key}.json``,
+    optionally with a copy of the task's output file alongside it at
+    ``{key}.out``. Entries are written atomically, so the cache can be shared
+    by workers on different nodes. The size and modification time of a
+    task's output (and the hash of a stored copy) are recorded in the entry,
+    so an output which has since been overwritten or truncated is not
+    mistaken for the cached result.
+
+    Parameters
+    ----------
+
+    cachedir : str
+        Directory in which to store the cache
+    store_outputs : bool, optional
+        Keep a copy of each output, to restore outputs which are missing or
+        changed (default False)
+    '''
+
+    def __init__(self, cachedir, store_outputs=False):
+        self.cachedir = cachedir
+        self.store_outputs = store_outputs
+
+    def _path(self, key, ext):
+        return os.path.join(self.cachedir, key[:2], '{}.{}'.format(key, ext))
+
+    def _write(self, path, write):
+        dirname = os.path.dirname(path)
+
+        if not os.path.isdir(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError:
+                if not os.path.isdir(dirname):
+                    raise
+
+        fd, tmp = tempfile.mkstemp(dir=dirname, prefix='.tmp-')
+
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                write(f)
+
+            os.rename(tmp, path)
+
+        except BaseException:
+            os.remove(tmp)
+            raise
+
+    def get(self, key):
+        '''
+        Look up an entry, marking it as recently used
+
+        Returns
+        -------
+        entry : dict or None
+        '''
+
+        path = self._path(key, 'json')
+
+        try:
+            with open(path, 'r') as f:
+                entry = json.load(f)
+
+            os.utime(path, None)
+
+        except (OSError, IOError, ValueError):
+            return None
+
+        return entry
+
+    def put(self, key, entry=None, output=None):
+        '''
+        Store an entry, recording the state of the file at ``output`` and,
+        with ``store_outputs``, a copy of it
+        '''
+
+        entry = dict(entry or {})
+        entry['created'] = time.time()
+        entry['output'] = None
+
+        if output is not None and os.path.isfile(output):
+            stat = os.stat(output)
+
+            entry['output'] = output
+            entry['output_size'] = stat.st_size
+            entry['output_mtime'] = stat.st_mtime
+
+        if entry['output'] is not None and self.store_outputs:
+            sha = hashlib.sha1()
+
+            def copy(f):
+                with open(output, 'rb') as src:
+                    for chunk in iter(lambda: src.read(1 << 20), b''):
+                        sha.update(chunk)
+                        f.write(chunk)
+
+            self._write(self._path(key, 'out'), copy)
+
+            entry['output_sha1'] = sha.hexdigest()
+
+        data = json.dumps(entry, sort_keys=True).encode('utf-8')
+        self._write(self._path(key, 'json'), lambda f: f.write(data))
+
+    def matches(self, entry, output):
+        '''
+        Whether the file at ``output`` is the output stored with ``entry``
+        '''
+
+        try:
+            stat = os.stat(output)
+        except OSError:
+            return False
+
+        if entry.get('output_size') != stat.st_size:
+            return False
+
+        if entry.get('output_mtime') == stat.st_mtime:
+            return True
+
+        # only hash the file if its contents may be unchanged
+        if entry.get('output_sha1') is None:
+            return False
+
+        return _file_hash(output) == entry['output_sha1']
+
+    def restore(self, key, output, entry=None):
+        '''
+        Make sure the file at ``output`` is the one stored with an entry,
+        copying the stored output into place if ``output`` is missing or
+        differs from it
+
+        Returns
+        -------
+        restored : bool
+            False if ``output`` is not the entry's output and no copy of it
+            was stored
+        '''
+
+        if entry is None:
+            entry = self.get(key) or {}
+
+        if self.matches(entry, output):
+            return True
+
+        stored = self._path(key, 'out')
+
+        if not os.path.isfile(stored):
+            return False
+
+        dirname = os.path.dirname(output)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+
+        # copy next to the output, so a partial copy never replaces it
+        tmp = os.path.join(dirname, '.tmp-{}-{}'.format(
+            uuid.uuid4().hex[:12], os.path.basename(output)))
+
+        try:
+            shutil.copyfile(stored, tmp)
+
+            # so later lookups recognize the output without hashing it
+            if entry.get('output_mtime') is not None:
+                os.utime(tmp, (time.time(), entry['output_mtime']))
+
+            os.rename(tmp, output)
+
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+        return True
+
+    def _entries(self):
+        '''
+        ``(last_used, size, paths)`` for every entry in the cache
+        '''
+
+        if not os.path.isdir(self.cachedir):
+            return
+
+        for prefix in iterdir(self.cachedir):
+            dirname = os.path.join(self.cachedir, prefix)
+
+            if not os.path.isdir(dirname):
+                continue
+
+            for fname in iterdir(dirname):
+                if not fname.endswith('.json'):
+                    continue
+
+                paths = [
+                    os.path.join(dirname, fname),
+                    os.path.join(dirname, fname[:-len('json')] + 'out')]
+
+                try:
+                    last_used = os.stat(paths[0]).st_mtime
+                except OSError:
+                    continue
+
+                size = sum(
+                    os.path.getsize(p) for p in paths if os.path.exists(p))
+
+                yield last_used, size, paths
+
+    def evict(self, max_size=None, max_age=None):
+        '''
+        Remove entries not used in the last ``max_age`` seconds, then the
+        least recently used entries until the cache is at most ``max_size``
+        bytes
+
+        Returns
+        -------
+        removed : int
+            Number of entries removed
+        '''
+
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        now = time.time()
+        removed = 0
+
+        for last_used, size, paths in entries:
+            expired = max_age is not None and now - last_used > max_age
+            too_big = max_size is not None and total > max_size
+
+            if not (expired or too_big):
+                continue
+
+            for path in paths:
+                if os.path.exists(path):
+                    os.remove(path)
+
+            total -= size
+            removed += 1
+
+        return removed
@@ -3,19 +3,38 @@ from __future__ import absolute_import
 
 import re
 import os
-import time
+import sys
+import json
 import math
+import time
 import toolz
 import click
 import pprint
+import pstats
+import cProfile
 import logging
+import hashlib
+import bisect
 import inspect
 import warnings
+import threading
 import itertools
 import functools
+import contextlib
 import subprocess
-
-from jrnr._compat import exclusive_open
+import multiprocessing
+import multiprocessing.connection
+import concurrent.futures
+
+from jrnr.spec import JobSpec
+from jrnr.cache import ResultCache, cache_key, fingerprint
+from jrnr.usage import TaskUsage, UsageLog, read_usage, summarize
+from jrnr.sacct import run_sacct, slurm_report
+from jrnr.schedule import task_durations, longest_first
+from jrnr.state import get_state_store
+from jrnr.attempt import attempt, current_attempt
+from jrnr.logs import WorkerLog, read_task_log
+from jrnr._compat import watch_directory, get_rss, iterdir
 
 FORMAT = '%(asctime)-15s %(message)s'
 
@@ -24,6 +43,69 @@ logger.setLevel('DEBUG')
 
 formatter = logging.Formatter(FORMAT)
 
+
+class _TaskLogHandler(logging.Handler):
+    '''
+    Route log records to the log file of the task running on each thread
+
+    Records emitted from a thread which is not running a task (e.g. a helper
+    thread started by the task itself) go to the only running task's log if
+    there is exactly one, and are otherwise dropped.
+    '''
+
+    def __init__(self):
+        logging.Handler.__init__(self, logging.DEBUG)
+        self._handlers = {}
+        self._lock_handlers = threading.Lock()
+
+    def task(self, path):
+        '''
+        Send records from the current thread to ``path`` within this context
+        '''
+
+        handler = logging.FileHandler(path)
+        handler.setFormatter(formatter)
+        handler.setLevel(logging.DEBUG)
+
+        return self.route(handler)
+
+    @contextlib.contextmanager
+    def route(self, handler):
+        '''
+        Send records from the current thread to ``handler`` within this
+        context, closing it on exit
+        '''
+
+        thread = threading.current_thread().ident
+
+        with self._lock_handlers:
+            self._handlers[thread] = handler
+
+        try:
+            yield handler
+
+        finally:
+            with self._lock_handlers:
+                del self._handlers[thread]
+
+            handler.close()
+
+    def emit(self, record):
+        with self._lock_handlers:
+            handler = self._handlers.get(threading.current_thread().ident)
+
+            if handler is None and len(self._handlers) == 1:
+                handler = list(self._handlers.values())[0]
+
+        if handler is not None:
+            handler.handle(record)
+
+
+task_logs = _TaskLogHandler()
+
+# exit code used by a worker to ask its supervisor for a replacement
+WORKER_RECYCLE = 75
+
 SLURM_SCRIPT = '''
 #!/bin/bash
 # Job name:
@@ -48,67 +130,1058 @@ SLURM_SCRIPT = '''
 {output}
 '''.strip()
 
-SLURM_MULTI_SCRIPT = SLURM_SCRIPT + '''
-#
-#SBATCH --array=0-{maxnodes}
+SLURM_ARRAY_SCRIPT = SLURM_SCRIPT + '''
+#
+#SBATCH --array=0-{maxnodes}
+
+# set up directories
+mkdir -p {logdir}
+mkdir -p locks
+
+## Run command
+
+'''
+
+SLURM_DO_JOB = '''python {filepath} do_job --job_name {jobname} \
+--job_id {uniqueid} --num_jobs {numjobs} --logdir "{logdir}" \
+--node_index ${{SLURM_ARRAY_TASK_ID}} --num_nodes {numnodes} \
+--workers {jobs_per_node} {flags} {job_flags} \
+>> {logdir}/nohup-{jobname}-{uniqueid}-${{SLURM_ARRAY_TASK_ID}}.out'''
+
+SLURM_MULTI_SCRIPT = SLURM_ARRAY_SCRIPT + 'nohup ' + SLURM_DO_JOB + ''' &
+
+python {filepath} wait --job_name {jobname} \
+--job_id {uniqueid} --num_jobs {numjobs} {flags}
+'''
+
+# each array element exits as soon as its node has nothing left to claim
+SLURM_RELEASE_SCRIPT = SLURM_ARRAY_SCRIPT + SLURM_DO_JOB + '''
+'''
+
+SLURM_SINGLE_SCRIPT = SLURM_SCRIPT + '''
+
+## Run command
+python {filepath} {flags}
+'''
+
+
+def _normalize(name):
+    ''' normalize click commands with underscores to dashes for click>=7.0 compatability '''
+    return name.replace("_", "-")
+
+
+def _product(values):
+    '''
+    Examples
+    --------
+
+    .. code-block:: python
+
+        >>> _product([3, 4, 5])
+        60
+
+    '''
+    return functools.reduce(lambda x, y: x*y, values, 1)
+
+
+def _unpack_job(specs):
+    job = {}
+    for spec in specs:
+        job.update(spec)
+    return job
+
+
+def generate_jobs(job_spec):
+    for specs in itertools.product(*job_spec):
+        yield _unpack_job(specs)
+
+
+def count_jobs(job_spec):
+    if isinstance(job_spec, JobSpec):
+        return len(job_spec)
+
+    return _product(map(len, job_spec))
+
+
+def _iter_tasks(num_jobs, worker_rank=0, num_workers=1, own=None):
+    '''
+    Iterate over task IDs in the order a worker should attempt to claim them
+
+    Task IDs are dealt round-robin into ``num_workers`` disjoint slices, and
+    each worker starts on its own slice (every ``num_workers``-th task,
+    beginning at ``worker_rank``). Only once its own slice is exhausted does
+    a worker move on to the slices of its neighbors, so concurrently started
+    workers do not all contend for the same lock files.
+
+    If ``own`` is True, only the worker's own slice is returned, and if it
+    is False, only the slices of its neighbors.
+
+    Examples
+    --------
+
+    .. code-block:: python
+
+        >>> list(_iter_tasks(7, worker_rank=1, num_workers=3))
+        [1, 4, 2, 5, 0, 3, 6]
+
+        >>> list(_iter_tasks(3, worker_rank=5, num_workers=10))
+        [2, 0, 1]
+
+        >>> list(_iter_tasks(7, worker_rank=1, num_workers=3, own=False))
+        [2, 5, 0, 3, 6]
+
+    '''
+
+    num_workers = max(1, min(num_workers, num_jobs))
+    worker_rank = worker_rank % num_workers
+
+    if own is None:
+        offsets = range(num_workers)
+    elif own:
+        offsets = range(1)
+    else:
+        offsets = range(1, num_workers)
+
+    for offset in offsets:
+        start = (worker_rank + offset) % num_workers
+        for task_id in range(start, num_jobs, num_workers):
+            yield task_id
+
+
+def _iter_group_blocks(
+        groups,
+        num_blocks,
+        worker_rank=0,
+        num_workers=1,
+        claim_batch=1,
+        first_task=0,
+        own=None):
+    '''
+    Iterate over block indices in the order a worker should attempt to claim
+    them, keeping blocks of the same group together
+
+    Groups are given by the ID of their first task. Each group is split into
+    runs of consecutive blocks, short enough for every worker to get a run,
+    and runs are dealt to workers like task IDs in ``_iter_tasks`` (which
+    also describes ``own``). A worker finishes each of its runs before
+    starting the next, so consecutive tasks run by a worker usually belong
+    to the same group.
+
+    Examples
+    --------
+
+    .. code-block:: python
+
+        >>> list(_iter_group_blocks([0, 5, 8], 10, 0, 2))
+        [0, 1, 2, 3, 4, 8, 9, 5, 6, 7]
+
+        >>> list(_iter_group_blocks([0, 5, 8], 10, 1, 2))
+        [5, 6, 7, 0, 1, 2, 3, 4, 8, 9]
+
+        >>> list(_iter_group_blocks([0, 3], 3, 1, 2, claim_batch=2))
+        [1, 2, 0]
+
+    '''
+
+    length = max(1, int(math.ceil(float(num_blocks) / num_workers)))
+
+    starts = sorted(set([0] + [
+        (g - first_task) // claim_batch for g in groups
+        if first_task <= g < first_task + num_blocks * claim_batch]))
+
+    runs = []
+
+    for start, stop in zip(starts, starts[1:] + [num_blocks]):
+        for run_start in range(start, stop, length):
+            runs.append((run_start, min(run_start + length, stop)))
+
+    for run in _iter_tasks(len(runs), worker_rank, num_workers, own):
+        for block in range(*runs[run]):
+            yield block
+
+
+def _iter_blocks(block_ids, num_jobs, claim_batch=1, first_task=0):
+    '''
+    Convert block indices into ``(start, stop)`` task ID ranges
+
+    Blocks of ``claim_batch`` tasks are counted from ``first_task`` and are
+    truncated at ``num_jobs``.
+
+    Examples
+    --------
+
+    .. code-block:: python
+
+        >>> list(_iter_blocks([0, 2, 1], 11, claim_batch=4))
+        [(0, 4), (8, 11), (4, 8)]
+
+        >>> list(_iter_blocks([0, 1], 11, claim_batch=4, first_task=5))
+        [(5, 9), (9, 11)]
+
+    '''
+
+    for block in block_ids:
+        yield (
+            first_task + block * claim_batch,
+            min(first_task + (block + 1) * claim_batch, num_jobs))
+
+
+def _scanned_state(tasks, start, stop):
+    '''
+    State of the block of tasks ``start`` to ``stop - 1``, given the sets of
+    task IDs in each state returned by a state store's ``scan``
+
+    Returns ``'lck'`` if any of its tasks are in progress, ``'done'`` if every
+    task is done or errored, and None if the block may still be claimed.
+
+    Examples
+    --------
+
+    .. code-block:: python
+
+        >>> tasks = {'lck': {4}, 'done': {0, 2}, 'err': {1, 3}}
+        >>> [_scanned_state(tasks, *block) for block in [(0, 2), (2, 5)]]
+        ['done', 'lck']
+
+        >>> print(_scanned_state(tasks, 5, 6))
+        None
+
+    '''
+
+    block = range(start, stop)
+
+    if any(task_id in tasks['lck'] for task_id in block):
+        return 'lck'
+
+    if all(
+            task_id in tasks['done'] or task_id in tasks['err']
+            for task_id in block):
+        return 'done'
+
+    return None
+
+
+def _count_blocks(num_jobs, claim_batch=1, first_task=0):
+    '''
+    Examples
+    --------
+
+    .. code-block:: python
+
+        >>> _count_blocks(11, claim_batch=4)
+        3
+
+        >>> _count_blocks(11, claim_batch=4, first_task=5)
+        2
+
+    '''
+
+    return int(math.ceil(float(num_jobs - first_task) / claim_batch))
+
+
+def _chunks(num_jobs, chunk_size=None, claim_batch=1):
+    '''
+    Split task IDs ``0`` to ``num_jobs - 1`` into ``(start, stop)`` ranges of
+    at most ``chunk_size`` tasks
+
+    Chunks are rounded up to a whole number of ``claim_batch`` blocks, so
+    that blocks are the same whether or not the job is chunked.
+
+    Examples
+    --------
+
+    .. code-block:: python
+
+        >>> _chunks(10)
+        [(0, 10)]
+
+        >>> _chunks(10, 4)
+        [(0, 4), (4, 8), (8, 10)]
+
+        >>> _chunks(10, 4, claim_batch=3)
+        [(0, 6), (6, 10)]
+
+    '''
+
+    if chunk_size is None or chunk_size >= num_jobs:
+        return [(0, num_jobs)]
+
+    chunk_size = int(math.ceil(float(chunk_size) / claim_batch)) * claim_batch
+
+    return [
+        (start, min(start + chunk_size, num_jobs))
+        for start in range(0, num_jobs, chunk_size)]
+
+
+def _chunk_counts(tasks, num_jobs, chunk_size, claim_batch=1):
+    '''
+    Count the tasks in each state in each chunk of a job, split as by
+    ``_chunks``
+
+    Parameters
+    ----------
+
+    tasks : dict
+        Sets of task IDs in each state, as returned by a state store's
+        ``scan``
+
+    Examples
+    --------
+
+    .. code-block:: python
+
+        >>> chunks = _chunk_counts(
+        ...     {'lck': {5}, 'done': {0, 1, 4}, 'err': {2}}, 6, 4)
+        ...
+        >>> [(c['start'], c['stop'], c['done'], c['errored']) for c in chunks]
+        [(0, 4, 2, 1), (4, 6, 1, 0)]
+
+        >>> chunks = _chunk_counts(
+        ...     {'lck': {5}, 'done': {0, 1, 4}, 'err': {2}}, 6, 4, 3)
+        ...
+        >>> [(c['start'], c['stop'], c['done'], c['errored']) for c in chunks]
+        [(0, 6, 3, 1)]
+
+    '''
+
+    chunks = [
+        {'start': start, 'stop': stop, 'done': 0, 'in_progress': 0,
+            'errored': 0}
+        for start, stop in _chunks(num_jobs, chunk_size, claim_batch)]
+
+    starts = [chunk['start'] for chunk in chunks]
+
+    for state, field in [
+            ('done', 'done'), ('lck', 'in_progress'), ('err', 'errored')]:
+        for task_id in tasks[state]:
+            if task_id < num_jobs:
+                chunks[bisect.bisect_right(starts, task_id) - 1][field] += 1
+
+    return chunks
+
+
+def _available_cores():
+    '''
+    Number of CPU cores this process is allowed to run on
+    '''
+
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return multiprocessing.cpu_count()
+
+
+def _format_block(start, stop):
+    '''
+    Examples
+    --------
+
+    .. code-block:: python
+
+        >>> _format_block(3, 4)
+        '3'
+
+        >>> _format_block(10, 20)
+        'tasks 10-19'
+
+    '''
+
+    if stop - start == 1:
+        return str(start)
+
+    return 'tasks {}-{}'.format(start, stop - 1)
+
+
+class _Position(object):
+    '''
+    A worker's position in its claim order, stored in a shared array
+    '''
+
+    def __init__(self, positions, index):
+        self._positions = positions
+        self._index = index
+
+    @property
+    def value(self):
+        return self._positions[self._index]
+
+    @value.setter
+    def value(self, value):
+        self._positions[self._index] = value
+
+
+def _fork_workers(target, workers, slots=1):
+    '''
+    Run ``target(worker_index, positions)`` in ``workers`` forked processes
+
+    Children share everything imported by the parent at the time of the fork,
+    so the user's module and its dependencies are only imported once per
+    node.
+
+    If ``target`` returns True, the worker is recycled: the child exits and
+    is replaced with a freshly forked process with the same worker index.
+    ``positions`` is a shared array of ``slots`` integers which workers can
+    use to record their progress, and which is handed on to the replacement.
+
+    Raises
+    ------
+    SystemExit
+        If any worker exits with an error
+    '''
+
+    context = multiprocessing.get_context('fork')
+
+    def run(worker_index, position):
+        if target(worker_index, position):
+            raise SystemExit(WORKER_RECYCLE)
+
+    def start(worker_index, position):
+        proc = context.Process(target=run, args=(worker_index, position))
+        proc.start()
+        return proc
+
+    procs = {}
+
+    for worker_index in range(workers):
+        position = context.Array('l', slots, lock=False)
+        procs[worker_index] = (start(worker_index, position), position)
+
+    failed = 0
+
+    while procs:
+        multiprocessing.connection.wait(
+            [proc.sentinel for proc, _ in procs.values()])
+
+        for worker_index, (proc, position) in list(procs.items()):
+            if proc.is_alive():
+                continue
+
+            proc.join()
+            del procs[worker_index]
+
+            if proc.exitcode == WORKER_RECYCLE:
+                procs[worker_index] = (start(worker_index, position), position)
+
+            elif proc.exitcode != 0:
+                failed += 1
+
+    if failed:
+        raise SystemExit(
+            '{} workers exited with an error'.format(failed))
+
+
+def _format_path(output, job):
+    '''
+    Fill in a task's output or input path
+
+    Examples
+    --------
+
+    .. code-block:: python
+
+        >>> _format_path('out/{model}/{year}.nc', {'model': 'a', 'year': 2000})
+        'out/a/2000.nc'
+
+        >>> _format_path(lambda job: job['model'] + '.csv', {'model': 'b'})
+        'b.csv'
+
+    '''
+
+    if callable(output):
+        return output(job)
+
+    return output.format(**job)
+
+
+def _list_directory(path):
+    try:
+        return set(iterdir(path))
+    except OSError:
+        return set()
+
+
+def _missing_outputs(job_spec, output, threads=16):
+    '''
+    IDs of the tasks in ``job_spec`` whose output does not exist yet
+
+    Each output directory is listed once, with ``threads`` directories listed
+    concurrently, rather than checking every task's output separately.
+
+    Returns
+    -------
+    task_ids : list of int
+    '''
+
+    paths = [
+        os.path.split(_format_path(output, job_spec.get_job(i)))
+        for i in range(count_jobs(job_spec))]
+
+    dirnames = sorted(set(dirname for dirname, _ in paths))
+
+    with concurrent.futures.ThreadPoolExecutor(threads) as executor:
+        listings = dict(zip(
+            dirnames,
+            executor.map(_list_directory, [d or '.' for d in dirnames])))
+
+    return [
+        task_id for task_id, (dirname, fname) in enumerate(paths)
+        if fname not in listings[dirname]]
+
+
+def _write_task_file(task_ids, jobname, lockdir='locks'):
+    '''
+    Save a list of task IDs for workers to run, returning the file's path
+
+    The file is named after a hash of its contents, so preparing the same
+    list twice reuses the same file.
+    '''
+
+    contents = ''.join('{}\n'.format(i) for i in task_ids)
+    digest = hashlib.sha1(contents.encode('utf-8')).hexdigest()[:12]
+
+    if not os.path.isdir(lockdir):
+        os.makedirs(lockdir)
+
+    path = os.path.join(lockdir, 'tasks-{}-{}.txt'.format(jobname, digest))
+
+    with open(path, 'w') as f:
+        f.write(contents)
+
+    return path.replace(os.sep, '/')
+
+
+def _read_task_file(path):
+    with open(path, 'r') as f:
+        return [int(line) for line in f if line.strip()]
+
+
+def _state_job_id(job_id, task_file=None):
+    '''
+    Job ID under which the state of a job's tasks is kept
+
+    Workers number the tasks in a task file by their position in the file,
+    so the state of runs of different task files is kept apart, under the
+    job ID and a hash of the file's contents. Resubmitting the same task file
+    with the same job ID resumes the run.
+
+    Examples
+    --------
+
+    .. code-block:: python
+
+        >>> import tempfile
+        >>> path = os.path.join(tempfile.mkdtemp(), 'tasks.txt')
+        >>> with open(path, 'w') as f:
+        ...     _ = f.write('5\\n8\\n')
+        ...
+        >>> _state_job_id('001', path)
+        '001.48f0c88ed1cb'
+
+        >>> _state_job_id('001')
+        '001'
+
+    '''
+
+    if task_file is None:
+        return job_id
+
+    with open(task_file, 'rb') as f:
+        digest = hashlib.sha1(f.read()).hexdigest()[:12]
+
+    return '{}.{}'.format(job_id, digest)
+
+
+def _known_job_id(job_id):
+    '''
+    Whether a job ID is known before the job is submitted (rather than
+    filled in from ``SLURM_ARRAY_JOB_ID``)
+    '''
+
+    return job_id is not None and '$' not in str(job_id)
+
+
+def _order_file(jobname, job_id, lockdir='locks'):
+    '''
+    Path of the file recording the task order chosen for a job ID, or None
+    if the job ID isn't known until the job is submitted
+    '''
+
+    if not _known_job_id(job_id):
+        return None
+
+    return os.path.join(
+        lockdir, 'order-{}-{}.txt'.format(jobname, str(job_id).strip('"')))
+
+
+def _record_task_file(jobname, job_id, task_file, lockdir='locks'):
+    '''
+    Record the task file run under a job ID, so that ``status`` and
+    ``cleanup`` can find the job's task state without ``--task_file``
+
+    Removes the record if ``task_file`` is None.
+    '''
+
+    path = os.path.join(
+        lockdir, 'taskfile-{}-{}.txt'.format(jobname, str(job_id).strip('"')))
+
+    if task_file is None:
+        if os.path.exists(path):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+        return
+
+    if _recorded_task_file(jobname, job_id, lockdir) == task_file:
+        return
+
+    if not os.path.isdir(lockdir):
+        os.makedirs(lockdir)
+
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+
+    with open(tmp, 'w') as f:
+        f.write(task_file)
+
+    os.rename(tmp, path)
+
+
+def _recorded_task_file(jobname, job_id, lockdir='locks'):
+    '''
+    The task file last run under a job ID, or None
+    '''
+
+    path = os.path.join(
+        lockdir, 'taskfile-{}-{}.txt'.format(jobname, str(job_id).strip('"')))
+
+    try:
+        with open(path, 'r') as f:
+            return f.read().strip() or None
+    except (IOError, OSError):
+        return None
+
+
+def _restore_cached(result_cache, key, output_path=None):
+    '''
+    Check for a cached result, restoring its output if it is missing or is
+    not the output stored with the result
+
+    Returns
+    -------
+    found : bool
+        True if the task does not need to be run again
+    '''
+
+    entry = result_cache.get(key)
+
+    if entry is None:
+        return False
+
+    if output_path is None:
+        return True
+
+    return result_cache.restore(key, output_path, entry)
+
+
+def _store_cached(result_cache, key, job, output_path=None):
+    try:
+        result_cache.put(key, {'job': job}, output_path)
+
+    except (OSError, IOError) as e:
+        logger.warning('Could not cache result {}: {}'.format(key, e))
+
+
+def _format_usage(summary):
+    '''
+    Examples
+    --------
+
+    .. code-block:: python
+
+        >>> print(_format_usage({
+        ...     'tasks': 2, 'attempts': 3, 'done': 1, 'errored': 1,
+        ...     'cached': 0, 'wall_total': 30, 'wall_mean': 15,
+        ...     'wall_max': 20, 'cpu_total': 15, 'cpu_efficiency': 0.5,
+        ...     'max_rss': 2**30, 'read_bytes': 2**20, 'write_bytes': 0,
+        ...     'slowest': [[1, 20], [0, 10]]}))
+        ...
+        tasks:         2 (3 attempts)
+        done:          1
+        errored:       1
+        cached:        0
+        wall time:     30.0s total, 15.0s mean, 20.0s max
+        cpu time:      15.0s (50% of wall time)
+        peak memory:   1024.0 MB
+        read:          1.0 MB
+        written:       0.0 MB
+        slowest tasks: 1 (20.0s), 0 (10.0s)
+
+    '''
+
+    mb = 1024.0 * 1024
+
+    if summary['cpu_efficiency'] is None:
+        efficiency = ''
+    else:
+        efficiency = ' ({:.0f}% of wall time)'.format(
+            100 * summary['cpu_efficiency'])
+
+    lines = [
+        ('tasks:', '{} ({} attempts)'.format(
+            summary['tasks'], summary['attempts'])),
+        ('done:', summary['done']),
+        ('errored:', summary['errored']),
+        ('cached:', summary['cached']),
+        ('wall time:', '{:.1f}s total, {:.1f}s mean, {:.1f}s max'.format(
+            summary['wall_total'], summary['wall_mean'],
+            summary['wall_max'])),
+        ('cpu time:', '{:.1f}s{}'.format(summary['cpu_total'], efficiency)),
+        ('peak memory:', '{:.1f} MB'.format(summary['max_rss'] / mb)),
+        ('read:', '{:.1f} MB'.format(summary['read_bytes'] / mb)),
+        ('written:', '{:.1f} MB'.format(summary['write_bytes'] / mb)),
+        ('slowest tasks:', ', '.join(
+            '{} ({:.1f}s)'.format(task_id, wall)
+            for task_id, wall in summary['slowest']))]
+
+    return '\n'.join('{:<15}{}'.format(*line) for line in lines)
+
+
+def _format_slurm_report(report):
+    '''
+    Examples
+    --------
+
+    .. code-block:: python
+
+        >>> print(_format_slurm_report({
+        ...     'elements': 3, 'states': {'COMPLETED': 2, 'TIMEOUT': 1},
+        ...     'node_hours': 30, 'tasks_per_hour': 120.5, 'idle_hours': 4,
+        ...     'max_rss': 2**30, 'memory_headroom': 0.25,
+        ...     'slowest': [['100_2', 12], ['100_0', 10]]}))
+        ...
+        elements:         3 (2 COMPLETED, 1 TIMEOUT)
+        node hours:       30.0
+        tasks per hour:   120.5
+        idle node hours:  4.0
+        peak memory:      1024.0 MB (25% headroom)
+        slowest elements: 100_2 (12.0h), 100_0 (10.0h)
+
+    '''
+
+    def optional(value, fmt):
+        return 'unknown' if value is None else fmt.format(value)
+
+    if report['memory_headroom'] is None:
+        headroom = ''
+    else:
+        headroom = ' ({:.0f}% headroom)'.format(
+            100 * report['memory_headroom'])
+
+    lines = [
+        ('elements:', '{} ({})'.format(
+            report['elements'], ', '.join(
+                '{} {}'.format(n, state)
+                for state, n in sorted(report['states'].items())))),
+        ('node hours:', '{:.1f}'.format(report['node_hours'])),
+        ('tasks per hour:', optional(report['tasks_per_hour'], '{:.1f}')),
+        ('idle node hours:', '{:.1f}'.format(report['idle_hours'])),
+        ('peak memory:', '{:.1f} MB{}'.format(
+            report['max_rss'] / (1024.0 * 1024), headroom)),
+        ('slowest elements:', ', '.join(
+            '{} ({:.1f}h)'.format(job_id, hours)
+            for job_id, hours in report['slowest']))]
+
+    return '\n'.join('{:<18}{}'.format(*line) for line in lines)
+
+
+def _to_flags(options):
+    '''
+    Convert ``(name, value)`` pairs into command line flags
+
+    Options set to None or False are omitted, and options set to True are
+    passed as bare flags.
+
+    Examples
+    --------
+
+    .. code-block:: python
+
+        >>> _to_flags([('workers', 4), ('max_tasks_per_worker', None)])
+        ['--workers', 4]
+
+        >>> _to_flags([('verbose', True), ('quiet', False)])
+        ['--verbose']
+
+    '''
+
+    flags = []
+
+    for name, value in options:
+        if value is None or value is False:
+            continue
+
+        flags.append('--{}'.format(name))
+
+        if value is not True:
+            flags.append(value)
+
+    return flags
+
+
+def _check_fraction(ctx, param, value):
+    '''
+    Click callback accepting numbers from 0 to 1 (``click.FloatRange`` needs
+    Click 7)
+    '''
+
+    if value is not None and not 0 <= value <= 1:
+        raise click.BadParameter('{} is not between 0 and 1'.format(value))
+
+    return value
+
+
+def _check_positive(ctx, param, value):
+    '''
+    Click callback accepting numbers greater than 0
+    '''
+
+    if value is not None and value <= 0:
+        raise click.BadParameter('{} is not greater than 0'.format(value))
+
+    return value
+
+
+def _worker_options(func):
+    '''
+    Add worker lifecycle options to a click command
+    '''
+
+    func = click.option(
+        '--log_mode', type=click.Choice(['task', 'worker']), default='task',
+        help=(
+            'Write a log file for each task, or one buffered log file for '
+            'each worker'))(func)
+
+    func = click.option(
+        '--speculate', type=float, default=None, callback=_check_positive,
+        help=(
+            'Once no tasks are left to claim, start a duplicate attempt at '
+            'tasks which have been running for this many seconds'))(func)
+
+    func = click.option(
+        '--threads', type=click.IntRange(min=1), default=1,
+        help='Number of threads running tasks in each worker')(func)
+
+    func = click.option(
+        '--max_worker_memory', type=float, default=None,
+        help='Replace a worker once its memory use exceeds this many MB')(func)
+
+    func = click.option(
+        '--max_tasks_per_worker', type=click.IntRange(min=1), default=None,
+        help='Replace a worker after it has run this many tasks')(func)
+
+    return func
+
+
+def _state_options(func):
+    '''
+    Add task state backend options to a click command
+    '''
+
+    func = click.option(
+        '--state_db', default=None,
+        help='Path to the task state database (sqlite backend only)')(func)
+
+    func = click.option(
+        '--backend', type=click.Choice(['file', 'sqlite']), default='file',
+        help='Task state backend')(func)
+
+    return func
+
+
+def _claim_options(func):
+    '''
+    Add task claiming options to a click command
+    '''
+
+    func = click.option(
+        '--lease', type=float, default=None, callback=_check_positive,
+        help=(
+            'Seconds after which claims of workers which stopped refreshing '
+            'them (e.g. on nodes which died) are taken over'))(func)
+
+    func = click.option(
+        '--claim_batch', type=click.IntRange(min=1), default=1,
+        help='Number of consecutive tasks to claim at once')(func)
+
+    return func
+
+
+def _task_options(func):
+    '''
+    Add task selection options to a click command
+    '''
+
+    func = click.option(
+        '--task_file', default=None,
+        help=(
+            'File listing the IDs of the tasks to run, one per line. Tasks '
+            'are numbered by their position in the file.'))(func)
+
+    return func
+
+
+def _cache_options(func):
+    '''
+    Add result cache options to a click command
+    '''
+
+    func = click.option(
+        '--no_cache', is_flag=True, default=False,
+        help='Run every task without reading or updating the result cache'
+        )(func)
+
+    return func
+
+
+def _profile_options(func):
+    '''
+    Add profiling options to a click command
+    '''
+
+    func = click.option(
+        '--profile_sample', type=float, default=None,
+        callback=_check_fraction,
+        help='Profile this fraction of tasks')(func)
+
+    func = click.option(
+        '--profile', is_flag=True, default=False,
+        help='Profile every task with cProfile')(func)
+
+    return func
+
+
+def _profile_rate(profile=False, profile_sample=None):
+    '''
+    Examples
+    --------
+
+    .. code-block:: python
+
+        >>> _profile_rate(), _profile_rate(True), _profile_rate(False, 0.1)
+        (None, 1.0, 0.1)
+
+    '''
+
+    if profile:
+        return 1.0
+
+    return profile_sample
+
+
+def _sampled(task_id, rate):
+    '''
+    Whether to profile a task, when sampling a fraction ``rate`` of tasks
+
+    Tasks are chosen by hashing their ID, so the same tasks are sampled every
+    time a job is run, and sampled tasks are spread evenly through the job.
+
+    Examples
+    --------
+
+    .. code-block:: python
+
+        >>> [i for i in range(40) if _sampled(i, 0.1)]
+        [0, 5, 13, 26, 34]
+
+        >>> sum(_sampled(i, 0.1) for i in range(10000)) // 100
+        10
+
+        >>> _sampled(5, None), _sampled(5, 1.0)
+        (False, True)
+
+    '''
+
+    if not rate:
+        return False
+
+    # multiplicative hashing with Knuth's constant
+    return ((task_id * 2654435761) % 2**32) < rate * 2**32
+
 
-# set up directories
-mkdir -p {logdir}
-mkdir -p locks
+def _profile_path(logdir, job_name, job_id, task_id):
+    return os.path.join(
+        logdir, 'profile-{}-{}-{}.prof'.format(job_name, job_id, task_id))
 
-## Run command
 
-for i in {{1..{jobs_per_node}}}
-do
-    nohup python {filepath} do_job --job_name {jobname} \
---job_id {uniqueid} --num_jobs {numjobs} --logdir "{logdir}" {flags} \
-> {logdir}/nohup-{jobname}-{uniqueid}-${{SLURM_ARRAY_TASK_ID}}-$i.out &
-done
+def merge_profiles(logdir, job_name, job_id, output):
+    '''
+    Merge the per-task cProfile stats of a job into a single stats file
 
-python {filepath} wait --job_name {jobname} \
---job_id {uniqueid} --num_jobs {numjobs} {flags}
-'''
+    Returns
+    -------
+    stats : pstats.Stats or None
+        The merged stats, or None if no tasks were profiled
+    '''
 
-SLURM_SINGLE_SCRIPT = SLURM_SCRIPT + '''
+    prefix = 'profile-{}-{}-'.format(job_name, job_id)
 
-## Run command
-python {filepath} {flags}
-'''
+    paths = sorted(
+        os.path.join(logdir, fname) for fname in iterdir(logdir)
+        if fname.startswith(prefix) and fname.endswith('.prof'))
 
+    if not paths:
+        return None
 
-def _normalize(name):
-    ''' normalize click commands with underscores to dashes for click>=7.0 compatability '''
-    return name.replace("_", "-")
+    stats = pstats.Stats(paths[0])
 
+    for path in paths[1:]:
+        stats.add(path)
 
-def _product(values):
+    stats.dump_stats(output)
+
+    return stats
+
+
+def _state_flags(backend='file', state_db=None, claim_batch=1, lease=None):
     '''
+    Command line flags passing state backend options on to workers
+
     Examples
     --------
 
     .. code-block:: python
 
-        >>> _product([3, 4, 5])
-        60
+        >>> _state_flags()
+        []
+
+        >>> _state_flags('sqlite', 'locks/tas.db')
+        ['--backend', 'sqlite', '--state_db', 'locks/tas.db']
+
+        >>> _state_flags(claim_batch=10)
+        ['--claim_batch', 10]
+
+        >>> _state_flags(lease=600)
+        ['--lease', 600]
 
     '''
-    return functools.reduce(lambda x, y: x*y, values, 1)
 
+    flags = []
 
-def _unpack_job(specs):
-    job = {}
-    for spec in specs:
-        job.update(spec)
-    return job
+    if claim_batch != 1:
+        flags += ['--claim_batch', claim_batch]
 
+    if backend != 'file':
+        flags += ['--backend', backend]
 
-def generate_jobs(job_spec):
-    for specs in itertools.product(*job_spec):
-        yield _unpack_job(specs)
+    if state_db is not None:
+        flags += ['--state_db', state_db]
 
+    if lease is not None:
+        flags += ['--lease', lease]
 
-def count_jobs(job_spec):
-    return _product(map(len, job_spec))
+    return flags
 
 
 def _prep_slurm(
@@ -122,10 +1195,16 @@ def _prep_slurm(
         maxnodes=100,
         dependencies=None,
         logdir='log',
-        flags=None):
+        flags=None,
+        job_flags=None,
+        release_idle=False,
+        first_task=0):
 
     depstr = ''
 
+    if first_task:
+        flags = ['--start', first_task] + list(flags or [])
+
     if (dependencies is not None) and (len(dependencies) > 1):
         status, deps = dependencies
 
@@ -140,6 +1219,11 @@ def _prep_slurm(
     else:
         flagstr = ''
 
+    if job_flags:
+        job_flagstr = ' '.join(map(str, job_flags))
+    else:
+        job_flagstr = ''
+
     if job_spec:
         n = count_jobs(job_spec)
 
@@ -148,11 +1232,19 @@ def _prep_slurm(
 
         numjobs = n
 
+        # don't request nodes which would have nothing to do
+        maxnodes = max(1, min(
+            maxnodes,
+            int(math.ceil(float(numjobs - first_task) / jobs_per_node))))
+
         output = (
                 '#\n#SBATCH --output {logdir}/slurm-{jobname}-%A_%a.out'
                 .format(jobname=jobname, logdir=logdir))
 
-        template = SLURM_MULTI_SCRIPT
+        if release_idle:
+            template = SLURM_RELEASE_SCRIPT
+        else:
+            template = SLURM_MULTI_SCRIPT
 
     else:
         numjobs = 1
@@ -169,10 +1261,12 @@ def _prep_slurm(
             numjobs=numjobs,
             jobs_per_node=jobs_per_node,
             maxnodes=(maxnodes-1),
+            numnodes=maxnodes,
             uniqueid=uniqueid,
             filepath=filepath.replace(os.sep, '/'),
             dependencies=depstr,
             flags=flagstr,
+            job_flags=job_flagstr,
             logdir=logdir,
             output=output))
 
@@ -188,7 +1282,10 @@ def run_slurm(
         maxnodes=100,
         dependencies=None,
         logdir='log',
-        flags=None):
+        flags=None,
+        job_flags=None,
+        release_idle=False,
+        first_task=0):
 
     _prep_slurm(
         filepath=filepath,
@@ -201,7 +1298,10 @@ def run_slurm(
         maxnodes=maxnodes,
         dependencies=dependencies,
         logdir=logdir,
-        flags=flags)
+        flags=flags,
+        job_flags=job_flags,
+        release_idle=release_idle,
+        first_task=first_task)
 
     job_command = ['sbatch', 'run-slurm.sh']
 
@@ -212,7 +1312,9 @@ def run_slurm(
 
     out, err = proc.communicate()
 
-    matcher = re.search(r'^\s*Submitted batch job (?P<run_id>[0-9]+)\s*$', out)
+    matcher = re.search(
+        r'^\s*Submitted batch job (?P<run_id>[0-9]+)\s*$',
+        out.decode('utf-8', 'replace'))
 
     if matcher:
         run_id = int(matcher.group('run_id'))
@@ -254,10 +1356,10 @@ def get_job_by_index(job_spec, index):
 
     '''
 
-    return _unpack_job([
-        job_spec[i][
-            (index//(_product(map(len, job_spec[i+1:]))) % len(job_spec[i]))]
-        for i in range(len(job_spec))])
+    if not isinstance(job_spec, JobSpec):
+        job_spec = JobSpec(job_spec)
+
+    return job_spec.get_job(index)
 
 
 def _get_call_args(job_spec, index=0):
@@ -305,7 +1407,14 @@ def slurm_runner(
         job_spec,
         filepath=None,
         onfinish=None,
-        return_index=False):
+        return_index=False,
+        filters=None,
+        exclude=None,
+        output=None,
+        cache=None,
+        inputs=None,
+        group_by=None,
+        cache_outputs=False):
     '''
     Decorator to create a SLURM runner job management command-line application
 
@@ -335,12 +1444,71 @@ def slurm_runner(
         Adds a ``task_id`` argument to run_job call with 0-indexed ID of
         current task
 
+    filters : list of functions, optional
+        Run only the tasks for which every filter returns True. Filters are
+        called with a dict of the task's keyword arguments.
+
+    exclude : list of dicts, optional
+        Skip any task whose keyword arguments match all of the items in one
+        of these dicts, e.g. ``[{'model': 'CCSM4', 'scenario': 'rcp45'}]``.
+
+        Tasks removed by ``filters`` and ``exclude`` are not counted or
+        submitted, and the remaining tasks are numbered consecutively. Task
+        IDs therefore change if the filters change.
+
+    output : str or function, optional
+        Path of the file written by each task, as a template formatted with
+        the task's keyword arguments (e.g.
+        ``'{scenario}/{model}/tas_{year}.nc'``), or a function of a dict of
+        the keyword arguments. If given, ``prep`` and ``run`` only submit
+        tasks whose output does not exist yet, unless called with
+        ``--overwrite``.
+
+    cache : str, optional
+        Directory in which to cache task results. A task is skipped if it has
+        already succeeded with the same keyword arguments, the same source
+        code for ``run_job``, and unchanged ``inputs``. If ``output`` is
+        given, the task is only skipped if its output is still the file it
+        wrote (same size and modification time). Default (None) does not
+        cache results.
+
+    inputs : list of str or functions, optional
+        Paths of files read by each task, given in the same way as
+        ``output``. Changing one of these files invalidates the cached
+        results of the tasks which read it.
+
+    group_by : list of str or function, optional
+        Keyword arguments (e.g. ``['model']``), or a function of a dict of
+        keyword arguments, identifying tasks which share inputs. Tasks are
+        renumbered so that each group is consecutive, and workers run
+        consecutive tasks from a group rather than spreading them over all
+        workers. See :py:func:`jrnr.memoize` for reusing inputs between
+        tasks.
+
+    cache_outputs : bool, optional
+        Keep a copy of each task's ``output`` in the ``cache``, and restore it
+        if the output is deleted or changed. Outputs whose modification time
+        changed but whose contents did not are still recognized. Default
+        (False) stores no outputs, and reruns tasks whose output changed.
+
     Returns
     -------
     slurm_runner : click.Group
         A SLURM runner job management command-line application
     '''
 
+    # keep the filters, order and groups of a spec which is already compiled
+    if not isinstance(job_spec, JobSpec):
+        job_spec = JobSpec(job_spec)
+
+    if filters or exclude:
+        job_spec = job_spec.filter(filters=filters, exclude=exclude)
+
+    if group_by is not None:
+        job_spec = job_spec.group(group_by)
+
+    code = fingerprint(run_job) if cache is not None else None
+
     if filepath is None:
         filepath = os.path.abspath(inspect.getfile(run_job))
     else:
@@ -374,6 +1542,25 @@ def slurm_runner(
     @click.option(
         '--uniqueid', '-u', default='"${SLURM_ARRAY_JOB_ID}"',
         help='Unique job pool id')
+    @click.option(
+        '--overwrite', is_flag=True, default=False,
+        help='Run tasks whose output already exists')
+    @click.option(
+        '--order', type=click.Choice(['index', 'longest']), default='index',
+        help=(
+            'Order in which to run tasks. "longest" runs the tasks which took '
+            'longest in earlier runs first'))
+    @click.option(
+        '--release_idle', is_flag=True, default=False,
+        help=(
+            'End each array element once its node has no tasks left to '
+            'claim, rather than waiting for every task to finish'))
+    @_task_options
+    @_state_options
+    @_claim_options
+    @_worker_options
+    @_cache_options
+    @_profile_options
     def prep(
             limit=None,
             jobs_per_node=24,
@@ -382,19 +1569,53 @@ def slurm_runner(
             partition='savio2',
             maxnodes=100,
             logdir='log',
-            uniqueid='"${SLURM_ARRAY_JOB_ID}"'):
+            uniqueid='"${SLURM_ARRAY_JOB_ID}"',
+            backend='file',
+            state_db=None,
+            claim_batch=1,
+            lease=None,
+            max_tasks_per_worker=None,
+            max_worker_memory=None,
+            threads=1,
+            speculate=None,
+            log_mode='task',
+            task_file=None,
+            overwrite=False,
+            order='index',
+            release_idle=False,
+            no_cache=False,
+            profile=False,
+            profile_sample=None):
+
+        spec, task_file = _prepare_tasks(
+            jobname, task_file, overwrite, order, logdir, uniqueid)
+
+        if not count_jobs(spec):
+            return
 
         _prep_slurm(
             filepath=filepath,
             jobname=jobname,
             partition=partition,
-            job_spec=job_spec,
+            job_spec=spec,
             jobs_per_node=jobs_per_node,
             maxnodes=maxnodes,
             limit=limit,
             uniqueid=uniqueid,
             logdir=logdir,
-            dependencies=('afterany', list(dependency)))
+            dependencies=('afterany', list(dependency)),
+            release_idle=release_idle,
+            flags=(
+                _state_flags(backend, state_db, claim_batch, lease) +
+                _to_flags([('task_file', task_file)])),
+            job_flags=_to_flags([
+                ('max_tasks_per_worker', max_tasks_per_worker),
+                ('max_worker_memory', max_worker_memory),
+                ('threads', threads if threads > 1 else None),
+                ('speculate', speculate),
+                ('log_mode', log_mode if log_mode != 'task' else None),
+                ('no_cache', no_cache),
+                ('profile_sample', _profile_rate(profile, profile_sample))]))
 
     @slurm.command()
     @click.option(
@@ -417,6 +1638,36 @@ def slurm_runner(
     @click.option(
         '--uniqueid', '-u', default='"${SLURM_ARRAY_JOB_ID}"',
         help='Unique job pool id')
+    @click.option(
+        '--overwrite', is_flag=True, default=False,
+        help='Run tasks whose output already exists')
+    @click.option(
+        '--order', type=click.Choice(['index', 'longest']), default='index',
+        help=(
+            'Order in which to run tasks. "longest" runs the tasks which took '
+            'longest in earlier runs first'))
+    @click.option(
+        '--release_idle', is_flag=True, default=False,
+        help=(
+            'End each array element once its node has no tasks left to '
+            'claim, rather than waiting for every task to finish'))
+    @click.option(
+        '--chunk_size', type=click.IntRange(min=1), default=None,
+        help=(
+            'Submit the job as several job arrays of at most this many tasks '
+            'each'))
+    @click.option(
+        '--chunk_policy', type=click.Choice(['chained', 'concurrent']),
+        default='chained',
+        help=(
+            'Start each chunk once the previous one has finished (chained), '
+            'or submit every chunk at once (concurrent)'))
+    @_task_options
+    @_state_options
+    @_claim_options
+    @_worker_options
+    @_cache_options
+    @_profile_options
     def run(
             limit=None,
             jobs_per_node=24,
@@ -425,110 +1676,891 @@ def slurm_runner(
             partition='savio2',
             maxnodes=100,
             logdir='log',
-            uniqueid='"${SLURM_ARRAY_JOB_ID}"'):
+            uniqueid='"${SLURM_ARRAY_JOB_ID}"',
+            backend='file',
+            state_db=None,
+            claim_batch=1,
+            lease=None,
+            max_tasks_per_worker=None,
+            max_worker_memory=None,
+            threads=1,
+            speculate=None,
+            log_mode='task',
+            task_file=None,
+            overwrite=False,
+            order='index',
+            release_idle=False,
+            chunk_size=None,
+            chunk_policy='chained',
+            no_cache=False,
+            profile=False,
+            profile_sample=None):
+
+        spec, task_file = _prepare_tasks(
+            jobname, task_file, overwrite, order, logdir, uniqueid)
+
+        if not count_jobs(spec):
+            return
 
         if not os.path.isdir(logdir):
             os.makedirs(logdir)
 
-        slurm_id = run_slurm(
-            filepath=filepath,
-            jobname=jobname,
-            partition=partition,
-            job_spec=job_spec,
-            jobs_per_node=jobs_per_node,
-            maxnodes=maxnodes,
-            limit=limit,
-            uniqueid=uniqueid,
-            logdir=logdir,
-            dependencies=('afterany', list(dependency)))
+        numjobs = count_jobs(spec)
+
+        if limit is not None:
+            numjobs = min(limit, numjobs)
+
+        job_id = uniqueid
+        slurm_ids = []
+
+        for start, stop in _chunks(numjobs, chunk_size, claim_batch):
+            if chunk_policy == 'chained' and slurm_ids:
+                dependencies = [slurm_ids[-1]]
+            else:
+                dependencies = list(dependency)
+
+            slurm_ids.append(run_slurm(
+                filepath=filepath,
+                jobname=jobname,
+                partition=partition,
+                job_spec=spec,
+                jobs_per_node=jobs_per_node,
+                maxnodes=maxnodes,
+                limit=stop,
+                uniqueid=job_id,
+                logdir=logdir,
+                dependencies=('afterany', dependencies),
+                release_idle=release_idle,
+                first_task=start,
+                flags=(
+                    _state_flags(backend, state_db, claim_batch, lease) +
+                    _to_flags([('task_file', task_file)])),
+                job_flags=_to_flags([
+                    ('max_tasks_per_worker', max_tasks_per_worker),
+                    ('max_worker_memory', max_worker_memory),
+                    ('threads', threads if threads > 1 else None),
+                    ('speculate', speculate),
+                    ('log_mode', log_mode if log_mode != 'task' else None),
+                    ('no_cache', no_cache),
+                    ('profile_sample', _profile_rate(
+                        profile, profile_sample))])))
+
+            # Later chunks, and the cleanup job, have their own
+            # SLURM_ARRAY_JOB_ID, so fill in the first chunk's. Every chunk
+            # then shares the same task state.
+            job_id = str(job_id).replace(
+                '${SLURM_ARRAY_JOB_ID}', str(slurm_ids[0]))
+
+            if chunk_size is not None:
+                print('chunk job: {} (tasks {} to {})'.format(
+                    slurm_ids[-1], start, stop - 1))
 
         finish_id = run_slurm(
             filepath=filepath,
             jobname=jobname+'_finish',
             partition=partition,
-            dependencies=('afterany', [slurm_id]),
+            dependencies=('afterany', slurm_ids),
             logdir=logdir,
-            flags=['cleanup', slurm_id])
+            flags=(
+                ['cleanup'] + slurm_ids +
+                _to_flags([
+                    ('job_name', jobname),
+                    ('job_id', job_id),
+                    ('num_jobs', numjobs),
+                    ('task_file', task_file)]) +
+                _state_flags(backend, state_db)))
 
-        print('run job: {}\non-finish job: {}'.format(slurm_id, finish_id))
+        print('run job: {}\non-finish job: {}'.format(
+            slurm_ids[0], finish_id))
 
-    @slurm.command()
-    @click.argument('slurm_id')
-    def cleanup(slurm_id):
-        proc = subprocess.Popen(
-            [
-                'sacct', '-j', slurm_id,
-                '--format=JobID,JobName,MaxRSS,Elapsed,State'],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE)
+    def _cache_lookup(spec, task_id, metadata):
+        '''
+        Cache key and output path (if any) of a task
+
+        Paths are filled in from the task's arguments, and the key from its
+        stringified ``metadata``.
+        '''
+
+        job = get_job_by_index(spec, task_id)
+
+        inputs_paths = [_format_path(path, job) for path in (inputs or [])]
+
+        if output is None:
+            output_path = None
+        else:
+            output_path = _format_path(output, job)
+
+        return cache_key(metadata, code, inputs_paths), output_path
+
+    def _select_tasks(task_file=None):
+        '''
+        The job spec, restricted to the tasks listed in ``task_file`` if given
+        '''
+
+        if task_file is None:
+            return job_spec
+
+        return job_spec.take(_read_task_file(task_file))
+
+    def _prepare_tasks(
+            jobname, task_file=None, overwrite=False, order='index',
+            logdir='log', job_id=None):
+        '''
+        Choose the tasks to submit, and the order in which to run them
+
+        Unless ``overwrite`` is set or a ``task_file`` is given, tasks whose
+        ``output`` already exists are left out. With ``order='longest'``,
+        tasks are sorted by their expected duration, estimated from the usage
+        records of earlier runs of ``jobname`` in ``logdir``. The chosen task
+        IDs are written to a new task file.
+
+        The order chosen for a ``job_id`` is saved and reused by later runs
+        with the same ID, so that resubmitting an interrupted job gives its
+        tasks the same positions (and so the same state) as before.
+
+        Returns
+        -------
+        spec : JobSpec
+        task_file : str or None
+            Task file to pass on to workers
+        '''
+
+        if task_file is not None:
+            task_ids = _read_task_file(task_file)
+
+        elif output is None or overwrite:
+            task_ids = None
+
+        else:
+            n = count_jobs(job_spec)
+            task_ids = _missing_outputs(job_spec, output)
+
+            print('{} of {} outputs already exist'.format(
+                n - len(task_ids), n))
+
+            if len(task_ids) == n:
+                task_ids = None
+
+        if order == 'longest':
+            order_file = _order_file(jobname, job_id)
+
+            if order_file is not None and os.path.exists(order_file):
+                durations = None
+                rank = dict(
+                    (task_id, i) for i, task_id in
+                    enumerate(_read_task_file(order_file)))
+
+            else:
+                durations = task_durations(
+                    read_usage(logdir, jobname), jobname)
+
+            if task_ids is None:
+                all_tasks = range(count_jobs(job_spec))
+            else:
+                all_tasks = task_ids
 
-        out, err = proc.communicate()
+            if durations is None:
+                task_ids = sorted(
+                    all_tasks,
+                    key=lambda task_id: rank.get(task_id, len(rank)))
+                task_file = None
 
-        print(out)
+                print('reusing the task order of job {}'.format(job_id))
+
+            elif durations:
+                task_ids = longest_first(job_spec, all_tasks, durations)
+                task_file = None
+
+                if order_file is not None:
+                    with open(order_file, 'w') as f:
+                        f.write(''.join('{}\n'.format(i) for i in task_ids))
+
+                print(
+                    'ordered tasks longest first using the durations of {} '
+                    'earlier tasks'.format(len(durations)))
+
+            else:
+                print(
+                    'no earlier runs of {} found in {}. tasks will run in '
+                    'order'.format(jobname, logdir))
+
+        if task_ids is None:
+            return job_spec, None
+
+        if task_file is None and task_ids:
+            task_file = _write_task_file(task_ids, jobname)
+
+            print('task IDs written to {}'.format(task_file))
+
+        if task_file is not None and _known_job_id(job_id):
+            _record_task_file(jobname, job_id, task_file)
+
+        return job_spec.take(task_ids), task_file
+
+    @slurm.command()
+    @click.argument('slurm_ids', nargs=-1, required=True)
+    @click.option(
+        '--job_name', '-j', default=None,
+        help='Check that every task of this job finished')
+    @click.option('--job_id', '-u', default=None)
+    @click.option('--num_jobs', type=int, default=None)
+    @_task_options
+    @_state_options
+    def cleanup(
+            slurm_ids,
+            job_name=None,
+            job_id=None,
+            num_jobs=None,
+            backend='file',
+            state_db=None,
+            task_file=None):
+        '''
+        Report on a finished run (one or more job arrays), and call
+        ``onfinish`` if all of its tasks finished
+
+        If ``job_name`` is given and any of its tasks were never run or are
+        still claimed (e.g. by a worker which was killed), ``onfinish`` is not
+        called and the command exits with an error.
+        '''
+
+        try:
+            print(_format_slurm_report(slurm_report(run_sacct(slurm_ids))))
+        except OSError as e:
+            print(e)
+
+        if job_name is not None:
+            if task_file is None:
+                task_file = _recorded_task_file(job_name, job_id)
+
+            if num_jobs is None:
+                num_jobs = count_jobs(_select_tasks(task_file))
+
+            store = get_state_store(
+                job_name, _state_job_id(job_id, task_file), backend, state_db)
+            store.setup()
+
+            counts = store.counts(num_jobs)
+            unfinished = num_jobs - counts['done'] - counts['err']
+
+            print('tasks: {} done, {} errored, {} unfinished'.format(
+                counts['done'], counts['err'], unfinished))
+
+            if unfinished:
+                raise SystemExit(
+                    '{} tasks did not finish. skipping onfinish'.format(
+                        unfinished))
 
         if onfinish:
             onfinish()
 
+    @slurm.command()
+    @click.option(
+        '--max_size', type=float, default=None,
+        help='Shrink the cache to at most this many MB')
+    @click.option(
+        '--max_age', type=float, default=None,
+        help='Remove results not used in this many days')
+    def cache_clean(max_size=None, max_age=None):
+        '''
+        Evict old results from the result cache
+        '''
+
+        if cache is None:
+            raise click.UsageError('This job does not have a result cache')
+
+        removed = ResultCache(cache).evict(
+            max_size=None if max_size is None else max_size * 1024 * 1024,
+            max_age=None if max_age is None else max_age * 24 * 3600)
+
+        print('removed {} cached results'.format(removed))
+
     @slurm.command()
     @click.option('--job_name', required=True)
     @click.option('--job_id', required=True)
     @click.option('--num_jobs', required=True, type=int)
+    @click.option(
+        '--start', type=int, default=0, help='First task ID to run')
     @click.option(
         '--logdir', '-L', default='log', help='Directory to write log files')
-    def do_job(job_name, job_id, num_jobs=None, logdir='log'):
+    @click.option(
+        '--node_index', type=int, default=0,
+        help='Index of this node in the job array (SLURM_ARRAY_TASK_ID)')
+    @click.option(
+        '--num_nodes', type=int, default=1,
+        help='Number of nodes in the job array')
+    @click.option(
+        '--worker_index', type=int, default=0,
+        help='Index of this worker on the node')
+    @click.option(
+        '--workers_per_node', type=int, default=1,
+        help='Number of workers running on each node')
+    @click.option(
+        '--workers', type=click.IntRange(min=1), default=1,
+        help=(
+            'Number of worker processes to fork from this process. Implies '
+            '--workers_per_node'))
+    @_task_options
+    @_state_options
+    @_claim_options
+    @_worker_options
+    @_cache_options
+    @_profile_options
+    def do_job(
+            job_name,
+            job_id,
+            num_jobs=None,
+            start=0,
+            logdir='log',
+            node_index=0,
+            num_nodes=1,
+            worker_index=0,
+            workers_per_node=1,
+            workers=1,
+            backend='file',
+            state_db=None,
+            claim_batch=1,
+            lease=None,
+            max_tasks_per_worker=None,
+            max_worker_memory=None,
+            threads=1,
+            speculate=None,
+            log_mode='task',
+            task_file=None,
+            no_cache=False,
+            profile=False,
+            profile_sample=None):
+
+        _do_job(
+            job_name,
+            job_id,
+            num_jobs,
+            first_task=start,
+            task_file=task_file,
+            logdir=logdir,
+            node_index=node_index,
+            num_nodes=num_nodes,
+            worker_index=worker_index,
+            workers_per_node=workers_per_node,
+            workers=workers,
+            backend=backend,
+            state_db=state_db,
+            claim_batch=claim_batch,
+            lease=lease,
+            max_tasks_per_worker=max_tasks_per_worker,
+            max_worker_memory=max_worker_memory,
+            threads=threads,
+            speculate=speculate,
+            log_mode=log_mode,
+            no_cache=no_cache,
+            profile_sample=_profile_rate(profile, profile_sample))
 
-        if not os.path.isdir('locks'):
-            os.makedirs('locks')
+    @slurm.command()
+    @click.option('--job_name', '-j', required=True)
+    @click.option('--job_id', '-u', required=True)
+    @click.option(
+        '--start', type=int, default=0, help='First task ID to run')
+    @click.option(
+        '--stop', type=int, default=None,
+        help='Run tasks up to (but not including) this task ID')
+    @click.option(
+        '--logdir', '-L', default='log', help='Directory to write log files')
+    @click.option(
+        '--workers', type=click.IntRange(min=1), default=None,
+        help='Number of worker processes (default: one per available core)')
+    @_task_options
+    @_state_options
+    @_claim_options
+    @_worker_options
+    @_cache_options
+    @_profile_options
+    def local(
+            job_name,
+            job_id,
+            start=0,
+            stop=None,
+            logdir='log',
+            workers=None,
+            backend='file',
+            state_db=None,
+            claim_batch=1,
+            lease=None,
+            max_tasks_per_worker=None,
+            max_worker_memory=None,
+            threads=1,
+            speculate=None,
+            log_mode='task',
+            task_file=None,
+            no_cache=False,
+            profile=False,
+            profile_sample=None):
+        '''
+        Run the job (or a range of its tasks) on this machine
+        '''
+
+        n = count_jobs(_select_tasks(task_file))
+
+        if stop is None or stop > n:
+            stop = n
+
+        if workers is None:
+            workers = _available_cores()
+
+        _do_job(
+            job_name,
+            job_id,
+            stop,
+            first_task=start,
+            task_file=task_file,
+            logdir=logdir,
+            workers=workers,
+            backend=backend,
+            state_db=state_db,
+            claim_batch=claim_batch,
+            lease=lease,
+            max_tasks_per_worker=max_tasks_per_worker,
+            max_worker_memory=max_worker_memory,
+            threads=threads,
+            speculate=speculate,
+            log_mode=log_mode,
+            no_cache=no_cache,
+            profile_sample=_profile_rate(profile, profile_sample))
+
+    def _do_job(
+            job_name,
+            job_id,
+            num_jobs,
+            first_task=0,
+            logdir='log',
+            node_index=0,
+            num_nodes=1,
+            worker_index=0,
+            workers_per_node=1,
+            workers=1,
+            backend='file',
+            state_db=None,
+            claim_batch=1,
+            lease=None,
+            max_tasks_per_worker=None,
+            max_worker_memory=None,
+            threads=1,
+            speculate=None,
+            log_mode='task',
+            task_file=None,
+            no_cache=False,
+            profile_sample=None):
+        '''
+        Run tasks ``first_task`` through ``num_jobs - 1`` with one or more
+        workers
+        '''
+
+        # build any task index and groups once, before forking workers
+        spec = _select_tasks(task_file)
+        count_jobs(spec)
+        getattr(spec, 'groups', None)
+
+        store = get_state_store(
+            job_name, _state_job_id(job_id, task_file), backend, state_db,
+            lease)
+        store.setup()
+
+        if worker_index == 0 and node_index == 0:
+            _record_task_file(job_name, job_id, task_file)
+
+        if cache is None or no_cache:
+            result_cache = None
+        else:
+            result_cache = ResultCache(cache, store_outputs=cache_outputs)
 
         if not os.path.isdir(logdir):
             os.makedirs(logdir)
 
-        for task_id in range(num_jobs):
+        usage_log = UsageLog(logdir, job_name, job_id)
+
+        if log_mode == 'worker':
+            worker_log = WorkerLog(logdir, job_name, job_id, formatter)
+        else:
+            worker_log = None
+
+        if workers > 1:
+            workers_per_node = workers
+
+        def work(worker_index, positions=None):
+
+            def work_thread(thread_index):
+                if positions is None:
+                    position = None
+                else:
+                    position = _Position(positions, thread_index)
+
+                rank = node_index * workers_per_node + worker_index
+
+                return _work(
+                    store, spec, job_name, job_id, num_jobs, logdir,
+                    first_task=first_task,
+                    worker_rank=(rank * threads + thread_index),
+                    num_workers=(num_nodes * workers_per_node * threads),
+                    claim_batch=claim_batch,
+                    max_tasks=max_tasks_per_worker,
+                    max_memory=max_worker_memory,
+                    position=position,
+                    result_cache=result_cache,
+                    usage_log=usage_log,
+                    profile_sample=profile_sample,
+                    speculate=speculate,
+                    worker_log=worker_log)
+
+            if threads == 1:
+                return work_thread(0)
+
+            with concurrent.futures.ThreadPoolExecutor(threads) as executor:
+                return any(list(executor.map(work_thread, range(threads))))
+
+        if workers > 1 or max_tasks_per_worker or max_worker_memory:
+            _fork_workers(
+                lambda i, positions: work(worker_index + i, positions),
+                workers,
+                slots=threads)
+
+        else:
+            work(worker_index)
+
+    def _work(
+            store,
+            spec,
+            job_name,
+            job_id,
+            num_jobs,
+            logdir,
+            first_task=0,
+            worker_rank=0,
+            num_workers=1,
+            claim_batch=1,
+            max_tasks=None,
+            max_memory=None,
+            position=None,
+            result_cache=None,
+            usage_log=None,
+            profile_sample=None,
+            speculate=None,
+            worker_log=None):
+        '''
+        Claim and run blocks of tasks from ``first_task`` up to ``num_jobs``
+        until none are left to claim
+
+        Stops early once the worker has run ``max_tasks`` tasks or its memory
+        use exceeds ``max_memory`` MB. If given, ``position.value`` is the
+        number of blocks in this worker's claim order which have already been
+        visited, and is updated as the worker progresses.
+
+        If ``speculate`` is given, the worker then waits for blocks which
+        were in progress to finish, starting a duplicate attempt at any which
+        have been running for ``speculate`` seconds and which no other worker
+        has duplicated yet.
+
+        Returns
+        -------
+        recycle : bool
+            True if the worker stopped early and should be replaced
+        '''
+
+        num_blocks = _count_blocks(num_jobs, claim_batch, first_task)
+        groups = getattr(spec, 'groups', None)
+
+        def claim_order(own):
+            if groups is None:
+                block_ids = _iter_tasks(
+                    num_blocks, worker_rank, num_workers, own)
+            else:
+                block_ids = _iter_group_blocks(
+                    groups, num_blocks, worker_rank, num_workers, claim_batch,
+                    first_task, own)
+
+            return _iter_blocks(block_ids, num_jobs, claim_batch, first_task)
 
-            lock_file = (
-                'locks/{}-{}-{}.{{}}'
-                .format(job_name, job_id, task_id))
+        blocks = itertools.chain(
+            ((block, True) for block in claim_order(True)),
+            ((block, False) for block in claim_order(False)))
 
-            if os.path.exists(lock_file.format('done')):
-                print('{} already done. skipping'.format(task_id))
-                continue
+        if position is not None:
+            blocks = itertools.islice(blocks, position.value, None)
 
-            elif os.path.exists(lock_file.format('err')):
-                print('{} previously errored. skipping'.format(task_id))
-                continue
+        tasks_run = [0]
+
+        def stop_early():
+            if max_tasks is not None and tasks_run[0] >= max_tasks:
+                return True
+
+            return max_memory is not None and (
+                (get_rss() or 0) > max_memory * 1024 * 1024)
+
+        def attempt_block(start, stop, duplicate=False):
+            '''
+            Run the pending tasks of a block, committing the block and its
+            staged outputs if this is the first attempt to complete it
+            '''
+
+            with attempt() as current:
+                succeeded = [
+                    _run_task(
+                        task_id, spec, job_name, job_id, logdir, store,
+                        result_cache, usage_log, profile_sample, duplicate,
+                        worker_log)
+                    for task_id in store.pending(start, stop)]
+
+                tasks_run[0] += len(succeeded)
+
+                # a block is complete once every task has been attempted,
+                # while a single task is only complete if it succeeded.
+                # Duplicate attempts don't record errors, so they only
+                # complete blocks in which every task succeeded.
+                if all(succeeded) or (stop - start > 1 and not duplicate):
+                    if store.complete(start, stop):
+                        current.commit()
+                        return True
+
+            return False
+
+        def run_block(start, stop):
+            '''
+            Claim and run a block, returning the state which prevented the
+            claim, if any
+            '''
+
+            state = store.claim(start, stop)
+
+            if state is not None:
+                return state
 
             try:
-                with exclusive_open(lock_file.format('lck')):
-                    pass
-
-                # Check for race conditions
-                if os.path.exists(lock_file.format('done')):
-                    print('{} already done. skipping'.format(task_id))
-                    if os.path.exists(lock_file.format('lck')):
-                        os.remove(lock_file.format('lck'))
-                    continue
+                attempt_block(start, stop)
+
+            except (KeyboardInterrupt, SystemExit):
+                logger.error(
+                    '{} interupted, removing .lck file before exiting'
+                    .format(_format_block(start, stop)))
+                raise
+
+            finally:
+                store.release(start, stop)
+
+        def run_duplicate(running):
+            '''
+            Start a duplicate attempt at the longest running block which has
+            been running for at least ``speculate`` seconds
+
+            Returns
+            -------
+            duplicated : list
+                Blocks which are already being attempted by another worker
+            '''
+
+            duplicated = []
+
+            for start, stop, claimed in sorted(running, key=lambda r: r[2]):
+                elapsed = time.time() - claimed
 
-                elif os.path.exists(lock_file.format('err')):
-                    print('{} previously errored. skipping'.format(task_id))
-                    if os.path.exists(lock_file.format('lck')):
-                        os.remove(lock_file.format('lck'))
+                if elapsed < speculate:
+                    break
+
+                if not store.duplicate(start, stop):
+                    duplicated.append((start, stop))
                     continue
 
-            except OSError:
-                print('{} already in progress. skipping'.format(task_id))
+                print('{} running for {:.0f}s. starting a duplicate attempt'
+                      .format(_format_block(start, stop), elapsed))
+
+                if attempt_block(start, stop, duplicate=True):
+                    print('{} committed by duplicate attempt'.format(
+                        _format_block(start, stop)))
+                else:
+                    print('{} finished first by original attempt'.format(
+                        _format_block(start, stop)))
+
+                break
+
+            return duplicated
+
+        locked = []
+        scanned = None
+
+        for (start, stop), own in blocks:
+
+            if stop_early():
+                return True
+
+            if position is not None:
+                position.value += 1
+
+            if not own:
+                # Most blocks in other workers' slices have been claimed by
+                # the time this worker gets to them, so read the state of
+                # every task once rather than probing each block in turn
+                if scanned is None:
+                    scanned = store.scan(num_jobs)
+
+                state = _scanned_state(scanned, start, stop)
+
+                if state is None:
+                    state = run_block(start, stop)
+
+                if state == 'lck':
+                    locked.append((start, stop))
+
+                continue
+
+            state = run_block(start, stop)
+
+            if state == 'done':
+                print('{} already done. skipping'.format(
+                    _format_block(start, stop)))
+
+            elif state == 'err':
+                print('{} previously errored. skipping'.format(
+                    _format_block(start, stop)))
+
+            elif state == 'lck':
+                print('{} already in progress. skipping'.format(
+                    _format_block(start, stop)))
+
+                locked.append((start, stop))
+
+        if store.lease is None and speculate is None:
+            return
+
+        interval = min(
+            t for t in (store.lease, speculate) if t is not None) / 2.
+
+        # Keep checking on blocks which were in progress until they are
+        # finished. Blocks held by workers which died are taken over once
+        # their lease expires, and blocks which have been running for longer
+        # than ``speculate`` seconds are attempted again.
+        while locked:
+            time.sleep(interval)
+
+            if store.lease is not None:
+                still_locked = []
+
+                for start, stop in locked:
+                    if stop_early():
+                        return True
+
+                    if run_block(start, stop) == 'lck':
+                        still_locked.append((start, stop))
+
+                locked = still_locked
+
+            if speculate is None:
                 continue
 
-            handler = logging.FileHandler(os.path.join(
+            if stop_early():
+                return True
+
+            running = store.running(locked)
+            locked = [(start, stop) for start, stop, _ in running]
+
+            duplicated = run_duplicate(running)
+
+            # without a lease, nothing more can be done about blocks which
+            # another worker is already attempting again
+            if store.lease is None:
+                locked = [block for block in locked if block not in duplicated]
+
+    def _run_task(
+            task_id,
+            spec,
+            job_name,
+            job_id,
+            logdir,
+            store,
+            result_cache=None,
+            usage_log=None,
+            profile_sample=None,
+            duplicate=False,
+            worker_log=None):
+        '''
+        Run a single claimed task, recording an error in ``store`` on failure
+
+        If a ``result_cache`` is given, the task is skipped if it has already
+        been run with the same arguments, code and inputs, and is added to the
+        cache if it succeeds. If a ``usage_log`` is given, the resources used
+        by the task are appended to it. A fraction ``profile_sample`` of tasks
+        are run under cProfile, with stats saved to ``logdir``.
+
+        Tasks log to their own file, or to ``worker_log`` if given.
+        Duplicate attempts at tasks claimed by another worker log separately,
+        are never profiled, and don't record errors.
+
+        Returns
+        -------
+        succeeded : bool
+        '''
+
+        with TaskUsage() as usage:
+            status = _attempt_task(
+                task_id, spec, job_name, job_id, logdir, store, result_cache,
+                _sampled(task_id, profile_sample) and not duplicate,
+                duplicate, worker_log)
+
+        if usage_log is not None:
+            record = dict(
+                usage.record,
+                job_name=job_name,
+                job_id=job_id,
+                task_id=task_id,
+                kwargs=_get_call_args(spec, task_id)['metadata'],
+                status=status)
+
+            if duplicate:
+                record['duplicate'] = True
+
+            usage_log.write(record)
+
+        return status != 'err'
+
+    def _attempt_task(
+            task_id,
+            spec,
+            job_name,
+            job_id,
+            logdir,
+            store,
+            result_cache=None,
+            profile=False,
+            duplicate=False,
+            worker_log=None):
+        '''
+        Outputs staged by the task and its cache entry are kept by the
+        current attempt until it is committed, and are discarded if the task
+        fails.
+
+        Returns
+        -------
+        status : str
+            ``'done'``, ``'cached'`` or ``'err'``
+        '''
+
+        if task_logs not in logger.handlers:
+            logger.addHandler(task_logs)
+
+        suffix = '-dup' if duplicate else ''
+
+        if worker_log is None:
+            task_log = task_logs.task(os.path.join(
                 logdir,
-                'run-{}-{}-{}.log'.format(job_name, job_id, task_id)))
-            handler.setFormatter(formatter)
-            handler.setLevel(logging.DEBUG)
+                'run-{}-{}-{}{}.log'.format(
+                    job_name, job_id, task_id, suffix)))
+        else:
+            task_log = task_logs.route(
+                worker_log.handler('{}{}'.format(task_id, suffix)))
 
-            logger.addHandler(handler)
+        current = current_attempt()
+        mark = current.mark()
+
+        with task_log:
 
             try:
 
-                job_kwargs = _get_call_args(job_spec, task_id)
+                job_kwargs = _get_call_args(spec, task_id)
 
                 if return_index:
                     job_kwargs.update({'task_id': task_id})
@@ -536,16 +2568,31 @@ def slurm_runner(
                 logger.debug('Beginning job\nkwargs:\t{}'.format(
                     pprint.pformat(job_kwargs['metadata'], indent=2)))
 
-                run_job(**job_kwargs)
+                if result_cache is not None:
+                    key, output_path = _cache_lookup(
+                        spec, task_id, job_kwargs['metadata'])
 
-            except (KeyboardInterrupt, SystemExit):
-                
-                try:
-                    logger.error('{} interupted, removing .lck file before exiting'.format(task_id))
-                    os.remove(lock_file.format('lck'))
-                except:
-                    pass
-                raise
+                    if _restore_cached(result_cache, key, output_path):
+                        logger.debug('Found cached result {}. skipping'.format(
+                            key))
+                        return 'cached'
+
+                if profile:
+                    profiler = cProfile.Profile()
+
+                    try:
+                        profiler.runcall(run_job, **job_kwargs)
+                    finally:
+                        profiler.dump_stats(_profile_path(
+                            logdir, job_name, job_id, task_id))
+
+                else:
+                    run_job(**job_kwargs)
+
+                if result_cache is not None:
+                    current.when_committed(functools.partial(
+                        _store_cached, result_cache, key,
+                        job_kwargs['metadata'], output_path))
 
             except Exception as e:
                 logger.error(
@@ -553,59 +2600,254 @@ def slurm_runner(
                     .format(job_name, job_id, task_id),
                     exc_info=e)
 
-                with open(lock_file.format('err'), 'w+'):
-                    pass
+                current.discard(mark)
 
-            else:
-                with open(lock_file.format('done'), 'w+'):
-                    pass
+                if not duplicate:
+                    store.fail(task_id)
 
-            finally:
-                if os.path.exists(lock_file.format('lck')):
-                    os.remove(lock_file.format('lck'))
+                return 'err'
 
-                logger.removeHandler(handler)
+        return 'done'
 
     @slurm.command()
     @click.option('--job_name', '-j', required=True)
     @click.option('--job_id', '-u', required=True)
-    def status(job_name, job_id, num_jobs=None, logdir='log'):
-        n = count_jobs(job_spec)
-        locks = os.listdir('locks')
+    @click.option(
+        '--json', 'as_json', is_flag=True, default=False,
+        help='Print task counts as JSON')
+    @click.option(
+        '--chunk_size', type=click.IntRange(min=1), default=None,
+        help='Also count the tasks in each chunk of a chunked run')
+    @click.option(
+        '--claim_batch', type=click.IntRange(min=1), default=1,
+        help=(
+            'Claim batch of the chunked run, to which its chunks were rounded '
+            'up'))
+    @_task_options
+    @_state_options
+    def status(
+            job_name,
+            job_id,
+            num_jobs=None,
+            logdir='log',
+            as_json=False,
+            chunk_size=None,
+            claim_batch=1,
+            backend='file',
+            state_db=None,
+            task_file=None):
 
-        count = int(math.log10(n)//1 + 1)
+        if task_file is None:
+            task_file = _recorded_task_file(job_name, job_id)
+
+        n = count_jobs(_select_tasks(task_file))
+        store = get_state_store(
+            job_name, _state_job_id(job_id, task_file), backend, state_db)
+
+        if chunk_size is None:
+            counts = store.counts(n)
+            chunks = None
+
+        else:
+            tasks = store.scan(n)
+            counts = {state: len(ids) for state, ids in tasks.items()}
+            chunks = _chunk_counts(tasks, n, chunk_size, claim_batch)
+
+        if as_json:
+            summary = {
+                'job_name': job_name,
+                'job_id': job_id,
+                'jobs': n,
+                'done': counts['done'],
+                'in_progress': counts['lck'],
+                'errored': counts['err']}
+
+            if chunks is not None:
+                summary['chunks'] = chunks
 
-        locked = len([
-            i for i in range(n)
-            if '{}-{}-{}.lck'.format(job_name, job_id, i) in locks])
+            print(json.dumps(summary, sort_keys=True))
 
-        done = len([
-            i for i in range(n)
-            if '{}-{}-{}.done'.format(job_name, job_id, i) in locks])
+            return
 
-        err = len([
-            i for i in range(n)
-            if '{}-{}-{}.err'.format(job_name, job_id, i) in locks])
+        count = int(math.log10(n)//1 + 1)
 
         print(
             ("\n".join(["{{:<15}}{{:{}d}}".format(count) for _ in range(4)]))
             .format(
                 'jobs:', n,
-                'done:', done,
-                'in progress:', locked,
-                'errored:', err))
+                'done:', counts['done'],
+                'in progress:', counts['lck'],
+                'errored:', counts['err']))
+
+        if chunks is not None:
+            print('')
+            print('{:<20}{:>10}{:>13}{:>10}'.format(
+                'chunk', 'done', 'in progress', 'errored'))
+
+            for chunk in chunks:
+                print('{:<20}{:>10}{:>13}{:>10}'.format(
+                    '{}-{}'.format(chunk['start'], chunk['stop'] - 1),
+                    chunk['done'], chunk['in_progress'], chunk['errored']))
+
+    @slurm.command()
+    @click.option('--job_name', '-j', required=True)
+    @click.option('--job_id', '-u', required=True)
+    @click.option(
+        '--logdir', '-L', default='log', help='Directory of log files')
+    @click.option(
+        '--json', 'as_json', is_flag=True, default=False,
+        help='Print the summary as JSON')
+    @click.option(
+        '--merge', default=None,
+        help='Write the usage records of all workers to a single JSONL file')
+    @click.option(
+        '--slurm_id', '-s', multiple=True,
+        help='SLURM job ID of the run, to include accounting data from sacct')
+    def report(
+            job_name,
+            job_id,
+            logdir='log',
+            as_json=False,
+            merge=None,
+            slurm_id=None):
+        '''
+        Summarize the resources used by each task of a job
+        '''
+
+        records = read_usage(logdir, job_name, job_id)
+
+        if merge is not None:
+            with open(merge, 'w') as f:
+                for record in records:
+                    f.write(json.dumps(record, sort_keys=True) + '\n')
+
+        summary = summarize(records)
+
+        if slurm_id:
+            summary['slurm'] = slurm_report(run_sacct(slurm_id), records)
+
+        if as_json:
+            print(json.dumps(summary, sort_keys=True))
+            return
+
+        print(_format_usage(summary))
+
+        if slurm_id:
+            print('')
+            print(_format_slurm_report(summary['slurm']))
+
+    @slurm.command()
+    @click.option('--job_name', '-j', required=True)
+    @click.option('--job_id', '-u', required=True)
+    @click.option(
+        '--logdir', '-L', default='log', help='Directory of log files')
+    @click.option(
+        '--output', '-o', default=None,
+        help='Path of the merged stats file (default {logdir}/profile-'
+        '{job_name}-{job_id}.pstats)')
+    @click.option(
+        '--sort', default='cumulative',
+        help='Order in which to print the merged stats')
+    @click.option(
+        '--lines', type=int, default=30,
+        help='Number of functions to print')
+    def profile_merge(
+            job_name,
+            job_id,
+            logdir='log',
+            output=None,
+            sort='cumulative',
+            lines=30):
+        '''
+        Merge the cProfile stats of all profiled tasks of a job
+        '''
+
+        if output is None:
+            output = os.path.join(
+                logdir, 'profile-{}-{}.pstats'.format(job_name, job_id))
+
+        stats = merge_profiles(logdir, job_name, job_id, output)
+
+        if stats is None:
+            raise click.ClickException('No profiled tasks found')
+
+        stats.stream = sys.stdout
+        stats.sort_stats(sort).print_stats(lines)
+
+        print('merged stats written to {}'.format(output))
+
+    @slurm.command()
+    @click.option('--job_name', '-j', required=True)
+    @click.option('--job_id', '-u', required=True)
+    @click.option(
+        '--task', '-t', 'task_id', type=int, required=True,
+        help='ID of the task')
+    @click.option(
+        '--logdir', '-L', default='log', help='Directory of log files')
+    def logs(job_name, job_id, task_id, logdir='log'):
+        '''
+        Print the log of a task
+
+        Reads the task's records from the worker logs written with
+        ``--log_mode worker``, or else its own log file.
+        '''
+
+        text = read_task_log(logdir, job_name, job_id, task_id)
+
+        if text is None:
+            path = os.path.join(
+                logdir, 'run-{}-{}-{}.log'.format(job_name, job_id, task_id))
+
+            if not os.path.exists(path):
+                raise click.ClickException(
+                    'No log found for task {}'.format(task_id))
+
+            with open(path, 'r') as f:
+                text = f.read()
+
+        sys.stdout.write(text)
 
     @slurm.command()
     @click.option('--job_name', required=True)
     @click.option('--job_id', required=True)
     @click.option('--num_jobs', required=True, type=int)
-    def wait(job_name, job_id, num_jobs=None):
-
-        for task_id in range(num_jobs):
-            while not os.path.exists(
-                        'locks/{}-{}-{}.done'
-                        .format(job_name, job_id, task_id)):
-                time.sleep(10)
+    @click.option(
+        '--start', type=int, default=0, help='First task ID to wait for')
+    @click.option(
+        '--interval', type=float, default=10,
+        help='Maximum number of seconds between checks on task state')
+    @_task_options
+    @_state_options
+    @_claim_options
+    def wait(
+            job_name,
+            job_id,
+            num_jobs=None,
+            start=0,
+            interval=10,
+            backend='file',
+            state_db=None,
+            claim_batch=1,
+            lease=None,
+            task_file=None):
+
+        store = get_state_store(
+            job_name, _state_job_id(job_id, task_file), backend, state_db)
+        num_blocks = _count_blocks(num_jobs, claim_batch, start)
+
+        outstanding = list(_iter_blocks(
+            range(num_blocks), num_jobs, claim_batch, start))
+
+        # Local changes wake us early; changes made on other nodes are picked
+        # up by the next scan at most ``interval`` seconds later.
+        with watch_directory(store.watchdir) as watcher:
+            while True:
+                outstanding = store.unfinished(outstanding, num_jobs)
+
+                if not outstanding:
+                    break
+
+                watcher.wait(interval)
 
     def run_interactive(task_id=0):
 
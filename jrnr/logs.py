@@ -0,0 +1,242 @@
+'''
+Per-worker task logs
+
+By default, each task logs to its own file. With ``--log_mode worker``, each
+worker process instead appends the logs of all of its tasks to a single
+file, ``{logdir}/worker-{job_name}-{job_id}-{host}-{pid}.log``, so a run
+creates one log file per worker rather than one per task.
+
+Records are formatted on the task's thread and written by a background
+thread, which writes each task's pending records as one contiguous span and
+appends ``{task} {offset} {length}`` for the span to an index file next to
+the log. ``read_task_log`` uses the index to pull a single task's records
+out of the logs of every worker.
+'''
+
+from __future__ import absolute_import
+
+import os
+import socket
+import logging
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from jrnr._compat import iterdir
+
+
+class _TaskRecordHandler(logging.Handler):
+    '''
+    Send the records of one task to a worker's log
+    '''
+
+    def __init__(self, worker_log, task):
+        logging.Handler.__init__(self, logging.DEBUG)
+        self.worker_log = worker_log
+        self.task = task
+
+    def emit(self, record):
+        try:
+            lines = self.format(record)
+        except Exception:
+            self.handleError(record)
+            return
+
+        self.worker_log.put(self.task, lines)
+
+    def close(self):
+        self.worker_log.flush()
+        logging.Handler.close(self)
+
+
+class WorkerLog(object):
+    '''
+    Buffered log file shared by all of the tasks run by a worker process
+
+    The file is opened, and its writer thread started, on first use in each
+    process, so a log created before forking workers gives each worker its
+    own file.
+
+    Parameters
+    ----------
+
+    logdir : str
+    job_name : str
+    job_id : str
+    formatter : logging.Formatter, optional
+
+    Examples
+    --------
+
+    .. code-block:: python
+
+        >>> import tempfile
+        >>> logdir = tempfile.mkdtemp()
+        >>> worker_log = WorkerLog(logdir, 'tas', '001')
+        >>> log = logging.getLogger('jrnr.logs.example')
+        >>> log.propagate = False
+        >>> for task in (3, 4):
+        ...     handler = worker_log.handler(task)
+        ...     log.addHandler(handler)
+        ...     log.warning('running task {}'.format(task))
+        ...     log.removeHandler(handler)
+        ...     handler.close()
+        ...
+        >>> print(read_task_log(logdir, 'tas', '001', 4))
+        task 4: running task 4
+        <BLANKLINE>
+
+    '''
+
+    def __init__(self, logdir, job_name, job_id, formatter=None):
+        self.logdir = logdir
+        self.job_name = job_name
+        self.job_id = job_id
+        self.formatter = formatter
+
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def path(self):
+        return os.path.join(
+            self.logdir,
+            'worker-{}-{}-{}-{}.log'.format(
+                self.job_name, self.job_id, socket.gethostname(),
+                os.getpid()))
+
+    def handler(self, task):
+        '''
+        A logging handler which writes records to this log, tagged with
+        ``task``
+        '''
+
+        handler = _TaskRecordHandler(self, task)
+
+        if self.formatter is not None:
+            handler.setFormatter(self.formatter)
+
+        return handler
+
+    def _start(self):
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+
+            # don't close files inherited from the parent process
+            self._log = open(self.path, 'ab')
+            self._index = open(os.path.splitext(self.path)[0] + '.idx', 'a')
+            self._queue = queue.Queue()
+
+            writer = threading.Thread(target=self._write)
+            writer.daemon = True
+            writer.start()
+
+            self._pid = os.getpid()
+
+    def put(self, task, text):
+        '''
+        Queue a formatted record of ``task`` to be written
+        '''
+
+        self._start()
+
+        lines = text.splitlines() or ['']
+        self._queue.put((str(task), ''.join(
+            'task {}: {}\n'.format(task, line) for line in lines)))
+
+    def flush(self):
+        '''
+        Wait until every queued record has been written
+        '''
+
+        if self._pid == os.getpid():
+            self._queue.join()
+
+    def _write(self):
+        while True:
+            batch = [self._queue.get()]
+
+            while True:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            spans = {}
+            order = []
+
+            for task, text in batch:
+                if task not in spans:
+                    spans[task] = []
+                    order.append(task)
+
+                spans[task].append(text)
+
+            try:
+                for task in order:
+                    data = ''.join(spans[task]).encode('utf-8')
+                    offset = self._log.tell()
+
+                    self._log.write(data)
+                    self._index.write(
+                        '{} {} {}\n'.format(task, offset, len(data)))
+
+                self._log.flush()
+                self._index.flush()
+
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+
+def read_task_log(logdir, job_name, job_id, task):
+    '''
+    Read the records of a single task from the logs of every worker of a job
+
+    Spans are returned in the order of the logs' modification times, and in
+    the order they were written within each log.
+
+    Returns
+    -------
+    text : str or None
+        None if the task has no records in any worker's log
+    '''
+
+    prefix = 'worker-{}-{}-'.format(job_name, job_id)
+    task = str(task)
+
+    if not os.path.isdir(logdir):
+        return None
+
+    indices = [
+        os.path.join(logdir, fname) for fname in iterdir(logdir)
+        if fname.startswith(prefix) and fname.endswith('.idx')]
+
+    chunks = []
+
+    for index in sorted(indices, key=os.path.getmtime):
+        with open(index, 'r') as f:
+            spans = []
+
+            for line in f:
+                fields = line.split()
+
+                if len(fields) == 3 and fields[0] == task:
+                    spans.append((int(fields[1]), int(fields[2])))
+
+        if not spans:
+            continue
+
+        with open(os.path.splitext(index)[0] + '.log', 'rb') as f:
+            for offset, length in spans:
+                f.seek(offset)
+                chunks.append(f.read(length).decode('utf-8', 'replace'))
+
+    if not chunks:
+        return None
+
+    return ''.join(chunks)
@@ -0,0 +1,104 @@
+'''
+In-process memoization of inputs shared between tasks
+
+A worker runs many tasks in the same process, so inputs loaded by one task
+can be kept in memory for the next. This is most useful together with the
+``group_by`` argument of ``slurm_runner``, which makes consecutive tasks run
+by a worker share inputs.
+'''
+
+from __future__ import absolute_import
+
+import functools
+import threading
+import collections
+
+
+def memoize(func=None, maxsize=4):
+    '''
+    Keep the results of the last ``maxsize`` distinct calls of a function
+
+    Unlike ``functools.lru_cache``, a result being computed by one thread is
+    waited for by other threads asking for the same arguments, rather than
+    computed again. Arguments must be hashable. The cache is per process, and
+    is emptied when a worker is recycled.
+
+    Examples
+    --------
+
+    .. code-block:: python
+
+        >>> loads = []
+        >>> @memoize(maxsize=2)
+        ... def load(path):
+        ...     loads.append(path)
+        ...     return path.upper()
+        ...
+        >>> load('a'), load('b'), load('a'), load('c'), load('b')
+        ('A', 'B', 'A', 'C', 'B')
+
+        >>> loads
+        ['a', 'b', 'c', 'b']
+
+        >>> load.cache_clear()
+
+    With ``xarray``:
+
+    .. code-block:: python
+
+        @memoize
+        def load_climatology(model):
+            return xr.open_dataset(CLIM_PATH.format(model=model)).load()
+
+    '''
+
+    if func is None:
+        return functools.partial(memoize, maxsize=maxsize)
+
+    cache = collections.OrderedDict()
+    lock = threading.Lock()
+    loading = {}
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        key = (args, tuple(sorted(kwargs.items())))
+
+        while True:
+            with lock:
+                if key in cache:
+                    value = cache.pop(key)
+                    cache[key] = value
+                    return value
+
+                event = loading.get(key)
+
+                if event is None:
+                    event = loading[key] = threading.Event()
+                    break
+
+            event.wait()
+
+        try:
+            value = func(*args, **kwargs)
+
+            with lock:
+                cache[key] = value
+
+                while len(cache) > maxsize:
+                    cache.popitem(last=False)
+
+        finally:
+            with lock:
+                del loading[key]
+
+            event.set()
+
+        return value
+
+    def cache_clear():
+        with lock:
+            cache.clear()
+
+    wrapper.cache_clear = cache_clear
+
+    return wrapper
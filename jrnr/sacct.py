@@ -0,0 +1,360 @@
+'''
+Parse SLURM accounting data for a job's array elements
+
+``sacct`` reports one row for each array element (``{job}_{index}``) and one
+for each of its steps (``{job}_{index}.batch``, ``.extern``, ...). Memory use
+is only reported on the steps, so rows are combined per element.
+'''
+
+from __future__ import absolute_import
+
+import re
+import time
+import datetime
+import subprocess
+
+SACCT_FIELDS = (
+    'JobID', 'JobName', 'State', 'Elapsed', 'Start', 'End', 'NodeList',
+    'MaxRSS', 'ReqMem', 'AllocCPUS')
+
+_SIZE_UNITS = {'': 1, 'K': 2**10, 'M': 2**20, 'G': 2**30, 'T': 2**40}
+
+
+def parse_elapsed(value):
+    '''
+    Convert a sacct duration (``[D-][HH:]MM:SS[.ss]``) to seconds
+
+    Examples
+    --------
+
+    .. code-block:: python
+
+        >>> parse_elapsed('1-02:03:04')
+        93784.0
+
+        >>> parse_elapsed('03:04.5')
+        184.5
+
+        >>> parse_elapsed('') is None
+        True
+
+    '''
+
+    if not value:
+        return None
+
+    days, _, clock = value.rpartition('-')
+    seconds = 0.0
+
+    for part in clock.split(':'):
+        seconds = seconds * 60 + float(part)
+
+    return seconds + int(days or 0) * 86400
+
+
+def parse_size(value, cpus=1):
+    '''
+    Convert a sacct memory size to bytes
+
+    Sizes requested per CPU (with a ``c`` suffix) are multiplied by ``cpus``.
+
+    Examples
+    --------
+
+    .. code-block:: python
+
+        >>> parse_size('1024K')
+        1048576
+
+        >>> parse_size('62.50G')
+        67108864000
+
+        >>> parse_size('4000Mc', cpus=2)
+        8388608000
+
+        >>> parse_size('') is None
+        True
+
+    '''
+
+    match = re.match(r'^([0-9.]+)([KMGT]?)([nc]?)$', value or '')
+
+    if not match:
+        return None
+
+    number, unit, per = match.groups()
+    size = int(float(number) * _SIZE_UNITS[unit])
+
+    if per == 'c':
+        size *= cpus
+
+    return size
+
+
+def parse_time(value):
+    '''
+    Convert a sacct timestamp to a naive local datetime
+
+    Examples
+    --------
+
+    .. code-block:: python
+
+        >>> parse_time('2018-06-01T12:30:00')
+        datetime.datetime(2018, 6, 1, 12, 30)
+
+        >>> parse_time('Unknown') is None
+        True
+
+    '''
+
+    try:
+        return datetime.datetime.strptime(value, '%Y-%m-%dT%H:%M:%S')
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_sacct(text):
+    '''
+    Parse the output of ``sacct --parsable2`` into one record per element
+
+    Parameters
+    ----------
+
+    text : str
+        Output of ``sacct --parsable2 --format=...``, including the header
+
+    Returns
+    -------
+    elements : list of dict
+        For each job or array element, its ``job_id``, ``name``, ``state``,
+        ``elapsed`` (seconds), ``start`` and ``end`` (datetimes), ``node``,
+        ``max_rss`` and ``req_mem`` (bytes), and ``cpus``
+
+    Examples
+    --------
+
+    .. code-block:: python
+
+        >>> elements = parse_sacct(\'\'\'
+        ... JobID|JobName|State|Elapsed|MaxRSS|NodeList
+        ... 100_0|tas|COMPLETED|01:00:00||n0001
+        ... 100_0.batch|batch|COMPLETED|01:00:00|2048K|n0001
+        ... 100_1|tas|TIMEOUT|02:00:00||n0002
+        ... \'\'\')
+        ...
+        >>> [(e['job_id'], e['elapsed'], e['max_rss']) for e in elements]
+        [('100_0', 3600.0, 2097152), ('100_1', 7200.0, None)]
+
+    '''
+
+    lines = [line for line in text.strip().splitlines() if line.strip()]
+
+    if not lines:
+        return []
+
+    header = lines[0].split('|')
+    elements = {}
+    order = []
+
+    for line in lines[1:]:
+        row = dict(zip(header, line.split('|')))
+        element_id, _, step = row.get('JobID', '').partition('.')
+
+        if element_id not in elements:
+            order.append(element_id)
+            elements[element_id] = {
+                'job_id': element_id,
+                'name': None,
+                'state': None,
+                'elapsed': None,
+                'start': None,
+                'end': None,
+                'node': None,
+                'max_rss': None,
+                'req_mem': None,
+                'cpus': None}
+
+        element = elements[element_id]
+
+        cpus = int(row.get('AllocCPUS') or 1)
+        max_rss = parse_size(row.get('MaxRSS'))
+
+        if max_rss is not None:
+            element['max_rss'] = max(element['max_rss'] or 0, max_rss)
+
+        if step:
+            continue
+
+        element.update({
+            'name': row.get('JobName'),
+            'state': (row.get('State') or '').split(' ')[0] or None,
+            'elapsed': parse_elapsed(row.get('Elapsed')),
+            'start': parse_time(row.get('Start')),
+            'end': parse_time(row.get('End')),
+            'node': row.get('NodeList') or None,
+            'req_mem': parse_size(row.get('ReqMem'), cpus),
+            'cpus': cpus})
+
+    return [elements[element_id] for element_id in order]
+
+
+def run_sacct(slurm_ids):
+    '''
+    Run ``sacct`` for a list of SLURM job IDs and parse its output
+    '''
+
+    proc = subprocess.Popen(
+        [
+            'sacct', '--parsable2',
+            '--jobs', ','.join(map(str, slurm_ids)),
+            '--format={}'.format(','.join(SACCT_FIELDS))],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE)
+
+    out, err = proc.communicate()
+
+    if proc.returncode != 0:
+        raise OSError(
+            'Error encountered running sacct: {}'.format(
+                err.decode('utf-8', 'replace')))
+
+    return parse_sacct(out.decode('utf-8', 'replace'))
+
+
+def _short_host(host):
+    return (host or '').split('.')[0]
+
+
+def _timestamp(value):
+    '''
+    Seconds since the epoch of a naive local datetime
+    '''
+
+    return time.mktime(value.timetuple())
+
+
+def slurm_report(elements, records=None, slowest=5):
+    '''
+    Combine sacct data for array elements with jrnr's task usage records
+
+    Each element is assumed to run on a single node. Tasks are matched to
+    elements by host name, and by time if several elements ran on the same
+    node.
+
+    Parameters
+    ----------
+
+    elements : list of dict
+        Output of ``parse_sacct``
+    records : list of dict, optional
+        Task usage records (see :py:func:`jrnr.usage.read_usage`)
+
+    Returns
+    -------
+    report : dict
+        ``elements``, ``node_hours``, ``tasks_per_hour`` (tasks completed per
+        hour of the run's span), ``slowest`` elements, the largest
+        ``max_rss`` and smallest ``memory_headroom`` (fraction of requested
+        memory left unused), and per-element ``nodes`` statistics: tasks run,
+        hours spent running tasks, and ``idle_hours`` between the end of the
+        node's last task and the end of the element.
+
+    Examples
+    --------
+
+    .. code-block:: python
+
+        >>> start = datetime.datetime(2018, 6, 1, 12)
+        >>> elements = [{
+        ...     'job_id': '100_0', 'state': 'COMPLETED', 'elapsed': 7200.0,
+        ...     'start': start, 'end': start + datetime.timedelta(hours=2),
+        ...     'node': 'n0001', 'max_rss': 2**30, 'req_mem': 2**32}]
+        ...
+        >>> t0 = _timestamp(start)
+        >>> records = [
+        ...     {'host': 'n0001.savio2', 'status': 'done', 'start': t0,
+        ...      'end': t0 + 1800, 'wall': 1800},
+        ...     {'host': 'n0001.savio2', 'status': 'done', 'start': t0 + 1800,
+        ...      'end': t0 + 3600, 'wall': 1800}]
+        ...
+        >>> report = slurm_report(elements, records)
+        >>> report['node_hours'], report['tasks_per_hour']
+        (2.0, 2.0)
+
+        >>> report['memory_headroom']
+        0.75
+
+        >>> node = report['nodes'][0]
+        >>> node['tasks'], node['busy_hours'], node['idle_hours']
+        (2, 1.0, 1.0)
+
+    '''
+
+    records = records or []
+
+    nodes = []
+
+    for element in elements:
+        host = _short_host(element.get('node'))
+
+        if element.get('start') is not None:
+            start = _timestamp(element['start'])
+        else:
+            start = None
+
+        if element.get('end') is not None:
+            end = _timestamp(element['end'])
+        else:
+            end = None
+
+        tasks = [
+            r for r in records
+            if _short_host(r.get('host')) == host and
+            (start is None or r.get('start', 0) >= start) and
+            (end is None or r.get('end', 0) <= end)]
+
+        last = max([r.get('end', 0) for r in tasks] or [start or 0])
+
+        nodes.append({
+            'job_id': element['job_id'],
+            'node': element.get('node'),
+            'state': element.get('state'),
+            'elapsed_hours': (element.get('elapsed') or 0) / 3600.,
+            'tasks': len(tasks),
+            'busy_hours': sum(r.get('wall') or 0 for r in tasks) / 3600.,
+            'idle_hours': (
+                max(0, end - last) / 3600. if end is not None else None),
+            'max_rss': element.get('max_rss'),
+            'req_mem': element.get('req_mem')})
+
+    node_hours = sum(n['elapsed_hours'] for n in nodes)
+    done = [r for r in records if r.get('status') in ('done', 'cached')]
+
+    if done:
+        span = (
+            max(r.get('end', 0) for r in done) -
+            min(r.get('start', 0) for r in done))
+        tasks_per_hour = len(done) / (span / 3600.) if span > 0 else None
+    else:
+        tasks_per_hour = None
+
+    headroom = [
+        1 - float(n['max_rss']) / n['req_mem'] for n in nodes
+        if n['max_rss'] and n['req_mem']]
+
+    return {
+        'elements': len(nodes),
+        'states': dict(
+            (state, sum(n['state'] == state for n in nodes))
+            for state in set(n['state'] for n in nodes)),
+        'node_hours': node_hours,
+        'tasks_per_hour': tasks_per_hour,
+        'idle_hours': sum(n['idle_hours'] or 0 for n in nodes),
+        'max_rss': max([n['max_rss'] or 0 for n in nodes] or [0]),
+        'memory_headroom': min(headroom) if headroom else None,
+        'slowest': [
+            [n['job_id'], n['elapsed_hours']]
+            for n in sorted(
+                nodes, key=lambda n: -n['elapsed_hours'])[:slowest]],
+        'nodes': nodes}
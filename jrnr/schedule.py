@@ -0,0 +1,186 @@
+'''
+Choosing the order in which tasks are claimed
+
+Workers claim tasks roughly in order of task ID. Reordering the task IDs of a
+run (by writing them to a task file) therefore changes which tasks run first.
+'''
+
+from __future__ import absolute_import
+
+from jrnr.spec import JobSpec
+
+
+def _key(job):
+    '''
+    Hashable key for a task's keyword arguments, compared as strings
+
+    Examples
+    --------
+
+    .. code-block:: python
+
+        >>> _key({'year': 2000, 'model': 'a'})
+        (('model', 'a'), ('year', '2000'))
+
+    '''
+
+    return tuple(sorted((k, str(v)) for k, v in job.items()))
+
+
+def task_durations(records, job_name=None):
+    '''
+    Duration of the latest successful attempt at each task in a set of usage
+    records, keyed on the task's keyword arguments
+
+    Parameters
+    ----------
+
+    records : list of dict
+        Task usage records (see :py:func:`jrnr.usage.read_usage`), from any
+        number of runs
+    job_name : str, optional
+        Only use records of this job
+
+    Returns
+    -------
+    durations : dict
+    '''
+
+    latest = {}
+
+    for record in records:
+        if record.get('status') != 'done' or 'kwargs' not in record:
+            continue
+
+        if job_name is not None and record.get('job_name') != job_name:
+            continue
+
+        key = _key(record['kwargs'])
+
+        if key not in latest or record['start'] >= latest[key]['start']:
+            latest[key] = record
+
+    return dict((key, record['wall']) for key, record in latest.items())
+
+
+def estimate_durations(job_spec, task_ids, durations):
+    '''
+    Estimate the duration of tasks from the durations of earlier runs
+
+    Tasks which have run before are expected to take as long as they did
+    last time. Other tasks are estimated from the average duration of tasks
+    sharing each of their elements, relative to the overall average: a task
+    is expected to take ``mean * product(element_mean / mean)`` over the
+    dimensions of the spec.
+
+    Parameters
+    ----------
+
+    job_spec : JobSpec
+    task_ids : list of int
+    durations : dict
+        Output of :py:func:`task_durations`
+
+    Returns
+    -------
+    estimates : list of float
+        Estimated duration of each task in ``task_ids``, or None for every
+        task if there are no durations
+
+    Examples
+    --------
+
+    .. code-block:: python
+
+        >>> spec = JobSpec((
+        ...     [{'rcp': 'rcp45'}, {'rcp': 'rcp85'}],
+        ...     [{'year': 2000}, {'year': 2099}]))
+        ...
+        >>> durations = {
+        ...     (('rcp', 'rcp45'), ('year', '2000')): 10.,
+        ...     (('rcp', 'rcp85'), ('year', '2000')): 20.,
+        ...     (('rcp', 'rcp45'), ('year', '2099')): 30.}
+        ...
+        >>> estimate_durations(spec, range(4), durations)
+        [10.0, 30.0, 20.0, 30.0]
+
+    '''
+
+    task_ids = list(task_ids)
+
+    if not durations:
+        return [None for _ in task_ids]
+
+    if not isinstance(job_spec, JobSpec):
+        job_spec = JobSpec(job_spec)
+
+    dims = [
+        [_key(element) for element in dim] for dim in job_spec.job_spec]
+
+    # mean duration of the tasks sharing each element of each dimension
+    totals = [[[0.0, 0] for _ in dim] for dim in dims]
+
+    for key, duration in durations.items():
+        items = set(key)
+
+        for dim, dim_totals in zip(dims, totals):
+            for element, total in zip(dim, dim_totals):
+                if element and set(element) <= items:
+                    total[0] += duration
+                    total[1] += 1
+                    break
+
+    mean = sum(durations.values()) / len(durations)
+
+    factors = [
+        [
+            (total / count / mean) if (count and mean) else 1.0
+            for total, count in dim_totals]
+        for dim_totals in totals]
+
+    estimates = []
+
+    for task_id in task_ids:
+        job = job_spec.get_job(task_id)
+        known = durations.get(_key(job))
+
+        if known is not None:
+            estimates.append(known)
+            continue
+
+        estimate = mean
+
+        for dim_factors, position in zip(factors, job_spec.decode(task_id)):
+            estimate *= dim_factors[position]
+
+        estimates.append(estimate)
+
+    return estimates
+
+
+def longest_first(job_spec, task_ids, durations):
+    '''
+    Order tasks by decreasing estimated duration
+
+    Tasks with equal estimates keep their original order.
+
+    Examples
+    --------
+
+    .. code-block:: python
+
+        >>> spec = JobSpec(([{'year': y} for y in range(2000, 2004)], ))
+        >>> longest_first(spec, range(4), {
+        ...     (('year', '2001'), ): 30., (('year', '2003'), ): 20.})
+        [1, 0, 2, 3]
+
+    '''
+
+    task_ids = list(task_ids)
+    estimates = estimate_durations(job_spec, task_ids, durations)
+
+    order = sorted(
+        range(len(task_ids)),
+        key=lambda i: -(estimates[i] or 0))
+
+    return [task_ids[i] for i in order]
@@ -0,0 +1,312 @@
+'''
+Node-local cache of inputs shared by the worker processes on a node
+
+The first worker to ask for a key loads it and writes it to a file in shared
+memory (``/dev/shm``). Other workers on the node map the same file instead of
+loading it again. Numpy arrays are memory-mapped read-only, so every worker
+shares a single copy in RAM. Other values are pickled, and are unpickled by
+each worker.
+
+Each entry has a lock file. Workers using an entry hold a shared lock on it,
+which acts as a reference count that the operating system releases if the
+worker dies. Entries no worker is using are evicted, least recently used
+first, once the cache grows beyond its byte budget.
+'''
+
+from __future__ import absolute_import
+
+import os
+import errno
+import pickle
+import hashlib
+import tempfile
+import threading
+import contextlib
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+def _default_directory():
+    base = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+
+    return os.path.join(base, 'jrnr-{}'.format(
+        os.getuid() if hasattr(os, 'getuid') else 'cache'))
+
+
+class NodeCache(object):
+    '''
+    Cache of values shared between processes on the same node
+
+    Parameters
+    ----------
+
+    directory : str, optional
+        Directory in which to store entries. Defaults to a per-user directory
+        in ``/dev/shm``, or in the temporary directory if there is no
+        ``/dev/shm``.
+    max_bytes : int, optional
+        Evict unused entries once the cache is larger than this. Entries in
+        use are never evicted, so the cache can exceed this if every entry is
+        in use. Default (None) never evicts entries.
+
+    Examples
+    --------
+
+    .. code-block:: python
+
+        >>> import tempfile
+        >>> cache = NodeCache(tempfile.mkdtemp())
+        >>> calls = []
+        >>> def load():
+        ...     calls.append(1)
+        ...     return {'units': 'K'}
+        ...
+        >>> with cache.using('meta', load) as meta:
+        ...     meta['units']
+        'K'
+
+        >>> cache.get('meta', load)
+        {'units': 'K'}
+
+        >>> len(calls)
+        1
+
+        >>> cache.release('meta')
+
+    A typical use in a task:
+
+    .. code-block:: python
+
+        SHARED = NodeCache(max_bytes=16 * 2**30)
+
+        def load_mask():
+            return xr.open_dataset(MASK_PATH).mask.values
+
+        @slurm_runner(job_spec=JOB_SPEC)
+        def make_tas(metadata, scenario, year, model, interactive=False):
+            with SHARED.using('land_mask', load_mask) as mask:
+                ...
+
+    '''
+
+    def __init__(self, directory=None, max_bytes=None):
+        if fcntl is None:
+            raise OSError('NodeCache requires fcntl, which is unavailable')
+
+        self.directory = directory or _default_directory()
+        self.max_bytes = max_bytes
+
+        # references held by this process: key -> [lock file, count, value]
+        self._refs = {}
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+
+    def _name(self, key):
+        return hashlib.sha1(str(key).encode('utf-8')).hexdigest()[:20]
+
+    def _paths(self, key):
+        base = os.path.join(self.directory, self._name(key))
+        return base + '.lock', base + '.npy', base + '.pkl'
+
+    def _setup(self):
+        try:
+            os.makedirs(self.directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def _read(self, npy, pkl):
+        if os.path.exists(npy):
+            os.utime(npy, None)
+            return np.load(npy, mmap_mode='r')
+
+        if os.path.exists(pkl):
+            os.utime(pkl, None)
+            with open(pkl, 'rb') as f:
+                return pickle.load(f)
+
+        raise KeyError(npy)
+
+    def _write(self, value, npy, pkl):
+        is_array = np is not None and isinstance(value, np.ndarray)
+        path = npy if is_array else pkl
+
+        fd, tmp = tempfile.mkstemp(dir=self.directory, prefix='.tmp-')
+
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                if is_array:
+                    np.save(f, value)
+                else:
+                    pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+            size = os.path.getsize(tmp)
+            self._evict(size)
+            os.rename(tmp, path)
+
+        except BaseException:
+            os.remove(tmp)
+            raise
+
+    def _entries(self):
+        '''
+        ``(last_used, size, lock, data)`` for each entry in the cache
+        '''
+
+        for fname in os.listdir(self.directory):
+            base, ext = os.path.splitext(fname)
+
+            if ext not in ('.npy', '.pkl') or fname.startswith('.'):
+                continue
+
+            path = os.path.join(self.directory, fname)
+
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+
+            yield (
+                stat.st_mtime, stat.st_size,
+                os.path.join(self.directory, base + '.lock'), path)
+
+    def _evict(self, incoming=0):
+        '''
+        Remove unused entries, least recently used first, until there is
+        room for ``incoming`` more bytes
+        '''
+
+        if self.max_bytes is None:
+            return
+
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _, _ in entries) + incoming
+
+        for _, size, lock, data in entries:
+            if total <= self.max_bytes:
+                break
+
+            try:
+                fd = os.open(lock, os.O_RDWR | os.O_CREAT)
+            except OSError:
+                continue
+
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except (IOError, OSError):
+                # in use by another worker
+                os.close(fd)
+                continue
+
+            try:
+                os.remove(data)
+                total -= size
+            except OSError:
+                pass
+            finally:
+                os.close(fd)
+
+    def get(self, key, loader):
+        '''
+        Get the value of ``key``, calling ``loader()`` to create it if no
+        worker on this node has yet
+
+        The entry is held (and won't be evicted) until ``release(key)`` is
+        called as many times as ``get``, or until the process exits.
+        '''
+
+        with self._lock:
+            if self._pid != os.getpid():
+                # drop this process's copies of the parent's references
+                for fd, _, _ in self._refs.values():
+                    os.close(fd)
+
+                self._refs = {}
+                self._pid = os.getpid()
+
+            if key in self._refs:
+                self._refs[key][1] += 1
+                return self._refs[key][2]
+
+            self._setup()
+            lock, npy, pkl = self._paths(key)
+
+            fd = os.open(lock, os.O_RDWR | os.O_CREAT)
+
+            try:
+                fcntl.flock(fd, fcntl.LOCK_SH)
+
+                try:
+                    value = self._read(npy, pkl)
+
+                except KeyError:
+                    # only one worker loads a missing entry
+                    fcntl.flock(fd, fcntl.LOCK_EX)
+
+                    try:
+                        value = self._read(npy, pkl)
+                    except KeyError:
+                        self._write(loader(), npy, pkl)
+                        value = self._read(npy, pkl)
+
+                    fcntl.flock(fd, fcntl.LOCK_SH)
+
+            except BaseException:
+                os.close(fd)
+                raise
+
+            self._refs[key] = [fd, 1, value]
+
+            return value
+
+    def release(self, key):
+        '''
+        Release a reference to ``key`` obtained with ``get``
+        '''
+
+        with self._lock:
+            ref = self._refs.get(key)
+
+            if ref is None or self._pid != os.getpid():
+                return
+
+            ref[1] -= 1
+
+            if ref[1] <= 0:
+                del self._refs[key]
+                os.close(ref[0])
+
+    @contextlib.contextmanager
+    def using(self, key, loader):
+        '''
+        Get the value of ``key`` within a context, releasing it on exit
+        '''
+
+        value = self.get(key, loader)
+
+        try:
+            yield value
+        finally:
+            self.release(key)
+
+    def clear(self):
+        '''
+        Remove every entry which is not in use
+        '''
+
+        max_bytes = self.max_bytes
+        self.max_bytes = 0
+
+        try:
+            if os.path.isdir(self.directory):
+                self._evict()
+        finally:
+            self.max_bytes = max_bytes
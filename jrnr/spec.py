@@ -0,0 +1,582 @@
+'''
+Compiled job specifications
+
+A job specification is a tuple of lists of dicts. Task ``i`` of a job is the
+``i``-th element of the cartesian product of the lists, with the last list
+varying fastest. A filtered specification skips some elements of the product,
+and numbers the remaining tasks consecutively.
+'''
+
+from __future__ import absolute_import
+
+import array
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+class JobSpec(object):
+    '''
+    Job specification with precomputed strides for decoding task IDs
+
+    Parameters
+    ----------
+
+    job_spec : tuple of lists of dicts or JobSpec
+        Job specification in the format ``([{kwargs: vals}, ...], [...], )``
+
+    Examples
+    --------
+
+    .. code-block:: python
+
+        >>> spec = JobSpec((
+        ...     [{'let': 'a'}, {'let': 'b'}, {'let': 'c'}],
+        ...     [{'num': 1}, {'num': 2}],
+        ...     [{'pitch': 'do'}, {'pitch': 'rey'}, {'pitch': 'mi'}]))
+        ...
+        >>> len(spec)
+        18
+
+        >>> spec.strides
+        (6, 3, 1)
+
+        >>> spec.decode(11)
+        (1, 1, 2)
+
+        >>> sorted(spec.get_job(11).items())
+        [('let', 'b'), ('num', 2), ('pitch', 'mi')]
+
+    '''
+
+    def __init__(self, job_spec):
+        if isinstance(job_spec, JobSpec):
+            job_spec = job_spec.job_spec
+
+        self.job_spec = tuple(job_spec)
+        self.shape = tuple(len(dim) for dim in self.job_spec)
+
+        strides = []
+        stride = 1
+        for length in reversed(self.shape):
+            strides.append(stride)
+            stride *= length
+
+        self.strides = tuple(reversed(strides))
+        self.size = stride
+
+    def __len__(self):
+        return self.size
+
+    def decode(self, index):
+        '''
+        Position of task ``index`` along each dimension of the spec
+
+        Returns
+        -------
+        indices : tuple of int
+        '''
+
+        return tuple(
+            (index // stride) % length
+            for stride, length in zip(self.strides, self.shape))
+
+    def decode_many(self, indices):
+        '''
+        Decode many task IDs at once
+
+        Parameters
+        ----------
+
+        indices : sequence of int or range
+
+        Returns
+        -------
+        indices : list
+            One sequence per dimension of the spec, giving the position of
+            each task along that dimension. These are integer arrays if numpy
+            is installed, and lists otherwise.
+
+        Examples
+        --------
+
+        .. code-block:: python
+
+            >>> spec = JobSpec((
+            ...     [{'a': 1}, {'a': 2}],
+            ...     [{'b': 'x'}, {'b': 'y'}, {'b': 'z'}]))
+            ...
+            >>> [list(map(int, dim)) for dim in spec.decode_many(range(6))]
+            [[0, 0, 0, 1, 1, 1], [0, 1, 2, 0, 1, 2]]
+
+        '''
+
+        if np is not None:
+            indices = np.asarray(indices, dtype=np.int64)
+
+            return [
+                (indices // stride) % length
+                for stride, length in zip(self.strides, self.shape)]
+
+        indices = list(indices)
+
+        return [
+            [(index // stride) % length for index in indices]
+            for stride, length in zip(self.strides, self.shape)]
+
+    def get_job(self, index):
+        '''
+        Keyword arguments for task ``index``
+
+        Returns
+        -------
+        job : dict
+        '''
+
+        job = {}
+
+        for dim, i in zip(self.job_spec, self.decode(index)):
+            job.update(dim[i])
+
+        return job
+
+    def filter(self, filters=None, exclude=None, chunksize=2**16):
+        '''
+        Restrict the spec to a subset of its tasks
+
+        Parameters
+        ----------
+
+        filters : list of functions, optional
+            Each filter is called with the keyword arguments of a task as a
+            dict, and the task is kept only if every filter returns True.
+
+        exclude : list of dicts, optional
+            A task is dropped if its keyword arguments match all of the items
+            in any of these dicts. Each key is assumed to be set by only one
+            dimension of the spec.
+
+        chunksize : int, optional
+            Number of tasks to evaluate at a time when building the index
+
+        Returns
+        -------
+        spec : FilteredJobSpec
+
+        Examples
+        --------
+
+        .. code-block:: python
+
+            >>> spec = JobSpec((
+            ...     [{'model': 'a'}, {'model': 'b'}],
+            ...     [{'year': 2000}, {'year': 2010}, {'year': 2020}]))
+            ...
+            >>> filtered = spec.filter(
+            ...     filters=[lambda job: job['year'] > 2000],
+            ...     exclude=[{'model': 'b', 'year': 2020}])
+            ...
+            >>> len(filtered)
+            3
+
+            >>> jobs = [filtered.get_job(i) for i in range(len(filtered))]
+            >>> [(job['model'], job['year']) for job in jobs]
+            [('a', 2010), ('a', 2020), ('b', 2010)]
+
+        '''
+
+        return FilteredJobSpec(self, filters, exclude, chunksize)
+
+    def group(self, key):
+        '''
+        Reorder the spec so that tasks with the same ``key`` are consecutive
+
+        Groups are ordered by their first task, and tasks keep their order
+        within each group.
+
+        Parameters
+        ----------
+
+        key : list of str or function
+            Names of the keyword arguments which make up the group, or a
+            function of a dict of a task's keyword arguments
+
+        Returns
+        -------
+        spec : FilteredJobSpec
+
+        Examples
+        --------
+
+        .. code-block:: python
+
+            >>> spec = JobSpec((
+            ...     [{'year': 2000}, {'year': 2010}],
+            ...     [{'model': 'a'}, {'model': 'b'}]))
+            ...
+            >>> grouped = spec.group(['model'])
+            >>> jobs = [grouped.get_job(i) for i in range(len(grouped))]
+            >>> [(job['model'], job['year']) for job in jobs]
+            [('a', 2000), ('a', 2010), ('b', 2000), ('b', 2010)]
+
+            >>> grouped.groups
+            [0, 2]
+
+        '''
+
+        return FilteredJobSpec(self, sort_key=_group_key(key))
+
+    def take(self, task_ids):
+        '''
+        Restrict the spec to a list of its task IDs
+
+        Task ``i`` of the returned spec is task ``task_ids[i]`` of this one.
+
+        Returns
+        -------
+        spec : FilteredJobSpec
+
+        Examples
+        --------
+
+        .. code-block:: python
+
+            >>> spec = JobSpec((
+            ...     [{'model': 'a'}, {'model': 'b'}],
+            ...     [{'year': 2000}, {'year': 2010}, {'year': 2020}]))
+            ...
+            >>> subset = spec.take([1, 5])
+            >>> len(subset)
+            2
+
+            >>> sorted(subset.get_job(1).items())
+            [('model', 'b'), ('year', 2020)]
+
+        '''
+
+        index = array.array('q', (int(i) for i in task_ids))
+
+        return FilteredJobSpec(self, index=_as_index(index))
+
+
+def _as_index(index):
+    '''
+    Convert an ``array.array`` of task positions to the type used for
+    indices: an integer array if numpy is installed
+    '''
+
+    if np is not None:
+        return np.frombuffer(index, dtype=np.int64)
+
+    return index
+
+
+def _group_key(key):
+    '''
+    Examples
+    --------
+
+    .. code-block:: python
+
+        >>> _group_key(['model', 'rcp'])({'model': 'a', 'rcp': 85, 'y': 1})
+        ('a', '85')
+
+    '''
+
+    if callable(key):
+        return key
+
+    names = [key] if isinstance(key, str) else list(key)
+
+    def get_key(job):
+        return tuple(str(job.get(name)) for name in names)
+
+    return get_key
+
+
+def _exclusion_tables(job_spec, rule):
+    '''
+    Per-element lookup tables used to match an exclusion rule
+
+    For each dimension, returns a list of ``(conflicts, matches)`` pairs, one
+    per element, where ``conflicts`` is 1 if the element sets one of the
+    rule's keys to a different value, and ``matches`` is the number of the
+    rule's keys it sets to the same value. A task matches the rule if no
+    element conflicts and the matches add up to the number of keys.
+    '''
+
+    return [
+        [
+            (
+                int(any(
+                    k in element and element[k] != v
+                    for k, v in rule.items())),
+                sum(
+                    k in element and element[k] == v
+                    for k, v in rule.items()))
+            for element in dim]
+        for dim in job_spec]
+
+
+class FilteredJobSpec(JobSpec):
+    '''
+    A job specification restricted to a subset of its tasks
+
+    Task IDs of a filtered spec are consecutive, and are mapped to positions
+    in the full cartesian product (``base``) through an index array. The index
+    is built the first time it is needed, a chunk of tasks at a time, unless
+    it is given explicitly.
+
+    See :py:meth:`JobSpec.filter` and :py:meth:`JobSpec.take`.
+    '''
+
+    def __init__(
+            self,
+            job_spec,
+            filters=None,
+            exclude=None,
+            chunksize=2**16,
+            index=None,
+            sort_key=None):
+
+        if isinstance(job_spec, FilteredJobSpec) and index is not None:
+            # a subset of a grouped spec keeps its order, and its groups
+            sort_key = job_spec.sort_key
+
+            # compose with the parent's index rather than nesting specs
+            if np is not None:
+                index = job_spec.index[np.asarray(index, dtype=np.int64)]
+            else:
+                index = array.array('q', (job_spec.index[i] for i in index))
+
+            job_spec = job_spec.base
+
+        JobSpec.__init__(self, job_spec)
+
+        self.base = JobSpec(job_spec)
+        self.filters = list(filters or [])
+        self.exclude = list(exclude or [])
+        self.chunksize = chunksize
+        self.sort_key = sort_key
+
+        self._index = index
+        self._groups = None
+
+    @property
+    def index(self):
+        '''
+        Position in the full product of each task in the filtered spec
+        '''
+
+        if self._index is None:
+            self._index = self._build_index()
+
+        return self._index
+
+    @property
+    def groups(self):
+        '''
+        First task ID of each group of consecutive tasks with the same
+        ``sort_key``, or None if the spec is not grouped
+        '''
+
+        if self.sort_key is None:
+            return None
+
+        if self._groups is None:
+            self._groups = []
+            last = object()
+
+            for i in range(len(self)):
+                key = self.sort_key(self.get_job(i))
+
+                if key != last:
+                    self._groups.append(i)
+                    last = key
+
+        return self._groups
+
+    def filter(self, filters=None, exclude=None, chunksize=2**16):
+        '''
+        Restrict the spec further, keeping the order (and groups) of its
+        remaining tasks
+
+        See :py:meth:`JobSpec.filter`.
+
+        Examples
+        --------
+
+        .. code-block:: python
+
+            >>> spec = JobSpec((
+            ...     [{'model': 'a'}, {'model': 'b'}],
+            ...     [{'year': 2000}, {'year': 2010}, {'year': 2020}]))
+            ...
+            >>> filtered = spec.filter(exclude=[{'year': 2000}]).filter(
+            ...     filters=[lambda job: job['model'] == 'b'])
+            ...
+            >>> [filtered.get_job(i)['year'] for i in range(len(filtered))]
+            [2010, 2020]
+
+        '''
+
+        spec = FilteredJobSpec(
+            self.base, self.filters + list(filters or []),
+            self.exclude + list(exclude or []), chunksize,
+            sort_key=self.sort_key)
+
+        # only the new rules need to be checked against this spec's tasks
+        rules = FilteredJobSpec(self.base, filters, exclude, chunksize)
+        index = array.array('q')
+
+        for start in range(0, len(self), chunksize):
+            index.extend(rules._select(
+                [int(task) for task in self.index[start:start + chunksize]]))
+
+        spec._index = _as_index(index)
+
+        return spec
+
+    def group(self, key):
+        '''
+        Reorder the spec so that tasks with the same ``key`` are consecutive,
+        keeping its subset of tasks
+
+        See :py:meth:`JobSpec.group`.
+
+        Examples
+        --------
+
+        .. code-block:: python
+
+            >>> spec = JobSpec((
+            ...     [{'year': 2000}, {'year': 2010}],
+            ...     [{'model': 'a'}, {'model': 'b'}]))
+            ...
+            >>> grouped = spec.take([3, 1, 2]).group(['model'])
+            >>> jobs = [grouped.get_job(i) for i in range(len(grouped))]
+            >>> [(job['model'], job['year']) for job in jobs]
+            [('b', 2010), ('b', 2000), ('a', 2010)]
+
+        '''
+
+        spec = FilteredJobSpec(
+            self.base, self.filters, self.exclude, self.chunksize,
+            sort_key=_group_key(key))
+
+        spec._index = _as_index(spec._sort(self.index))
+
+        return spec
+
+    def _excluded(self, tables, positions):
+        '''
+        Mask of tasks matching any exclusion rule, given their positions
+        along each dimension
+        '''
+
+        if np is not None:
+            excluded = np.zeros(len(positions[0]), dtype=bool)
+
+            for rule, table in zip(self.exclude, tables):
+                conflicts = np.zeros(len(positions[0]), dtype=np.int64)
+                matches = np.zeros(len(positions[0]), dtype=np.int64)
+
+                for dim_table, dim_positions in zip(table, positions):
+                    dim_table = np.array(dim_table, dtype=np.int64)
+                    conflicts += dim_table[dim_positions, 0]
+                    matches += dim_table[dim_positions, 1]
+
+                excluded |= (conflicts == 0) & (matches >= len(rule))
+
+            return excluded
+
+        excluded = []
+
+        for task_positions in zip(*positions):
+            excluded.append(any(
+                all(
+                    dim_table[p][0] == 0
+                    for dim_table, p in zip(table, task_positions)) and
+                sum(
+                    dim_table[p][1]
+                    for dim_table, p in zip(table, task_positions)
+                    ) >= len(rule)
+                for rule, table in zip(self.exclude, tables)))
+
+        return excluded
+
+    def _select(self, chunk, tables=None):
+        '''
+        Positions from ``chunk`` (in the full product) which pass this spec's
+        exclusions and filters
+        '''
+
+        if tables is None:
+            tables = [
+                _exclusion_tables(self.job_spec, rule)
+                for rule in self.exclude]
+
+        if not len(chunk):
+            return []
+
+        excluded = self._excluded(tables, self.base.decode_many(chunk))
+
+        candidates = [
+            task for task, skip in zip(chunk, excluded) if not skip]
+
+        if self.filters:
+            candidates = [
+                task for task in candidates
+                if all(f(self.base.get_job(task)) for f in self.filters)]
+
+        return candidates
+
+    def _build_index(self):
+        tables = [
+            _exclusion_tables(self.job_spec, rule) for rule in self.exclude]
+
+        index = array.array('q')
+
+        for start in range(0, self.size, self.chunksize):
+            index.extend(self._select(
+                range(start, min(start + self.chunksize, self.size)), tables))
+
+        if self.sort_key is not None:
+            index = self._sort(index)
+
+        return _as_index(index)
+
+    def _sort(self, index):
+        '''
+        Stable sort of the index by group, with groups in order of their
+        first task
+        '''
+
+        rank = {}
+        ranks = []
+
+        for task in index:
+            key = self.sort_key(self.base.get_job(task))
+            ranks.append(rank.setdefault(key, len(rank)))
+
+        order = sorted(range(len(index)), key=ranks.__getitem__)
+
+        return array.array('q', (index[i] for i in order))
+
+    def __len__(self):
+        return len(self.index)
+
+    def decode(self, index):
+        return self.base.decode(int(self.index[index]))
+
+    def decode_many(self, indices):
+        if np is not None:
+            return self.base.decode_many(
+                self.index[np.asarray(indices, dtype=np.int64)])
+
+        return self.base.decode_many([self.index[i] for i in indices])
+
+    def get_job(self, index):
+        return self.base.get_job(int(self.index[index]))
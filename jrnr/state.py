@@ -0,0 +1,850 @@
+'''
+Task state backends for ``slurm_runner``
+
+A state store records which tasks of a job have been claimed by a worker, which
+have completed, and which have errored. Each store is bound to a single
+``(job_name, job_id)`` pair.
+
+Tasks are claimed and completed in contiguous blocks of task IDs
+``[start, stop)``. By default a block holds a single task. Errors are always
+recorded per task.
+
+If a store has a ``lease``, claims expire unless they are refreshed. A
+background thread in each worker process refreshes the claims it holds, so
+the claims of workers which died (e.g. on preempted nodes) expire, and can be
+taken over by other workers.
+
+Completing a block is atomic and only succeeds once, so that when several
+attempts at a block run at once (see ``--speculate``), exactly one of them is
+committed.
+'''
+
+from __future__ import absolute_import
+
+import os
+import time
+import uuid
+import socket
+import sqlite3
+import threading
+
+from jrnr._compat import exclusive_open, iterdir
+
+# guards the creation of each store's per-process claim state
+_held_setup = threading.Lock()
+
+
+def _unit(start, stop=None):
+    '''
+    Name fragment for a block of tasks
+
+    Examples
+    --------
+
+    .. code-block:: python
+
+        >>> _unit(4)
+        '4'
+
+        >>> _unit(10, 20)
+        '10_19'
+
+    '''
+
+    if stop is None or stop - start == 1:
+        return str(start)
+
+    return '{}_{}'.format(start, stop - 1)
+
+
+class StateStore(object):
+    '''
+    Base class for task state stores
+
+    Stores implement ``setup``, ``claim``, ``pending``, ``release``,
+    ``complete``, ``fail``, ``get_state``, ``is_done``, ``running``,
+    ``duplicate``, ``scan`` and ``counts``. ``watchdir`` names a directory
+    which changes whenever task state is updated.
+    '''
+
+    watchdir = '.'
+    lease = None
+
+    def _held(self):
+        '''
+        Blocks claimed by the current process, as a dict of ``(start, stop)``
+        to a claim token
+        '''
+
+        if getattr(self, '_held_pid', None) != os.getpid():
+            with _held_setup:
+                if getattr(self, '_held_pid', None) != os.getpid():
+                    self._held_blocks = {}
+                    self._held_lock = threading.Lock()
+                    self._heartbeat = None
+
+                    # set last, so other threads never see a stale dict
+                    self._held_pid = os.getpid()
+
+        return self._held_blocks
+
+    def _hold(self, start, stop=None, token=None):
+        held = self._held()
+        stop = start + 1 if stop is None else stop
+
+        with self._held_lock:
+            held[(start, stop)] = token
+
+            if self.lease is not None and self._heartbeat is None:
+                self._heartbeat = threading.Thread(
+                    target=self._beat, args=(os.getpid(), ))
+                self._heartbeat.daemon = True
+                self._heartbeat.start()
+
+    def _unhold(self, start, stop=None):
+        held = self._held()
+        stop = start + 1 if stop is None else stop
+
+        with self._held_lock:
+            return held.pop((start, stop), None)
+
+    def _beat(self, pid):
+        while os.getpid() == pid:
+            time.sleep(self.lease / 3.)
+            self.heartbeat()
+
+    def heartbeat(self):
+        '''
+        Refresh the lease on every block claimed by the current process
+        '''
+
+        held = self._held()
+
+        with self._held_lock:
+            blocks = list(held.items())
+
+        for (start, stop), token in blocks:
+            self.refresh(start, stop, token)
+
+    def unfinished(self, blocks, num_jobs):
+        '''
+        Filter a list of ``(start, stop)`` blocks down to those not yet done
+
+        A single task is done once it has succeeded. A block of tasks is done
+        once every task in it has either succeeded or errored. Uses a single
+        call to ``scan``.
+        '''
+
+        tasks = self.scan(num_jobs)
+        finished = tasks['done'] | tasks['err']
+
+        def is_done(start, stop):
+            if stop - start == 1:
+                return start in tasks['done']
+
+            return all(i in finished for i in range(start, stop))
+
+        return [
+            (start, stop) for start, stop in blocks
+            if not is_done(start, stop)]
+
+
+class FileStateStore(StateStore):
+    '''
+    Task state stored as empty marker files in a locks directory
+
+    Each task ``i`` is represented by at most one of
+    ``{job_name}-{job_id}-{i}.lck``, ``.done``, or ``.err``. A block of tasks
+    ``i`` through ``j`` claimed together is locked and completed with a single
+    ``{job_name}-{job_id}-{i}_{j}.lck`` or ``.done`` file, while tasks in the
+    block which error still get their own ``.err`` file.
+
+    Parameters
+    ----------
+
+    job_name : str
+    job_id : str
+    lockdir : str, optional
+        Directory in which to write lock files (default ``'locks'``)
+    lease : float, optional
+        Seconds after which a ``.lck`` file which has not been refreshed may
+        be taken over by another worker. Lock files record the host and
+        process holding them, and their modification time is the time of the
+        last refresh. Default (None) never expires claims.
+    '''
+
+    def __init__(self, job_name, job_id, lockdir='locks', lease=None):
+        self.job_name = job_name
+        self.job_id = job_id
+        self.lockdir = lockdir
+        self.lease = lease
+
+    @property
+    def watchdir(self):
+        return self.lockdir
+
+    def _path(self, unit, state):
+        return os.path.join(
+            self.lockdir,
+            '{}-{}-{}.{}'.format(self.job_name, self.job_id, unit, state))
+
+    def setup(self):
+        if not os.path.isdir(self.lockdir):
+            os.makedirs(self.lockdir)
+
+    def get_state(self, start, stop=None):
+        '''
+        Return ``'done'`` or ``'err'`` for finished blocks, else ``None``
+        '''
+
+        unit = _unit(start, stop)
+
+        if os.path.exists(self._path(unit, 'done')):
+            return 'done'
+
+        if unit == str(start) and os.path.exists(self._path(unit, 'err')):
+            return 'err'
+
+    def claim(self, start, stop=None):
+        '''
+        Attempt to claim a block of tasks
+
+        Returns
+        -------
+        state : str or None
+            ``None`` if the block was claimed by this worker. Otherwise, the
+            state which prevented the claim (``'done'``, ``'err'``, or
+            ``'lck'``).
+        '''
+
+        state = self.get_state(start, stop)
+        if state is not None:
+            return state
+
+        path = self._path(_unit(start, stop), 'lck')
+        token = '{} {} {!r} {}'.format(
+            socket.gethostname(), os.getpid(), time.time(), uuid.uuid4().hex)
+
+        try:
+            with exclusive_open(path) as f:
+                f.write(token)
+
+        except OSError:
+            if not self._take_over(path):
+                return 'lck'
+
+            try:
+                with exclusive_open(path) as f:
+                    f.write(token)
+
+            except OSError:
+                return 'lck'
+
+        self._hold(start, stop, token)
+
+        # Check for race conditions
+        state = self.get_state(start, stop)
+        if state is not None:
+            self.release(start, stop)
+            return state
+
+    def _expired(self, path):
+        return time.time() - os.stat(path).st_mtime > self.lease
+
+    def _take_over(self, path):
+        '''
+        Remove a lock file whose lease has expired
+
+        The lock file is first renamed, so that only one of several workers
+        trying to take it over at once succeeds. If its holder refreshed it
+        just before it was renamed, it is put back.
+
+        Returns
+        -------
+        removed : bool
+        '''
+
+        if self.lease is None:
+            return False
+
+        stale = '{}.{}.stale'.format(path, uuid.uuid4().hex)
+
+        try:
+            if not self._expired(path):
+                return False
+
+            os.rename(path, stale)
+
+        except OSError:
+            return False
+
+        try:
+            if not self._expired(stale):
+                try:
+                    os.link(stale, path)
+                except OSError:
+                    pass
+
+                return False
+
+        finally:
+            os.remove(stale)
+
+        return True
+
+    def refresh(self, start, stop=None, token=None):
+        '''
+        Renew the lease on a claimed block
+
+        Returns
+        -------
+        held : bool
+            False if the claim has been taken over by another worker
+        '''
+
+        path = self._path(_unit(start, stop), 'lck')
+
+        if token is None:
+            token = self._held().get(
+                (start, start + 1 if stop is None else stop))
+
+        if not self._owns(path, token):
+            return False
+
+        try:
+            os.utime(path, None)
+        except OSError:
+            return False
+
+        return True
+
+    def _owns(self, path, token):
+        # a claim this process doesn't know the token of is never its own
+        if token is None:
+            return False
+
+        try:
+            with open(path, 'r') as f:
+                return f.read() == token
+        except (IOError, OSError):
+            return False
+
+    def pending(self, start, stop=None):
+        '''
+        Task IDs in a claimed block which still need to be run
+
+        Per-task state is not checked inside a block, so a block which was
+        interrupted before completing is re-run in full.
+        '''
+
+        return list(range(start, start + 1 if stop is None else stop))
+
+    def release(self, start, stop=None):
+        '''
+        Remove the claim on a block, unless another worker has taken it over
+        '''
+
+        path = self._path(_unit(start, stop), 'lck')
+        token = self._unhold(start, stop)
+
+        if self._owns(path, token):
+            os.remove(path)
+
+    def complete(self, start, stop=None):
+        '''
+        Mark a block as done
+
+        Returns
+        -------
+        committed : bool
+            False if the block had already been finished by another attempt
+        '''
+
+        unit = _unit(start, stop)
+
+        if unit == str(start) and os.path.exists(self._path(unit, 'err')):
+            return False
+
+        try:
+            with exclusive_open(self._path(unit, 'done')):
+                pass
+
+        except OSError:
+            return False
+
+        return True
+
+    def fail(self, task_id):
+        if os.path.exists(self._path(task_id, 'done')):
+            return
+
+        with open(self._path(task_id, 'err'), 'w+'):
+            pass
+
+    def running(self, blocks):
+        '''
+        Blocks from a list of ``(start, stop)`` which are claimed and not yet
+        done
+
+        Returns
+        -------
+        running : list of tuple
+            ``(start, stop, claimed)`` for each running block, where
+            ``claimed`` is the time at which the block was claimed
+        '''
+
+        running = []
+
+        for start, stop in blocks:
+            path = self._path(_unit(start, stop), 'lck')
+
+            try:
+                with open(path, 'r') as f:
+                    token = f.read().split()
+
+                claimed = (
+                    float(token[2]) if len(token) == 4
+                    else os.path.getmtime(path))
+
+            except (IOError, OSError, ValueError):
+                continue
+
+            if not self.is_done(start, stop):
+                running.append((start, stop, claimed))
+
+        return running
+
+    def duplicate(self, start, stop=None):
+        '''
+        Register a duplicate attempt at a claimed block
+
+        Returns
+        -------
+        registered : bool
+            False if another duplicate attempt has already been registered
+        '''
+
+        try:
+            with exclusive_open(self._path(_unit(start, stop), 'dup')) as f:
+                f.write('{} {}'.format(socket.gethostname(), os.getpid()))
+
+        except OSError:
+            return False
+
+        return True
+
+    def is_done(self, start, stop=None):
+        return os.path.exists(self._path(_unit(start, stop), 'done'))
+
+    def scan(self, num_jobs):
+        '''
+        Read the state of every task in a single pass over the locks directory
+
+        Returns
+        -------
+        tasks : dict
+            Sets of task IDs in the ``'lck'``, ``'done'``, and ``'err'``
+            states. Tasks in a completed block which errored are reported as
+            ``'err'`` only.
+        '''
+
+        prefix = '{}-{}-'.format(self.job_name, self.job_id)
+        tasks = {'lck': set(), 'done': set(), 'err': set()}
+
+        for fname in iterdir(self.lockdir):
+            if not fname.startswith(prefix):
+                continue
+
+            unit, _, state = fname[len(prefix):].rpartition('.')
+            start, _, last = unit.partition('_')
+
+            if (state not in tasks) or not (start + last).isdigit():
+                continue
+
+            tasks[state].update(
+                range(int(start), min(int(last or start) + 1, num_jobs)))
+
+        tasks['done'] -= tasks['err']
+        tasks['lck'] -= (tasks['done'] | tasks['err'])
+
+        return tasks
+
+    def counts(self, num_jobs):
+        '''
+        Count tasks in each state
+
+        Returns
+        -------
+        counts : dict
+            Number of tasks in ``'lck'``, ``'done'``, and ``'err'`` states
+        '''
+
+        return {
+            state: len(ids) for state, ids in self.scan(num_jobs).items()}
+
+
+class SQLiteStateStore(StateStore):
+    '''
+    Task state stored in a SQLite database
+
+    All jobs share a single ``tasks`` table keyed on
+    ``(job_name, job_id, task_id)``. A task which has never been claimed (or
+    whose claim was released) has no row. Claiming a task inserts its row, so
+    a claim is a single atomic statement which fails if any other worker holds
+    or has finished the task.
+
+    The database is opened in WAL mode so that readers (``status``, ``wait``)
+    do not block workers. Note that WAL requires all processes to be able to
+    share memory-mapped files, which rules out some network filesystems.
+
+    Parameters
+    ----------
+
+    job_name : str
+    job_id : str
+    path : str, optional
+        Path to the database file (default ``'locks/jrnr.db'``)
+    timeout : float, optional
+        Seconds to wait for a competing write transaction (default 60)
+    lease : float, optional
+        Seconds after which a claim which has not been refreshed may be taken
+        over by another worker. Default (None) never expires claims.
+    '''
+
+    def __init__(
+            self,
+            job_name,
+            job_id,
+            path='locks/jrnr.db',
+            timeout=60,
+            lease=None):
+
+        self.job_name = job_name
+        self.job_id = str(job_id)
+        self.path = path
+        self.timeout = timeout
+        self.lease = lease
+
+        self._local = threading.local()
+
+    @property
+    def watchdir(self):
+        return os.path.dirname(self.path) or '.'
+
+    @property
+    def conn(self):
+        # connections must not be shared between threads or forked children
+        local = self._local
+
+        if getattr(local, 'pid', None) != os.getpid():
+            local.conn = sqlite3.connect(
+                self.path, timeout=self.timeout, isolation_level=None)
+            local.conn.execute('PRAGMA journal_mode=WAL')
+            local.conn.execute(
+                'CREATE TABLE IF NOT EXISTS tasks ('
+                'job_name TEXT NOT NULL, '
+                'job_id TEXT NOT NULL, '
+                'task_id INTEGER NOT NULL, '
+                'state TEXT NOT NULL, '
+                'host TEXT, '
+                'pid INTEGER, '
+                'updated REAL, '
+                'claimed REAL, '
+                'PRIMARY KEY (job_name, job_id, task_id))')
+            local.conn.execute(
+                'CREATE TABLE IF NOT EXISTS duplicates ('
+                'job_name TEXT NOT NULL, '
+                'job_id TEXT NOT NULL, '
+                'start INTEGER NOT NULL, '
+                'stop INTEGER NOT NULL, '
+                'host TEXT, '
+                'pid INTEGER, '
+                'PRIMARY KEY (job_name, job_id, start, stop))')
+            local.pid = os.getpid()
+
+        return local.conn
+
+    def setup(self):
+        dirname = os.path.dirname(self.path)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+
+    def _key(self, task_id):
+        return (self.job_name, self.job_id, task_id)
+
+    def _states(self, start, stop=None):
+        return [row[0] for row in self.conn.execute(
+            'SELECT state FROM tasks '
+            'WHERE job_name=? AND job_id=? AND task_id>=? AND task_id<?',
+            (self.job_name, self.job_id, start,
+                start + 1 if stop is None else stop))]
+
+    @staticmethod
+    def _finished(states, start, stop=None):
+        # A single task is done if it succeeded. A block of tasks is done once
+        # every task in it has either succeeded or errored.
+        stop = start + 1 if stop is None else stop
+
+        if stop - start == 1:
+            return states[0] if states in (['done'], ['err']) else None
+
+        if len(states) == stop - start and 'lck' not in states:
+            return 'done'
+
+    def get_state(self, start, stop=None):
+        '''
+        Return ``'done'`` or ``'err'`` for finished blocks, else ``None``
+        '''
+
+        return self._finished(self._states(start, stop), start, stop)
+
+    def claim(self, start, stop=None):
+        '''
+        Attempt to claim a block of tasks
+
+        The block is checked and claimed inside a single write transaction.
+        Tasks in the block which already succeeded or errored (e.g. in an
+        interrupted earlier attempt at the block) are not claimed again.
+
+        Returns
+        -------
+        state : str or None
+            ``None`` if the block was claimed by this worker. Otherwise, the
+            state which prevented the claim (``'done'``, ``'err'``, or
+            ``'lck'``).
+        '''
+
+        stop = start + 1 if stop is None else stop
+        now = time.time()
+
+        with self.conn:
+            self.conn.execute('BEGIN IMMEDIATE')
+
+            if self.lease is not None:
+                self.conn.execute(
+                    'DELETE FROM tasks '
+                    'WHERE job_name=? AND job_id=? AND task_id>=? '
+                    'AND task_id<? AND state=? AND updated<?',
+                    (self.job_name, self.job_id, start, stop, 'lck',
+                        now - self.lease))
+
+            states = self._states(start, stop)
+            if 'lck' in states:
+                return 'lck'
+
+            state = self._finished(states, start, stop)
+            if state is not None:
+                return state
+
+            self.conn.executemany(
+                'INSERT OR IGNORE INTO tasks VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                [
+                    self._key(task_id) + ('lck', ) + self._owner() +
+                    (now, now)
+                    for task_id in range(start, stop)])
+
+        self._hold(start, stop)
+
+    def _owner(self):
+        return (socket.gethostname(), os.getpid())
+
+    def refresh(self, start, stop=None, token=None):
+        '''
+        Renew the lease on a claimed block
+
+        Returns
+        -------
+        held : bool
+            False if the claim has been taken over by another worker
+        '''
+
+        cursor = self.conn.execute(
+            'UPDATE tasks SET updated=? '
+            'WHERE job_name=? AND job_id=? AND task_id>=? AND task_id<? '
+            'AND state=? AND host=? AND pid=?',
+            (time.time(), self.job_name, self.job_id, start,
+                start + 1 if stop is None else stop, 'lck') + self._owner())
+
+        return cursor.rowcount > 0
+
+    def pending(self, start, stop=None):
+        '''
+        Task IDs in a claimed block which still need to be run
+        '''
+
+        return [row[0] for row in self.conn.execute(
+            'SELECT task_id FROM tasks '
+            'WHERE job_name=? AND job_id=? AND task_id>=? AND task_id<? '
+            'AND state=? ORDER BY task_id',
+            (self.job_name, self.job_id, start,
+                start + 1 if stop is None else stop, 'lck'))]
+
+    def release(self, start, stop=None):
+        '''
+        Remove the claim on a block, unless another worker has taken it over
+        '''
+
+        self._unhold(start, stop)
+
+        self.conn.execute(
+            'DELETE FROM tasks '
+            'WHERE job_name=? AND job_id=? AND task_id>=? AND task_id<? '
+            'AND state=? AND host=? AND pid=?',
+            (self.job_name, self.job_id, start,
+                start + 1 if stop is None else stop, 'lck') + self._owner())
+
+    def complete(self, start, stop=None):
+        '''
+        Mark the claimed tasks in a block as done
+
+        Returns
+        -------
+        committed : bool
+            False if the block had already been finished by another attempt
+        '''
+
+        cursor = self.conn.execute(
+            'UPDATE tasks SET state=?, updated=? '
+            'WHERE job_name=? AND job_id=? AND task_id>=? AND task_id<? '
+            'AND state=?',
+            ('done', time.time(), self.job_name, self.job_id, start,
+                start + 1 if stop is None else stop, 'lck'))
+
+        return cursor.rowcount > 0
+
+    def fail(self, task_id):
+        self.conn.execute(
+            'UPDATE tasks SET state=?, updated=? '
+            'WHERE job_name=? AND job_id=? AND task_id=? AND state=?',
+            ('err', time.time()) + self._key(task_id) + ('lck', ))
+
+    def running(self, blocks):
+        '''
+        Blocks from a list of ``(start, stop)`` which are claimed and not yet
+        done
+
+        Returns
+        -------
+        running : list of tuple
+            ``(start, stop, claimed)`` for each running block, where
+            ``claimed`` is the time at which the block was claimed
+        '''
+
+        if not blocks:
+            return []
+
+        claimed = dict(self.conn.execute(
+            'SELECT task_id, claimed FROM tasks '
+            'WHERE job_name=? AND job_id=? AND task_id>=? AND task_id<? '
+            'AND state=?',
+            (self.job_name, self.job_id, min(b[0] for b in blocks),
+                max(b[1] for b in blocks), 'lck')))
+
+        running = []
+
+        for start, stop in blocks:
+            times = [claimed[i] for i in range(start, stop) if i in claimed]
+
+            if times:
+                running.append((start, stop, min(times)))
+
+        return running
+
+    def duplicate(self, start, stop=None):
+        '''
+        Register a duplicate attempt at a claimed block
+
+        Returns
+        -------
+        registered : bool
+            False if another duplicate attempt has already been registered
+        '''
+
+        cursor = self.conn.execute(
+            'INSERT OR IGNORE INTO duplicates VALUES (?, ?, ?, ?, ?, ?)',
+            (self.job_name, self.job_id, start,
+                start + 1 if stop is None else stop) + self._owner())
+
+        return cursor.rowcount > 0
+
+    def is_done(self, start, stop=None):
+        return self.get_state(start, stop) == 'done'
+
+    def scan(self, num_jobs):
+        '''
+        Read the state of every task with a single query
+
+        Returns
+        -------
+        tasks : dict
+            Sets of task IDs in the ``'lck'``, ``'done'``, and ``'err'``
+            states
+        '''
+
+        tasks = {'lck': set(), 'done': set(), 'err': set()}
+
+        for task_id, state in self.conn.execute(
+                'SELECT task_id, state FROM tasks '
+                'WHERE job_name=? AND job_id=? AND task_id<?',
+                (self.job_name, self.job_id, num_jobs)):
+            tasks[state].add(task_id)
+
+        return tasks
+
+    def counts(self, num_jobs):
+        '''
+        Count tasks in each state
+
+        Returns
+        -------
+        counts : dict
+            Number of tasks in ``'lck'``, ``'done'``, and ``'err'`` states
+        '''
+
+        counts = {'lck': 0, 'done': 0, 'err': 0}
+        counts.update(self.conn.execute(
+            'SELECT state, COUNT(*) FROM tasks '
+            'WHERE job_name=? AND job_id=? AND task_id<? '
+            'GROUP BY state',
+            (self.job_name, self.job_id, num_jobs)).fetchall())
+
+        return counts
+
+
+def get_state_store(
+        job_name, job_id, backend='file', state_db=None, lease=None):
+    '''
+    Create a state store for a job
+
+    Parameters
+    ----------
+
+    job_name : str
+    job_id : str
+    backend : str, optional
+        One of ``'file'`` (default) or ``'sqlite'``
+    state_db : str, optional
+        Path to the SQLite database. Only used by the ``'sqlite'`` backend.
+    lease : float, optional
+        Seconds after which unrefreshed claims expire (default never)
+
+    Examples
+    --------
+
+    .. code-block:: python
+
+        >>> get_state_store('tas', '001')  # doctest: +ELLIPSIS
+        <jrnr.state.FileStateStore object at ...>
+
+    '''
+
+    if backend == 'file':
+        return FileStateStore(job_name, job_id, lease=lease)
+
+    elif backend == 'sqlite':
+        if state_db is None:
+            return SQLiteStateStore(job_name, job_id, lease=lease)
+
+        return SQLiteStateStore(job_name, job_id, path=state_db, lease=lease)
+
+    raise ValueError('Unrecognized state backend: {}'.format(backend))
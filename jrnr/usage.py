@@ -0,0 +1,238 @@
+'''
+Per-task resource accounting
+
+Each worker process appends one JSON record per task to its own file,
+``{logdir}/usage-{job_name}-{job_id}-{host}-{pid}.jsonl``, so workers never
+contend for a file. ``read_usage`` merges the files of a job.
+
+Memory and I/O are measured for the whole worker process, so when a worker
+runs several tasks at once in threads, they are shared between those tasks.
+'''
+
+from __future__ import absolute_import
+
+import os
+import json
+import time
+import socket
+import threading
+
+from jrnr._compat import (
+    iterdir, reset_peak_rss, get_peak_rss, get_cpu_time, get_io)
+
+
+class TaskUsage(object):
+    '''
+    Measure the resources used within a context
+
+    Examples
+    --------
+
+    .. code-block:: python
+
+        >>> with TaskUsage() as usage:
+        ...     total = sum(range(1000))
+        ...
+        >>> sorted(usage.record.keys())  # doctest: +NORMALIZE_WHITESPACE
+        ['cpu', 'end', 'max_rss', 'read_bytes', 'start', 'wall',
+        'write_bytes']
+
+    '''
+
+    def __init__(self):
+        self.record = {}
+
+    def __enter__(self):
+        reset_peak_rss()
+
+        self._io = get_io()
+        self._cpu = get_cpu_time()
+        self._start = time.time()
+
+        return self
+
+    def __exit__(self, *exc):
+        end = time.time()
+        io = get_io()
+
+        self.record = {
+            'start': self._start,
+            'end': end,
+            'wall': end - self._start,
+            'cpu': get_cpu_time() - self._cpu,
+            'max_rss': get_peak_rss(),
+            'read_bytes': None,
+            'write_bytes': None}
+
+        if io is not None and self._io is not None:
+            for field in ('read_bytes', 'write_bytes'):
+                self.record[field] = io[field] - self._io[field]
+
+
+class UsageLog(object):
+    '''
+    Append-only JSONL file of task usage records for the current process
+
+    The file is opened on first use, and reopened under a new name if the
+    process has been forked since. Records can be written from several
+    threads.
+
+    Parameters
+    ----------
+
+    logdir : str
+    job_name : str
+    job_id : str
+    '''
+
+    def __init__(self, logdir, job_name, job_id):
+        self.logdir = logdir
+        self.job_name = job_name
+        self.job_id = job_id
+
+        self._file = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def path(self):
+        return os.path.join(
+            self.logdir,
+            'usage-{}-{}-{}-{}.jsonl'.format(
+                self.job_name, self.job_id, socket.gethostname(),
+                os.getpid()))
+
+    def write(self, record):
+        '''
+        Append a record, tagged with the host and process ID
+        '''
+
+        record = dict(record, host=socket.gethostname(), pid=os.getpid())
+        line = json.dumps(record, sort_keys=True) + '\n'
+
+        with self._lock:
+            if self._pid != os.getpid():
+                # don't close a file inherited from the parent process
+                self._file = open(self.path, 'a')
+                self._pid = os.getpid()
+
+            self._file.write(line)
+            self._file.flush()
+
+
+def read_usage(logdir, job_name, job_id=None):
+    '''
+    Read the usage records of every worker of a job
+
+    If ``job_id`` is None, reads the records of every run of jobs named
+    ``job_name``.
+
+    Lines which can't be parsed, such as a partial record written by a worker
+    which was killed, are skipped.
+
+    Returns
+    -------
+    records : list of dict
+        Records sorted by task ID and start time
+    '''
+
+    if job_id is None:
+        prefix = 'usage-{}-'.format(job_name)
+    else:
+        prefix = 'usage-{}-{}-'.format(job_name, job_id)
+
+    records = []
+
+    if not os.path.isdir(logdir):
+        return records
+
+    for fname in iterdir(logdir):
+        if not (fname.startswith(prefix) and fname.endswith('.jsonl')):
+            continue
+
+        with open(os.path.join(logdir, fname), 'r') as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    continue
+
+    return sorted(
+        records, key=lambda r: (r.get('task_id', -1), r.get('start', 0)))
+
+
+def _latest(records):
+    '''
+    The most recent record of each task
+    '''
+
+    latest = {}
+
+    for record in records:
+        task_id = record.get('task_id')
+
+        if (task_id not in latest) or (
+                record.get('start', 0) >= latest[task_id].get('start', 0)):
+            latest[task_id] = record
+
+    return [latest[k] for k in sorted(latest, key=lambda k: (k is None, k))]
+
+
+def summarize(records, slowest=5):
+    '''
+    Summarize the usage records of a job
+
+    Only the most recent attempt at each task is counted.
+
+    Examples
+    --------
+
+    .. code-block:: python
+
+        >>> summary = summarize([
+        ...     {'task_id': 0, 'status': 'done', 'start': 0, 'wall': 10,
+        ...      'cpu': 5, 'max_rss': 2**20},
+        ...     {'task_id': 1, 'status': 'err', 'start': 0, 'wall': 30,
+        ...      'cpu': 30, 'max_rss': 2**21},
+        ...     {'task_id': 1, 'status': 'done', 'start': 60, 'wall': 20,
+        ...      'cpu': 10, 'max_rss': 2**20}])
+        ...
+        >>> summary['tasks'], summary['wall_total'], summary['max_rss']
+        (2, 30, 2097152)
+
+        >>> summary['slowest']
+        [[1, 20], [0, 10]]
+
+    '''
+
+    latest = _latest(records)
+
+    def total(field, rows):
+        return sum(r.get(field) or 0 for r in rows)
+
+    statuses = {}
+    for record in latest:
+        status = record.get('status')
+        statuses[status] = statuses.get(status, 0) + 1
+
+    wall = total('wall', latest)
+    cpu = total('cpu', latest)
+
+    return {
+        'tasks': len(latest),
+        'attempts': len(records),
+        'done': statuses.get('done', 0),
+        'errored': statuses.get('err', 0),
+        'cached': statuses.get('cached', 0),
+        'wall_total': wall,
+        'wall_mean': float(wall) / len(latest) if latest else 0,
+        'wall_max': max([r.get('wall') or 0 for r in latest] or [0]),
+        'cpu_total': cpu,
+        'cpu_efficiency': float(cpu) / wall if wall else None,
+        'max_rss': max([r.get('max_rss') or 0 for r in records] or [0]),
+        'read_bytes': total('read_bytes', records),
+        'write_bytes': total('write_bytes', records),
+        'slowest': [
+            [r.get('task_id'), r.get('wall')]
+            for r in sorted(
+                latest, key=lambda r: -(r.get('wall') or 0))[:slowest]]}
@@ -43,6 +43,7 @@ setup(
     },
     include_package_data=True,
     install_requires=requirements,
+    python_requires='>=3.4',
     license="MIT license",
     zip_safe=False,
     keywords='jrnr',
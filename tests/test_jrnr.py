@@ -3,10 +3,24 @@
 
 """Tests for `jrnr` package."""
 
+import os
+import json
+import logging
+import time
+import socket
+import sqlite3
+import threading
+import multiprocessing
 import pytest
 from click.testing import CliRunner
 
+import jrnr.spec
+import jrnr._compat
 from jrnr import cli
+from jrnr.spec import JobSpec
+from jrnr import memoize, stage_output
+from jrnr.jrnr import slurm_runner, generate_jobs
+from jrnr.state import get_state_store
 
 
 @pytest.fixture
@@ -34,3 +48,1199 @@ def test_command_line_interface():
     help_result = runner.invoke(cli.main, ['--help'])
     assert help_result.exit_code == 0
     assert '--help  Show this message and exit.' in help_result.output
+
+
+JOB_SPEC = (
+    [{'model': 'a'}, {'model': 'b'}, {'model': 'c'}],
+    [{'year': y} for y in range(2000, 2004)])
+
+
+@pytest.fixture
+def workdir(tmpdir):
+    with tmpdir.as_cwd():
+        yield tmpdir
+
+
+@pytest.fixture
+def runner():
+    completed = []
+
+    @slurm_runner(job_spec=JOB_SPEC, return_index=True)
+    def run_job(metadata, model, year, task_id, interactive=False):
+        if model == 'c' and year == 2000:
+            raise ValueError('bad input')
+
+        completed.append(task_id)
+
+    run_job.completed = completed
+
+    return run_job
+
+
+def test_do_job_staggered_workers(workdir, runner):
+    """Workers with different ranks together complete every task once"""
+    cli = CliRunner()
+
+    for worker in range(3):
+        result = cli.invoke(runner, [
+            'do_job', '--job_name', 'test', '--job_id', '1',
+            '--num_jobs', '12', '--worker_index', str(worker),
+            '--workers_per_node', '3'])
+
+        assert result.exit_code == 0
+
+    assert runner.completed[:4] == [0, 3, 6, 9]
+    assert sorted(runner.completed) == [i for i in range(12) if i != 8]
+    assert len(os.listdir('locks')) == 12
+
+
+def test_prep_passes_worker_options(workdir, runner):
+    result = CliRunner().invoke(
+        runner, ['prep', '-j', 'test', '-u', '1', '-n', '4', '-x', '2'])
+
+    assert result.exit_code == 0
+
+    script = workdir.join('run-slurm.sh').read()
+
+    assert '--num_jobs 12' in script
+    assert '--node_index ${SLURM_ARRAY_TASK_ID} --num_nodes 2' in script
+    assert '--workers 4' in script
+
+
+@pytest.mark.parametrize('backend', ['file', 'sqlite'])
+def test_state_backends(workdir, runner, backend):
+    cli = CliRunner()
+
+    result = cli.invoke(runner, [
+        'do_job', '--job_name', 'test', '--job_id', '1', '--num_jobs', '5',
+        '--backend', backend])
+
+    assert result.exit_code == 0
+    assert sorted(runner.completed) == list(range(5))
+
+    result = cli.invoke(runner, [
+        'do_job', '--job_name', 'test', '--job_id', '1', '--num_jobs', '5',
+        '--backend', backend])
+
+    assert '4 already done. skipping' in result.output
+    assert len(runner.completed) == 5
+
+    result = cli.invoke(
+        runner, ['status', '-j', 'test', '-u', '1', '--backend', backend])
+
+    assert result.exit_code == 0
+    assert result.output.split() == [
+        'jobs:', '12', 'done:', '5', 'in', 'progress:', '0', 'errored:', '0']
+
+
+@pytest.mark.parametrize('backend', ['file', 'sqlite'])
+def test_claim_batch(workdir, runner, backend):
+    cli = CliRunner()
+    args = [
+        'do_job', '--job_name', 'test', '--job_id', '1', '--num_jobs', '12',
+        '--claim_batch', '5', '--backend', backend]
+
+    result = cli.invoke(runner, args)
+
+    assert result.exit_code == 0
+    assert sorted(runner.completed) == [i for i in range(12) if i != 8]
+
+    if backend == 'file':
+        assert sorted(os.listdir('locks')) == [
+            'test-1-0_4.done', 'test-1-10_11.done', 'test-1-5_9.done',
+            'test-1-8.err']
+
+    result = cli.invoke(runner, args)
+    assert 'tasks 5-9 already done. skipping' in result.output
+
+    result = cli.invoke(
+        runner, ['status', '-j', 'test', '-u', '1', '--backend', backend])
+
+    assert result.output.split() == [
+        'jobs:', '12', 'done:', '11', 'in', 'progress:', '0', 'errored:', '1']
+
+    result = cli.invoke(runner, [
+        'wait', '--job_name', 'test', '--job_id', '1', '--num_jobs', '12',
+        '--claim_batch', '5', '--backend', backend])
+
+    assert result.exit_code == 0
+
+
+def test_status_json(workdir, runner):
+    os.makedirs('locks')
+
+    for fname in [
+            'test-1-0.done', 'test-1-1.lck', 'test-1-4_7.done', 'test-1-5.err',
+            'test-1-2-3.done', 'test-12-3.done', 'other-1-3.done']:
+        workdir.join('locks', fname).write('')
+
+    result = CliRunner().invoke(
+        runner, ['status', '-j', 'test', '-u', '1', '--json'])
+
+    assert result.exit_code == 0
+    assert json.loads(result.output) == {
+        'job_name': 'test', 'job_id': '1', 'jobs': 12,
+        'done': 4, 'in_progress': 1, 'errored': 1}
+
+
+def test_wait_returns_when_tasks_complete(workdir, runner):
+    os.makedirs('locks')
+    workdir.join('locks', 'test-1-0.done').write('')
+
+    def finish():
+        for fname in ['test-1-2.done', 'test-1-3.err', 'test-1-1.done']:
+            time.sleep(0.05)
+            workdir.join('locks', fname).write('')
+
+    thread = threading.Thread(target=finish)
+    thread.start()
+
+    start = time.time()
+    result = CliRunner().invoke(runner, [
+        'wait', '--job_name', 'test', '--job_id', '1', '--num_jobs', '3',
+        '--interval', '0.05'])
+    thread.join()
+
+    assert result.exit_code == 0
+    assert time.time() - start < 5
+    assert workdir.join('locks', 'test-1-1.done').check()
+
+
+def test_do_job_forked_workers(workdir, runner):
+    result = CliRunner().invoke(runner, [
+        'do_job', '--job_name', 'test', '--job_id', '1', '--num_jobs', '12',
+        '--workers', '3'])
+
+    # task 8 errors inside a worker, which is not a worker failure
+    assert result.exit_code == 0
+    assert sorted(os.listdir('locks')) == sorted(
+        ['test-1-{}.done'.format(i) for i in range(12) if i != 8] +
+        ['test-1-8.err'])
+
+
+def test_do_job_recycles_workers(workdir):
+
+    @slurm_runner(job_spec=JOB_SPEC, return_index=True)
+    def record_pid(metadata, model, year, task_id, interactive=False):
+        workdir.join('pid-{}'.format(task_id)).write(str(os.getpid()))
+
+    result = CliRunner().invoke(record_pid, [
+        'do_job', '--job_name', 'test', '--job_id', '1', '--num_jobs', '12',
+        '--workers', '2', '--max_tasks_per_worker', '2'])
+
+    assert result.exit_code == 0
+    assert len(os.listdir('locks')) == 12
+
+    pids = [workdir.join('pid-{}'.format(i)).read() for i in range(12)]
+
+    assert all(pids.count(pid) <= 2 for pid in pids)
+    assert len(set(pids)) >= 6
+
+
+@pytest.mark.parametrize('backend', ['file', 'sqlite'])
+def test_do_job_threads(workdir, backend):
+    logger = logging.getLogger('uploader')
+
+    @slurm_runner(job_spec=JOB_SPEC, return_index=True)
+    def sleepy(metadata, model, year, task_id, interactive=False):
+        logger.debug('running task {}'.format(task_id))
+        time.sleep(0.01)
+
+    result = CliRunner().invoke(sleepy, [
+        'do_job', '--job_name', 'test', '--job_id', '1', '--num_jobs', '12',
+        '--threads', '4', '--backend', backend])
+
+    assert result.exit_code == 0
+
+    result = CliRunner().invoke(
+        sleepy, ['status', '-j', 'test', '-u', '1', '--backend', backend])
+    assert result.output.split()[3] == '12'
+
+    for i in range(12):
+        log = workdir.join('log', 'run-test-1-{}.log'.format(i)).read()
+        assert 'running task {}\n'.format(i) in log
+        assert log.count('running task') == 1
+
+
+def test_local(workdir, runner):
+    cli = CliRunner()
+
+    result = cli.invoke(runner, [
+        'local', '-j', 'test', '-u', '1', '--start', '3', '--stop', '9',
+        '--workers', '2'])
+
+    assert result.exit_code == 0
+    assert sorted(os.listdir('locks')) == sorted(
+        ['test-1-{}.done'.format(i) for i in range(3, 9) if i != 8] +
+        ['test-1-8.err'])
+
+    # resuming the run picks up only the remaining tasks
+    result = cli.invoke(runner, ['local', '-j', 'test', '-u', '1'])
+
+    assert result.exit_code == 0
+    assert '5 already done. skipping' in result.output
+    assert len(os.listdir('locks')) == 12
+
+
+def test_workers_scan_other_slices(workdir, runner):
+    cli = CliRunner()
+    args = [
+        'local', '-j', 'test', '-u', '1', '--workers', '1', '--threads', '4']
+
+    cli.invoke(runner, args)
+    result = cli.invoke(runner, args)
+
+    # each worker only probes its own slice, and reads the state of the
+    # others' with a single scan
+    assert result.exit_code == 0
+    assert result.output.count('already done. skipping') == 11
+    assert result.output.count('previously errored. skipping') == 1
+
+
+@pytest.mark.parametrize('use_numpy', [True, False])
+def test_job_spec_decode_many(monkeypatch, use_numpy):
+    if not use_numpy:
+        monkeypatch.setattr(jrnr.spec, 'np', None)
+
+    spec = JobSpec(JOB_SPEC)
+    decoded = spec.decode_many(range(len(spec)))
+
+    assert [list(map(int, dim)) for dim in decoded] == [
+        [spec.decode(i)[d] for i in range(len(spec))] for d in range(2)]
+
+    assert [spec.get_job(i) for i in range(len(spec))] == list(
+        generate_jobs(JOB_SPEC))
+
+
+@pytest.mark.parametrize('use_numpy', [True, False])
+def test_derived_specs(monkeypatch, use_numpy):
+    if not use_numpy:
+        monkeypatch.setattr(jrnr.spec, 'np', None)
+
+    spec = JobSpec(JOB_SPEC).filter(exclude=[{'year': 2000}])
+    nested = spec.filter(filters=[lambda job: job['model'] != 'b'])
+
+    jobs = [nested.get_job(i) for i in range(len(nested))]
+    assert [(job['model'], job['year']) for job in jobs] == [
+        (model, year) for model in 'ac' for year in range(2001, 2004)]
+
+    # filtering a subset keeps its order
+    subset = JobSpec(JOB_SPEC).take([11, 0, 5, 4]).filter(
+        exclude=[{'year': 2000}])
+
+    assert [int(i) for i in subset.index] == [11, 5]
+
+    # grouping a subset keeps its tasks
+    grouped = JobSpec(JOB_SPEC).take([11, 0, 5, 4]).group(['year'])
+
+    assert [int(i) for i in grouped.index] == [11, 0, 4, 5]
+    assert grouped.groups == [0, 1, 3]
+
+
+def test_filtered_runner(workdir):
+    completed = []
+
+    @slurm_runner(
+        job_spec=JOB_SPEC,
+        filters=[lambda job: job['year'] >= 2002],
+        exclude=[{'model': 'b', 'year': 2003}])
+    def run_job(metadata, model, year, interactive=False):
+        completed.append((model, year))
+
+    cli = CliRunner()
+    result = cli.invoke(
+        run_job, ['prep', '-j', 'test', '-u', '1', '-n', '2', '-x', '10'])
+
+    assert result.exit_code == 0
+
+    script = workdir.join('run-slurm.sh').read()
+    assert '--num_jobs 5' in script
+    assert '#SBATCH --array=0-2' in script
+
+    result = cli.invoke(run_job, [
+        'do_job', '--job_name', 'test', '--job_id', '1', '--num_jobs', '5'])
+
+    assert result.exit_code == 0
+    assert sorted(completed) == [
+        ('a', 2002), ('a', 2003), ('b', 2002), ('c', 2002), ('c', 2003)]
+
+
+def test_runner_keeps_compiled_spec(workdir):
+
+    @slurm_runner(job_spec=JobSpec(JOB_SPEC).filter(
+        filters=[lambda job: job['model'] != 'c'],
+        exclude=[{'year': 2000}]))
+    def run_job(metadata, model, year, interactive=False):
+        pass
+
+    result = CliRunner().invoke(run_job, ['prep', '-j', 'test', '-u', '1'])
+
+    assert result.exit_code == 0
+    assert '--num_jobs 6' in workdir.join('run-slurm.sh').read()
+
+
+def test_skip_existing_outputs(workdir):
+    completed = []
+
+    @slurm_runner(job_spec=JOB_SPEC, output='out/{model}/{year}.txt')
+    def run_job(metadata, model, year, interactive=False):
+        completed.append((model, year))
+
+    for model in ['a', 'b']:
+        workdir.join('out', model).ensure(dir=True)
+
+        for year in range(2000, 2004):
+            workdir.join('out', model, '{}.txt'.format(year)).write('')
+
+    workdir.join('out', 'b', '2001.txt').remove()
+
+    cli = CliRunner()
+    result = cli.invoke(
+        run_job, ['prep', '-j', 'test', '-u', '1', '-n', '2', '-x', '10'])
+
+    assert result.exit_code == 0
+    assert '7 of 12 outputs already exist' in result.output
+    assert 'task IDs written to locks/tasks-test-' in result.output
+
+    script = workdir.join('run-slurm.sh').read()
+    assert '--num_jobs 5' in script
+
+    task_file = script.split('--task_file ')[1].split()[0]
+    task_ids = workdir.join(task_file).read().split()
+    assert task_ids == ['5', '8', '9', '10', '11']
+
+    result = cli.invoke(run_job, [
+        'do_job', '--job_name', 'test', '--job_id', '1', '--num_jobs', '5',
+        '--task_file', task_file])
+
+    assert result.exit_code == 0
+    assert sorted(completed) == [
+        ('b', 2001), ('c', 2000), ('c', 2001), ('c', 2002), ('c', 2003)]
+
+    result = cli.invoke(run_job, [
+        'status', '-j', 'test', '-u', '1', '--task_file', task_file, '--json'])
+
+    assert json.loads(result.output)['done'] == 5
+
+    # status finds the task file run under the job ID by itself
+    result = cli.invoke(run_job, ['status', '-j', 'test', '-u', '1', '--json'])
+
+    assert json.loads(result.output)['jobs'] == 5
+    assert json.loads(result.output)['done'] == 5
+
+    result = cli.invoke(
+        run_job,
+        ['prep', '-j', 'test', '-u', '2', '-n', '2', '--overwrite'])
+
+    assert '--num_jobs 12' in workdir.join('run-slurm.sh').read()
+    assert '--task_file' not in workdir.join('run-slurm.sh').read()
+
+
+def test_resume_with_task_file(workdir):
+    completed = []
+
+    @slurm_runner(job_spec=JOB_SPEC, output='out/{model}-{year}.txt')
+    def run_job(metadata, model, year, interactive=False):
+        completed.append((model, year))
+        workdir.join('out', '{}-{}.txt'.format(model, year)).write('')
+
+    workdir.join('out').ensure(dir=True)
+
+    cli = CliRunner()
+    result = cli.invoke(run_job, [
+        'local', '-j', 'test', '-u', '1', '--stop', '5', '--workers', '1'])
+
+    assert result.exit_code == 0
+    assert len(completed) == 5
+
+    # resuming on the cluster with the same job ID runs the remaining tasks,
+    # rather than mistaking them for the tasks finished locally
+    result = cli.invoke(run_job, ['prep', '-j', 'test', '-u', '1'])
+
+    script = workdir.join('run-slurm.sh').read()
+    task_file = script.split('--task_file ')[1].split()[0]
+
+    result = cli.invoke(run_job, [
+        'do_job', '--job_name', 'test', '--job_id', '1', '--num_jobs', '7',
+        '--task_file', task_file])
+
+    assert result.exit_code == 0
+    assert 'already done' not in result.output
+    assert sorted(completed) == sorted(
+        (model, year) for model in 'abc' for year in range(2000, 2004))
+
+    result = cli.invoke(run_job, [
+        'status', '-j', 'test', '-u', '1', '--task_file', task_file, '--json'])
+
+    assert json.loads(result.output)['done'] == 7
+
+
+def test_result_cache(workdir):
+    completed = []
+
+    workdir.join('inputs').ensure(dir=True)
+    for year in range(2000, 2004):
+        workdir.join('inputs', '{}.txt'.format(year)).write('')
+
+    @slurm_runner(
+        job_spec=JOB_SPEC,
+        output='out/{model}_{year}.txt',
+        cache='cache',
+        cache_outputs=True,
+        inputs=['inputs/{year}.txt'])
+    def run_job(metadata, model, year, interactive=False):
+        completed.append((model, year))
+
+        if not os.path.isdir('out'):
+            os.makedirs('out')
+
+        with open('out/{}_{}.txt'.format(model, year), 'w') as f:
+            f.write(model)
+
+    cli = CliRunner()
+
+    def run(job_id, *args):
+        result = cli.invoke(run_job, [
+            'local', '-j', 'test', '-u', job_id, '--workers', '1'] +
+            list(args))
+        assert result.exit_code == 0
+
+    run('1')
+    assert len(completed) == 12
+
+    # cached results are reused, and missing outputs restored from the cache
+    workdir.join('out', 'b_2001.txt').remove()
+    run('2')
+    assert len(completed) == 12
+    assert workdir.join('out', 'b_2001.txt').read() == 'b'
+
+    # outputs which were overwritten or truncated since are restored too
+    workdir.join('out', 'c_2000.txt').write('edited')
+    workdir.join('out', 'c_2001.txt').write('')
+    run('5')
+    assert len(completed) == 12
+    assert workdir.join('out', 'c_2000.txt').read() == 'c'
+    assert workdir.join('out', 'c_2001.txt').read() == 'c'
+
+    # an output with the same contents but a new modification time is
+    # recognized by its hash
+    later = time.time() + 10
+    os.utime(str(workdir.join('out', 'a_2000.txt')), (later, later))
+    run('6')
+    assert len(completed) == 12
+
+    # modifying an input invalidates the results which read it
+    later = time.time() + 10
+    os.utime(str(workdir.join('inputs', '2002.txt')), (later, later))
+    del completed[:]
+    run('3')
+    assert sorted(completed) == [('a', 2002), ('b', 2002), ('c', 2002)]
+
+    del completed[:]
+    run('4', '--no_cache')
+    assert len(completed) == 12
+
+    result = cli.invoke(run_job, ['cache_clean', '--max_size', '0'])
+    assert result.exit_code == 0
+    assert 'removed 15 cached results' in result.output
+
+
+def test_result_cache_without_outputs(workdir):
+    completed = []
+
+    @slurm_runner(
+        job_spec=JOB_SPEC, output='out/{model}_{year}.txt', cache='cache')
+    def run_job(metadata, model, year, interactive=False):
+        completed.append((model, year))
+        workdir.join('out', '{}_{}.txt'.format(model, year)).write(model)
+
+    workdir.join('out').ensure(dir=True)
+
+    cli = CliRunner()
+
+    def run(job_id):
+        result = cli.invoke(run_job, [
+            'local', '-j', 'test', '-u', job_id, '--workers', '1'])
+        assert result.exit_code == 0
+
+    run('1')
+    run('2')
+    assert len(completed) == 12
+    assert not list(workdir.join('cache').visit('*.out'))
+
+    # outputs which are missing or changed are not restored, so their tasks
+    # run again
+    workdir.join('out', 'a_2000.txt').remove()
+    workdir.join('out', 'b_2000.txt').write('edited')
+    run('3')
+    assert sorted(completed[12:]) == [('a', 2000), ('b', 2000)]
+
+
+def test_result_cache_formats_paths_from_arguments(workdir):
+    completed = []
+
+    @slurm_runner(
+        job_spec=JOB_SPEC,
+        output='out/{model}_{year:05d}.txt',
+        cache='cache',
+        inputs=[lambda job: 'inputs/{}.txt'.format(job['year'] - 2000)])
+    def run_job(metadata, model, year, interactive=False):
+        completed.append((model, year))
+        workdir.join('out', '{}_{:05d}.txt'.format(model, year)).write(model)
+
+    workdir.join('out').ensure(dir=True)
+
+    cli = CliRunner()
+
+    for job_id in ['1', '2']:
+        result = cli.invoke(run_job, [
+            'local', '-j', 'test', '-u', job_id, '--workers', '1'])
+
+        assert result.exit_code == 0
+        assert not [f for f in os.listdir('locks') if f.endswith('.err')]
+
+    # the second run is served from the cache
+    assert len(completed) == 12
+    assert workdir.join('out', 'c_02003.txt').read() == 'c'
+
+
+def test_usage_report(runner, workdir):
+    cli = CliRunner()
+
+    result = cli.invoke(runner, [
+        'local', '-j', 'test', '-u', '1', '--workers', '2'])
+
+    assert result.exit_code == 0
+
+    usage_files = [
+        f for f in os.listdir('log') if f.startswith('usage-test-1-')]
+
+    assert len(usage_files) == 2
+
+    result = cli.invoke(runner, [
+        'report', '-j', 'test', '-u', '1', '--json', '--merge', 'usage.jsonl'])
+
+    assert result.exit_code == 0
+
+    summary = json.loads(result.output)
+    assert summary['tasks'] == 12
+    assert summary['done'] == 11
+    assert summary['errored'] == 1
+    assert summary['max_rss'] > 0
+
+    with open('usage.jsonl') as f:
+        records = [json.loads(line) for line in f]
+
+    assert [r['task_id'] for r in records] == list(range(12))
+    assert records[8]['status'] == 'err'
+    assert all(r['wall'] >= 0 and r['cpu'] >= 0 for r in records)
+
+    result = cli.invoke(runner, ['report', '-j', 'test', '-u', '1'])
+    assert 'errored:       1' in result.output
+
+
+def test_cpu_time_without_resource(monkeypatch):
+    monkeypatch.setattr(jrnr._compat, 'resource', None)
+
+    assert jrnr._compat.get_cpu_time() >= 0
+
+
+def test_profile(runner, workdir):
+    cli = CliRunner()
+
+    result = cli.invoke(runner, [
+        'local', '-j', 'test', '-u', '1', '--workers', '2',
+        '--profile_sample', '0.2'])
+
+    assert result.exit_code == 0
+
+    profiled = sorted(
+        int(f.split('-')[-1].split('.')[0]) for f in os.listdir('log')
+        if f.startswith('profile-test-1-'))
+
+    assert profiled == [0, 5, 10]
+
+    result = cli.invoke(runner, ['profile_merge', '-j', 'test', '-u', '1'])
+
+    assert result.exit_code == 0
+    assert 'run_job' in result.output
+    assert os.path.isfile('log/profile-test-1.pstats')
+
+    result = cli.invoke(runner, ['profile_merge', '-j', 'test', '-u', '2'])
+    assert result.exit_code != 0
+
+
+def test_prep_passes_profile_options(runner, workdir):
+    result = CliRunner().invoke(
+        runner, ['prep', '-j', 'test', '-u', '1', '--profile'])
+
+    assert result.exit_code == 0
+    assert '--profile_sample 1.0' in workdir.join('run-slurm.sh').read()
+
+    result = CliRunner().invoke(
+        runner, ['prep', '-j', 'test', '-u', '1', '--profile_sample', '1.5'])
+
+    assert result.exit_code == 2
+    assert 'not between 0 and 1' in result.output
+
+
+@pytest.fixture
+def fake_sacct(workdir, monkeypatch):
+    '''
+    Put a fake ``sacct`` on the path, reporting two array elements: one on
+    this host covering the next minute, and one on another node
+    '''
+
+    start = time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(time.time()-1))
+    end = time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(time.time()+60))
+
+    rows = [
+        'JobID|JobName|State|Elapsed|Start|End|NodeList|MaxRSS|ReqMem|'
+        'AllocCPUS',
+        '100_0|test|COMPLETED|00:01:01|{}|{}|{}||4000M|1'.format(
+            start, end, socket.gethostname()),
+        '100_0.batch|batch|COMPLETED|00:01:01|{}|{}|{}|1000M||1'.format(
+            start, end, socket.gethostname()),
+        '100_1|test|TIMEOUT|00:02:00|{}|{}|other||4000M|1'.format(
+            start, end)]
+
+    bindir = workdir.join('bin').ensure(dir=True)
+    sacct = bindir.join('sacct')
+    sacct.write('#!/bin/sh\ncat <<EOF\n{}\nEOF\n'.format('\n'.join(rows)))
+    sacct.chmod(0o755)
+
+    monkeypatch.setenv(
+        'PATH', str(bindir) + os.pathsep + os.environ.get('PATH', ''))
+
+
+def test_slurm_report(runner, workdir, fake_sacct):
+    cli = CliRunner()
+
+    result = cli.invoke(runner, [
+        'local', '-j', 'test', '-u', '1', '--workers', '1'])
+
+    result = cli.invoke(runner, [
+        'report', '-j', 'test', '-u', '1', '-s', '100', '--json'])
+
+    assert result.exit_code == 0
+
+    slurm = json.loads(result.output)['slurm']
+    assert slurm['elements'] == 2
+    assert slurm['states'] == {'COMPLETED': 1, 'TIMEOUT': 1}
+    assert slurm['node_hours'] == pytest.approx((61 + 120) / 3600.)
+    assert slurm['memory_headroom'] == pytest.approx(0.75)
+    assert slurm['slowest'][0][0] == '100_1'
+    assert [node['tasks'] for node in slurm['nodes']] == [12, 0]
+
+    result = cli.invoke(runner, ['cleanup', '100'])
+
+    assert result.exit_code == 0
+    assert 'elements:         2 (1 COMPLETED, 1 TIMEOUT)' in result.output
+
+
+def test_longest_first(workdir):
+
+    @slurm_runner(job_spec=JOB_SPEC)
+    def run_job(metadata, model, year, interactive=False):
+        if model == 'c':
+            time.sleep(0.1)
+        elif model == 'b' and year == 2003:
+            time.sleep(0.3)
+
+    cli = CliRunner()
+
+    result = cli.invoke(run_job, [
+        'prep', '-j', 'test', '-u', '2', '--order', 'longest'])
+
+    assert 'no earlier runs of test' in result.output
+    assert '--task_file' not in workdir.join('run-slurm.sh').read()
+
+    # task 11 (model c, year 2003) has never run, so is estimated
+    result = cli.invoke(run_job, [
+        'local', '-j', 'test', '-u', '1', '--stop', '11', '--workers', '1'])
+
+    assert result.exit_code == 0
+
+    result = cli.invoke(run_job, [
+        'prep', '-j', 'test', '-u', '2', '--order', 'longest'])
+
+    assert result.exit_code == 0
+    assert 'durations of 11 earlier tasks' in result.output
+
+    script = workdir.join('run-slurm.sh').read()
+    assert '--num_jobs 12' in script
+
+    task_file = script.split('--task_file ')[1].split()[0]
+    order = [int(i) for i in workdir.join(task_file).read().split()]
+
+    assert sorted(order) == list(range(12))
+    assert set(order[:5]) == {7, 8, 9, 10, 11}
+
+    # more durations don't change the order of a job which has been prepared
+    cli.invoke(run_job, [
+        'local', '-j', 'test', '-u', '3', '--stop', '4', '--workers', '1'])
+
+    result = cli.invoke(run_job, [
+        'prep', '-j', 'test', '-u', '2', '--order', 'longest'])
+
+    assert 'reusing the task order of job 2' in result.output
+    assert '--task_file {} '.format(task_file) in (
+        workdir.join('run-slurm.sh').read())
+
+
+def test_group_by(workdir):
+    completed = []
+    loads = []
+
+    @memoize(maxsize=1)
+    def load(year):
+        loads.append(year)
+        return year
+
+    @slurm_runner(job_spec=JOB_SPEC, group_by=['year'], return_index=True)
+    def run_job(metadata, model, year, task_id, interactive=False):
+        completed.append((task_id, model, load(year)))
+
+    # tasks are renumbered so that each year is consecutive
+    assert run_job.run_interactive(4) is None
+    assert completed[-1] == (4, 'b', 2001)
+
+    del completed[:]
+
+    # worker 0 of 2 runs its own runs of years first, then its neighbor's
+    result = CliRunner().invoke(run_job, [
+        'do_job', '--job_name', 'test', '--job_id', '1', '--num_jobs', '12',
+        '--node_index', '0', '--num_nodes', '2'])
+
+    assert result.exit_code == 0
+    assert [year for _, _, year in completed] == (
+        [2000] * 3 + [2002] * 3 + [2001] * 3 + [2003] * 3)
+
+    assert loads == [2001, 2000, 2002, 2001, 2003]
+
+
+def test_node_cache(tmpdir):
+    np = pytest.importorskip('numpy')
+
+    from jrnr.shm import NodeCache
+
+    loads = tmpdir.join('loads')
+    cache = NodeCache(str(tmpdir.join('shm')), max_bytes=2000)
+
+    def load_array():
+        with open(str(loads), 'a') as f:
+            f.write('x')
+        time.sleep(0.1)
+        return np.arange(100, dtype='float64')
+
+    def worker(queue):
+        value = cache.get('array', load_array)
+        queue.put(float(value.sum()))
+
+    context = multiprocessing.get_context('fork')
+    queue = context.Queue()
+    procs = [context.Process(target=worker, args=(queue, )) for _ in range(4)]
+
+    for proc in procs:
+        proc.start()
+
+    results = [queue.get(timeout=10) for _ in procs]
+
+    for proc in procs:
+        proc.join()
+
+    assert results == [4950.0] * 4
+    assert loads.read() == 'x'
+
+    value = cache.get('array', load_array)
+    assert isinstance(value, np.memmap)
+    assert loads.read() == 'x'
+
+    # 'array' is in use, so 'b' is evicted to make room for 'c'
+    cache.get('b', lambda: np.zeros(100))
+    cache.release('b')
+    cache.get('c', lambda: np.zeros(100))
+
+    assert len(os.listdir(str(tmpdir.join('shm')))) == 5
+
+    assert cache.get('b', lambda: np.ones(100)).sum() == 100
+
+    cache.release('array')
+    cache.release('b')
+    cache.release('c')
+    cache.clear()
+
+    assert not [
+        f for f in os.listdir(str(tmpdir.join('shm')))
+        if not f.endswith('.lock')]
+
+
+def _expire_claim(backend, task_id, age=3600):
+    '''
+    Make the claim on a task look as though it hasn't been refreshed in
+    ``age`` seconds
+    '''
+
+    then = time.time() - age
+
+    if backend == 'file':
+        path = 'locks/test-1-{}.lck'.format(task_id)
+        os.utime(path, (then, then))
+
+    else:
+        conn = sqlite3.connect('locks/jrnr.db')
+        conn.execute(
+            'UPDATE tasks SET updated=? WHERE task_id=?', (then, task_id))
+        conn.commit()
+        conn.close()
+
+
+@pytest.mark.parametrize('backend', ['file', 'sqlite'])
+def test_lease_takeover(workdir, backend):
+    dead = get_state_store('test', '1', backend, lease=60)
+    dead.setup()
+
+    assert dead.claim(3) is None
+
+    # another process trying to claim the task while the lease is current
+    alive = get_state_store('test', '1', backend, lease=60)
+    alive._owner = lambda: ('other-host', 1)
+    alive._held_pid = None
+
+    assert alive.claim(3) == 'lck'
+
+    _expire_claim(backend, 3)
+
+    assert alive.claim(3) is None
+    assert alive.refresh(3)
+    assert not dead.refresh(3)
+
+    # the original holder must not release the new holder's claim
+    dead.release(3)
+    assert alive.claim(3) == 'lck'
+    assert get_state_store('test', '1', backend).counts(10)['lck'] == 1
+
+    alive.complete(3)
+    alive.release(3)
+
+    assert get_state_store('test', '1', backend).counts(10) == {
+        'lck': 0, 'done': 1, 'err': 0}
+
+
+def test_lease_heartbeat(workdir):
+    store = get_state_store('test', '1', lease=0.3)
+    store.setup()
+    store.claim(0, 2)
+
+    path = 'locks/test-1-0_1.lck'
+    then = time.time() - 60
+    os.utime(path, (then, then))
+
+    time.sleep(0.4)
+
+    assert time.time() - os.stat(path).st_mtime < 0.3
+
+    store.release(0, 2)
+    assert not os.path.exists(path)
+
+
+def test_concurrent_claims_are_held(workdir):
+    store = get_state_store('test', '1', lease=60)
+    store.setup()
+
+    start = threading.Event()
+
+    def claim(task_id):
+        start.wait()
+        store.claim(task_id)
+
+    threads = [threading.Thread(target=claim, args=(i, )) for i in range(8)]
+
+    for thread in threads:
+        thread.start()
+
+    start.set()
+
+    for thread in threads:
+        thread.join()
+
+    # every claim is refreshed and released, not just the last thread's
+    for task_id in range(8):
+        assert store.refresh(task_id)
+        store.release(task_id)
+
+    assert os.listdir('locks') == []
+
+    # a claim this process never made is left alone
+    with open('locks/test-1-9.lck', 'w') as f:
+        f.write('other-host 1 token')
+
+    store.release(9)
+    assert os.listdir('locks') == ['test-1-9.lck']
+
+
+def test_do_job_takes_over_expired_claims(workdir, runner):
+    os.makedirs('locks')
+
+    with open('locks/test-1-3.lck', 'w') as f:
+        f.write('dead-host 1 token')
+
+    result = CliRunner().invoke(runner, [
+        'do_job', '--job_name', 'test', '--job_id', '1', '--num_jobs', '12',
+        '--lease', '0.2'])
+
+    assert result.exit_code == 0
+    assert 'task 3 already in progress' not in result.output
+    assert os.path.exists('locks/test-1-3.done')
+    assert sorted(runner.completed) == [i for i in range(12) if i != 8]
+
+    result = CliRunner().invoke(runner, [
+        'prep', '-j', 'test', '-u', '1', '--lease', '0'])
+
+    assert result.exit_code == 2
+    assert 'not greater than 0' in result.output
+
+
+@pytest.mark.parametrize('backend', ['file', 'sqlite'])
+def test_duplicate_attempts_commit_once(workdir, backend):
+    original = get_state_store('test', '1', backend)
+    original.setup()
+
+    assert original.claim(3) is None
+
+    duplicate = get_state_store('test', '1', backend)
+    duplicate._owner = lambda: ('other-host', 1)
+
+    running = duplicate.running([(2, 3), (3, 4)])
+    assert [block[:2] for block in running] == [(3, 4)]
+    assert time.time() - running[0][2] < 60
+
+    assert duplicate.duplicate(3)
+    assert not original.duplicate(3)
+
+    assert duplicate.complete(3)
+    assert not original.complete(3)
+    assert duplicate.running([(3, 4)]) == []
+
+    original.fail(3)
+    original.release(3)
+
+    assert get_state_store('test', '1', backend).counts(10) == {
+        'lck': 0, 'done': 1, 'err': 0}
+
+
+def test_speculate(workdir):
+    @slurm_runner(job_spec=JOB_SPEC, return_index=True)
+    def run_job(metadata, model, year, task_id, interactive=False):
+        with open(stage_output('out/{}.txt'.format(task_id)), 'w') as f:
+            f.write(model)
+
+        if model == 'c' and year == 2000:
+            raise ValueError('bad input')
+
+    workdir.join('out').ensure(dir=True)
+    workdir.join('locks').ensure(dir=True)
+
+    # a claim held by a slow worker for the last hour
+    workdir.join('locks', 'test-1-3.lck').write(
+        'slow-host 1 {!r} token'.format(time.time() - 3600))
+
+    result = CliRunner().invoke(run_job, [
+        'do_job', '--job_name', 'test', '--job_id', '1', '--num_jobs', '12',
+        '--speculate', '0.2'])
+
+    assert result.exit_code == 0
+    assert '3 running for 3600s. starting a duplicate' in result.output
+    assert '3 committed by duplicate attempt' in result.output
+
+    assert os.path.exists('locks/test-1-3.done')
+    assert os.path.exists('log/run-test-1-3-dup.log')
+
+    # staged outputs of failed tasks are discarded
+    assert sorted(os.listdir('out')) == sorted(
+        '{}.txt'.format(i) for i in range(12) if i != 8)
+
+    result = CliRunner().invoke(run_job, [
+        'prep', '-j', 'test', '-u', '1', '--speculate', '-1'])
+
+    assert result.exit_code == 2
+    assert 'not greater than 0' in result.output
+
+
+@pytest.fixture
+def fake_sbatch(workdir, monkeypatch):
+    '''
+    Put a fake ``sbatch`` on the path, which keeps a copy of each script it
+    is given as ``submitted-{job id}.sh``
+    '''
+
+    bindir = workdir.join('bin').ensure(dir=True)
+    sbatch = bindir.join('sbatch')
+    sbatch.write(
+        '#!/bin/sh\n'
+        'id=$((100 + $(ls submitted-*.sh 2>/dev/null | wc -l)))\n'
+        'cp "$1" submitted-$id.sh\n'
+        'echo "Submitted batch job $id"\n')
+    sbatch.chmod(0o755)
+
+    monkeypatch.setenv(
+        'PATH', str(bindir) + os.pathsep + os.environ.get('PATH', ''))
+
+
+def test_release_idle(workdir, fake_sbatch, fake_sacct):
+    finished = []
+
+    @slurm_runner(job_spec=JOB_SPEC, onfinish=lambda: finished.append(1))
+    def run_job(metadata, model, year, interactive=False):
+        pass
+
+    cli = CliRunner()
+
+    result = cli.invoke(run_job, [
+        'run', '-j', 'test', '-n', '4', '--release_idle'])
+
+    assert result.exit_code == 0
+    assert 'run job: 100\non-finish job: 101' in result.output
+
+    script = workdir.join('submitted-100.sh').read()
+    assert ' wait ' not in script
+    assert 'nohup python' not in script
+    assert not script.strip().endswith('&')
+    assert '--node_index ${SLURM_ARRAY_TASK_ID}' in script
+
+    cleanup = workdir.join('submitted-101.sh').read().strip().splitlines()[-1]
+    args = cleanup.split(' cleanup ')[1].split()
+    assert args == [
+        '100', '--job_name', 'test', '--job_id', '"100"', '--num_jobs', '12']
+
+    args = [arg.strip('"') for arg in args]
+
+    result = cli.invoke(run_job, ['cleanup'] + args[:1] + [
+        '-j', 'test', '-u', '100', '--num_jobs', '12'])
+
+    assert result.exit_code != 0
+    assert 'tasks: 0 done, 0 errored, 12 unfinished' in result.output
+    assert finished == []
+
+    cli.invoke(run_job, ['local', '-j', 'test', '-u', '100', '--workers', '1'])
+    result = cli.invoke(run_job, ['cleanup'] + args)
+
+    assert result.exit_code == 0
+    assert finished == [1]
+
+
+def test_worker_log_mode(workdir, runner):
+    cli = CliRunner()
+
+    result = cli.invoke(runner, [
+        'local', '-j', 'test', '-u', '1', '--workers', '2', '--threads', '2',
+        '--log_mode', 'worker'])
+
+    assert result.exit_code == 0
+
+    logs = os.listdir('log')
+    assert not [f for f in logs if f.startswith('run-')]
+    assert len([f for f in logs if f.startswith('worker-test-1-')]) == 4
+
+    result = cli.invoke(runner, ['logs', '-j', 'test', '-u', '1', '-t', '8'])
+
+    assert result.exit_code == 0
+    lines = result.output.splitlines()
+    assert all(line.startswith('task 8: ') for line in lines)
+    assert "'model': 'c'" in result.output
+    assert 'ValueError: bad input' in result.output
+
+    result = cli.invoke(runner, ['logs', '-j', 'test', '-u', '1', '-t', '5'])
+    assert 'Error encountered' not in result.output
+    assert "'model': 'b', 'year': '2001'" in result.output
+
+    result = cli.invoke(runner, ['logs', '-j', 'test', '-u', '1', '-t', '50'])
+    assert result.exit_code != 0
+
+    # logs of tasks with their own log file
+    cli.invoke(runner, ['local', '-j', 'test', '-u', '2', '--workers', '1'])
+    result = cli.invoke(runner, ['logs', '-j', 'test', '-u', '2', '-t', '8'])
+    assert 'ValueError: bad input' in result.output
+
+
+@pytest.mark.parametrize('policy', ['chained', 'concurrent'])
+def test_chunked_run(workdir, fake_sbatch, fake_sacct, policy):
+    finished = []
+
+    @slurm_runner(job_spec=JOB_SPEC, onfinish=lambda: finished.append(1))
+    def run_job(metadata, model, year, interactive=False):
+        pass
+
+    cli = CliRunner()
+
+    result = cli.invoke(run_job, [
+        'run', '-j', 'test', '-n', '4', '--chunk_size', '5',
+        '--chunk_policy', policy, '-d', '99'])
+
+    assert result.exit_code == 0
+    assert 'chunk job: 101 (tasks 5 to 9)' in result.output
+    assert 'run job: 100\non-finish job: 103' in result.output
+
+    scripts = [
+        workdir.join('submitted-{}.sh'.format(i)).read()
+        for i in range(100, 103)]
+
+    assert '--start' not in scripts[0]
+    assert '--job_id "${SLURM_ARRAY_JOB_ID}" --num_jobs 5 ' in scripts[0]
+    assert '--job_id "100" --num_jobs 10 ' in scripts[1]
+    assert '--job_id "100" --num_jobs 12 ' in scripts[2]
+    assert 'wait --job_name test --job_id "100" --num_jobs 12 --start 10' in (
+        scripts[2])
+
+    # two nodes are enough for the last two tasks
+    assert '#SBATCH --array=0-0' in scripts[2]
+
+    if policy == 'chained':
+        deps = ['99', '100', '101']
+    else:
+        deps = ['99', '99', '99']
+
+    for script, dep in zip(scripts, deps):
+        assert '#SBATCH --dependency=afterany:{}\n'.format(dep) in script
+
+    finish = workdir.join('submitted-103.sh').read()
+    assert '#SBATCH --dependency=afterany:100,101,102' in finish
+
+    args = finish.strip().splitlines()[-1].split(' cleanup ')[1].split()
+    assert args == [
+        '100', '101', '102', '--job_name', 'test', '--job_id', '"100"',
+        '--num_jobs', '12']
+
+    result = cli.invoke(run_job, [
+        'do_job', '--job_name', 'test', '--job_id', '100', '--num_jobs', '10',
+        '--start', '5'])
+
+    assert result.exit_code == 0
+
+    result = cli.invoke(run_job, [
+        'status', '-j', 'test', '-u', '100', '--chunk_size', '5', '--json'])
+
+    status = json.loads(result.output)
+    assert status['done'] == 5
+    assert [(c['start'], c['stop'], c['done']) for c in status['chunks']] == [
+        (0, 5, 0), (5, 10, 5), (10, 12, 0)]
+
+    result = cli.invoke(run_job, [
+        'status', '-j', 'test', '-u', '100', '--chunk_size', '5'])
+
+    assert '5-9' in result.output
+
+    # chunks of a run with --claim_batch 2 are rounded up to 6 tasks
+    result = cli.invoke(run_job, [
+        'status', '-j', 'test', '-u', '100', '--chunk_size', '5',
+        '--claim_batch', '2', '--json'])
+
+    status = json.loads(result.output)
+    assert [(c['start'], c['stop'], c['done']) for c in status['chunks']] == [
+        (0, 6, 1), (6, 12, 4)]
+
+    result = cli.invoke(run_job, ['cleanup'] + [a.strip('"') for a in args])
+
+    assert result.exit_code != 0
+    assert 'tasks: 5 done, 0 errored, 7 unfinished' in result.output
+    assert finished == []